@@ -1,25 +1,64 @@
+from array import array
+from copy import copy
 from dataclasses import dataclass
+from collections import OrderedDict
+from functools import lru_cache
+from itertools import chain, islice, tee
+from operator import attrgetter
 from util import *
+from profiler import Profiler, DISABLED_PROFILER, PROFILE_FORMATS
+from preprocessor import Preprocessor, is_local_tagname
 import argparse
-
-MEM_OPCODE = '000'
-ADD_OPCODE = '001'
-AND_OPCODE = '010'
-XOR_OPCODE = '011'
-ROL_OPCODE = '100'
-BEQ_OPCODE = '101'
-SET_OPCODE = '110'
-MOV_OPCODE = '111'
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import glob
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+
+MEM_OPCODE = 0b000
+ADD_OPCODE = 0b001
+AND_OPCODE = 0b010
+XOR_OPCODE = 0b011
+ROL_OPCODE = 0b100
+BEQ_OPCODE = 0b101
+SET_OPCODE = 0b110
+MOV_OPCODE = 0b111
+
+# bit positions of the fields inside a 9 bit word
+OPCODE_SHIFT = 6
+DEST_REG_SHIFT = 3
+SET_FLAG_SHIFT = 4
+MEM_FLAG_SHIFT = 2
 
 RESERVED_REGISTER_NAME = 'R7'
 
-SUPPORTED_REGISTERS = ['R0', 'R1', 'R2', 'R3', 'R4', 'R5', 'R6', RESERVED_REGISTER_NAME]
-SUPPORTED_MULTI_INSTRUCTIONS = ['ADD', 'SUB', 'AND', 'XOR', 'ROL', 'ROR', 'LSL', 'LSR', 'MOV']
-SUPPORTED_REGISTER_ONLY_INSTRUCTIONS = []
-SUPPORTED_IMMEDIATE_ONLY_INSTRUCTIONS = []
-SUPPORTED_MEMORY_INSTRUCTIONS = ['LDR', 'STR']
-SUPPORTED_BRANCH_INSTRUCTIONS = ['BEQ']
-SUPPORTED_SINGLE_INSTRUCTIONS = ['ZER']
+REGISTER_BITS = {'R0': 0b000, 'R1': 0b001, 'R2': 0b010, 'R3': 0b011, 'R4': 0b100, 'R5': 0b101, 'R6': 0b110, RESERVED_REGISTER_NAME: 0b111}
+SUPPORTED_REGISTERS = frozenset(REGISTER_BITS)
+
+# [1:0] of a MEM word, selects where the address comes from
+MEM_TARGET_LOCATION_BITS = {RESERVED_REGISTER_NAME: 0b00, '200': 0b01, '201': 0b10}
+
+# operand shapes, see INSTRUCTION_SPECS
+REG = 'reg'
+IMM = 'imm'
+TAG = 'tag'
+
+# operands are separated by a comma, whitespace or both
+OPERAND_SEPARATOR_PATTERN = re.compile(r'\s*,\s*|\s+')
+TAG_DEFINITION_PATTERN = re.compile(r'@(?P<name>[A-Za-z_][\w.]*):?')
+# one pattern per operand shape, tried in order since a register name would also match the tag pattern
+OPERAND_SHAPE_PATTERNS = [
+	(REG, '|'.join(REGISTER_BITS)),
+	(IMM, r'#(?:0x[0-9a-f]+|0b[01]+|\d+)'),
+	(TAG, r'[A-Za-z_][\w.]*'),
+]
+# all shapes in one regex, the name of the group that matched is the shape
+OPERAND_PATTERN = re.compile('|'.join(f'(?P<{shape}>{pattern})' for shape, pattern in OPERAND_SHAPE_PATTERNS), re.IGNORECASE)
+# an operand in a tag position is a tag even when it is spelled like a register, tag definitions accept those names
+TAG_OPERAND_PATTERN = re.compile(dict(OPERAND_SHAPE_PATTERNS)[TAG])
 
 '''
 Machine Code (9 Bits):
@@ -74,11 +113,15 @@ Tags are also supported:
 @<tagname>: 
 
 This will mark a tag. Make sure that the tag name is the only thing on the line. Tags are case sensitive. 
+A tag name starts with a letter or an underscore, followed by letters, digits, underscores or dots
+([A-Za-z_][A-Za-z0-9_.]*), and a tag may only be defined once.
 How are immediates handled?
 
 R7 is reserved for storing immediate values. The machine itself does not support immediates directly - everything has to be put into 
 R7 first. This is done by the assembler. The assembler will take the immediate value and store it in R7. Then, the assembler will call the same 
 instruction again, but with R7 as the source register. This will cause the machine to perform the operation with the immediate value in R7.
+Immediates therefore take 0 to 255, SUB takes 1 to 255 since it adds the negated value and the shift amounts
+of ROR, LSL and LSR can be any value. Immediates out of range are reported by the lexer with their line.
 
 The only instruction that can actually use R7 is the SET instruction. This instruction is not accessible to the programmer. It is only used 
 by the assembler to set the value of R7. 
@@ -156,8 +199,32 @@ class RawInstruction(SourceArtifact):
 class Tag(SourceArtifact):
 	name: str
 
-# maps tag names to line numbers
-tag_map = dict()
+# one per BEQ, records where its SET/MEM preamble sits so it can be patched once the tag address is known
+# preamble slots that were optimized away are None
+@dataclass
+class BranchFixup:
+	tagname: str
+	address: int
+	preamble: (int, int, int, int, int)
+
+@dataclass
+class SymbolTable:
+	# maps tag names to instruction addresses
+	tags: dict
+	fixups: [BranchFixup]
+
+# number of SET/MEM words process_beq_instr emits in front of every branch
+BRANCH_PREAMBLE_LENGTH = 5
+# instructions buffered by the streaming resolver before they are passed on
+STREAM_FLUSH_SIZE = 4096
+# distinct source lines kept by the expansion cache
+EXPANSION_CACHE_SIZE = 4096
+# on disk cache of lowered tag regions, bump the version whenever lowering changes
+REGION_CACHE_DIR = '.datalore-cache'
+REGION_CACHE_VERSION = 4
+REGION_CACHE_EXTENSION = '.regions'
+# sources whose regions are kept, the files of the least recently built ones are removed first
+REGION_CACHE_SOURCES = 256
 
 # ----------------------------------------------
 @dataclass
@@ -224,126 +291,134 @@ class TagMachineInstruction(MachineInstruction):
 
 # ----------------------------------------------
 
-def is_valid_instruction(tokens: [str]) -> bool:
-	if len(tokens) != 2 and len(tokens) != 3 and len(tokens) != 4 and not tokens[0].startswith('@'):
-		return False
-	mnemonic = tokens[0]
-	operand1 = tokens[1]
-	operand2 = None
-	if len(tokens) == 3 or len(tokens) == 4:
-		operand2 = tokens[2]
-	# multi instructions must either have two registers or one reg and one imm in the form of #<imm>
-	if mnemonic in SUPPORTED_MULTI_INSTRUCTIONS:
-		if operand1 in SUPPORTED_REGISTERS and operand2 in SUPPORTED_REGISTERS:
-			return True
-		elif operand1 in SUPPORTED_REGISTERS and operand2.startswith('#') and operand2[1:].isnumeric():
-			return True
-		else:
-			return False
-	elif mnemonic in SUPPORTED_REGISTER_ONLY_INSTRUCTIONS:
-		if operand1 in SUPPORTED_REGISTERS and operand2 in SUPPORTED_REGISTERS:
-			return True
-		else:
-			return False
-	elif mnemonic in SUPPORTED_IMMEDIATE_ONLY_INSTRUCTIONS:
-		if operand1 in SUPPORTED_REGISTERS and operand2.startswith('#') and operand2[1:].isnumeric():
-			return True
-		else:
-			return False
-	elif mnemonic in SUPPORTED_MEMORY_INSTRUCTIONS:
-		if operand1 in SUPPORTED_REGISTERS and operand2 in SUPPORTED_REGISTERS:
-			return True
-		elif operand1 in SUPPORTED_REGISTERS and operand2.startswith('#') and operand2[1:].isnumeric():
-			return True
-		else:
-			return False
-	elif mnemonic in SUPPORTED_BRANCH_INSTRUCTIONS:
-		if operand1 in SUPPORTED_REGISTERS and operand2 in SUPPORTED_REGISTERS and len(tokens) == 4:
-			return True
-		else:
-			return False
-	elif mnemonic in SUPPORTED_SINGLE_INSTRUCTIONS:
-		if operand1 in SUPPORTED_REGISTERS and len(tokens) == 2:
-			return True
-		else:
-			return False
-	else:
-		return False
+def classify_operand(operand: str, is_tag: bool = False) -> str:
+	if is_tag:
+		return TAG if TAG_OPERAND_PATTERN.fullmatch(operand) is not None else None
+	match = OPERAND_PATTERN.fullmatch(operand)
+	return match.lastgroup if match is not None else None
+
+'''
+Returns the canonical tokens of a source line: ('@<tagname>',) for a tag, the upper case mnemonic followed by
+the operands for an instruction and nothing for a blank or comment line. Raises on a malformed line.
+'''
+def lex_source_line(line: str) -> (str, ...):
+	return lex_statement(line.partition('//')[0].strip())
+
+# sources repeat the same statements a lot, only the distinct ones are classified
+@lru_cache(maxsize=EXPANSION_CACHE_SIZE)
+def lex_statement(statement: str) -> (str, ...):
+	if not statement:
+		return ()
+	if statement.startswith('@'):
+		match = TAG_DEFINITION_PATTERN.fullmatch(statement)
+		if match is None:
+			raise Exception(f'Invalid tag: {statement}')
+		return ('@' + match.group('name'),)
+	tokens = OPERAND_SEPARATOR_PATTERN.split(statement)
+	mnemonic = tokens[0].upper()
+	operand_shapes = VALID_OPERAND_SHAPES.get(mnemonic)
+	if operand_shapes is None:
+		raise Exception(f'Invalid instruction: {tokens[0]}')
+	operands = []
+	shapes = []
+	imm = None
+	tag_positions = TAG_OPERAND_POSITIONS[mnemonic]
+	for position, operand in enumerate(tokens[1:]):
+		shape = classify_operand(operand, position in tag_positions)
+		if shape is None:
+			raise Exception(f'Invalid operand: {operand}')
+		if shape == REG:
+			operand = operand.upper()
+		elif shape == IMM:
+			# hex and binary immediates become decimal, the later stages only parse those
+			imm = parse_immediate(operand[1:])
+			operand = f'#{imm}'
+		operands.append(operand)
+		shapes.append(shape)
+	if tuple(shapes) not in operand_shapes:
+		raise Exception(f'Invalid operands for {mnemonic}: {", ".join(tokens[1:])}')
+	# checked here so that the line is reported with the other lexer errors instead of failing the lowering
+	immediates = VALID_IMMEDIATES[mnemonic]
+	if imm is not None and immediates is not None and imm not in immediates:
+		raise Exception(f'Immediate value {imm} is out of range for {mnemonic}, expected {immediates.start} to {immediates.stop - 1}')
+	return (mnemonic, *operands)
+
+'''
+Lexes the (line number, raw line) pairs into canonical lines, one per tag or instruction. The line number of
+every line that is passed on is appended to line_numbers when it is given. Malformed lines and tags that are
+defined twice are skipped and reported together once the input is exhausted.
+'''
+def lex_source_lines(numbered_lines: [(int, str)], line_numbers: [int] = None) -> [str]:
+	errors = []
+	# line number of every tag definition, a tag may only be defined once
+	tag_lines = dict()
+	for line_number, line in numbered_lines:
+		try:
+			tokens = lex_source_line(line)
+		except Exception as e:
+			errors.append(f'line {line_number}: {e}')
+			continue
+		if tokens and tokens[0].startswith('@'):
+			if tokens[0] in tag_lines:
+				errors.append(f'line {line_number}: Tag {tokens[0][1:]} is already defined on line {tag_lines[tokens[0]]}')
+				continue
+			tag_lines[tokens[0]] = line_number
+		if tokens:
+			if line_numbers is not None:
+				line_numbers.append(line_number)
+			yield ' '.join(tokens)
+	if errors:
+		raise Exception(f'{len(errors)} invalid source line(s):\n' + '\n'.join(errors))
+
+def get_source_artifact(tokens: (str, ...)) -> SourceArtifact:
+	if tokens[0].startswith('@'):
+		return Tag(name=tokens[0][1:])
+	operand2 = tokens[2] if len(tokens) > 2 else None
+	tagname = tokens[3] if len(tokens) > 3 else None
+	return RawInstruction(mnemonic=tokens[0], operand1=tokens[1], operand2=operand2, tagname=tagname)
 
 def get_source_artifacts(cleaned_lines: [str]) -> [SourceArtifact]:
-	source_artifacts = []
 	for line in cleaned_lines:
-		if line.startswith('@'):
-			# tag
-			tagname = line[1:]
-			tag = Tag(name=tagname)
-			source_artifacts.append(tag)
-		else:
-			# instruction (make sure mnemonic is upper case)
-			tokens = line.replace(',', '').split(' ')
-			if is_valid_instruction(tokens):
-				mnemonic = tokens[0].upper()
-				operand1 = tokens[1]
-				operand2 = None
-				tagname = None
-				if len(tokens) == 3:
-					operand2 = tokens[2]
-				elif len(tokens) == 4:
-					operand2 = tokens[2]
-					tagname = tokens[3]
-				raw_instr = RawInstruction(mnemonic=mnemonic, operand1=operand1, operand2=operand2, tagname=tagname)
-				source_artifacts.append(raw_instr)
-			else:
-				raise Exception(f'Invalid instruction: {line}')
-	return source_artifacts
+		tokens = lex_source_line(line)
+		if tokens:
+			yield get_source_artifact(tokens)
+
+def build_alu_intermediate(raw_instr: RawInstruction) -> IntermediateInstruction:
+	if raw_instr.operand2 is None:
+		# single register instructions (ZER)
+		return RegisterIntermediateInstruction(mnemonic=raw_instr.mnemonic, dest_reg=raw_instr.operand1, src_reg=None)
+	elif raw_instr.operand2.startswith('#'):
+		return ImmediateIntermediateInstruction(mnemonic=raw_instr.mnemonic, dest_reg=raw_instr.operand1, imm=raw_instr.operand2[1:])
+	else:
+		return RegisterIntermediateInstruction(mnemonic=raw_instr.mnemonic, dest_reg=raw_instr.operand1, src_reg=raw_instr.operand2)
 
-def get_intermediate_instructions(raw_instr: RawInstruction) -> [IntermediateInstruction]:
-	intermediate_instructions = []
-	mnemonic = raw_instr.mnemonic
-	operand1 = raw_instr.operand1
-	operand2 = raw_instr.operand2
-	tagname = raw_instr.tagname
-	if mnemonic in SUPPORTED_BRANCH_INSTRUCTIONS:
-		branch_instr = BranchIntermediateInstruction(mnemonic=mnemonic, operand_reg1=operand1, operand_reg2=operand2, tagname=tagname)
-		intermediate_instructions.append(branch_instr)
-	elif mnemonic in SUPPORTED_MEMORY_INSTRUCTIONS:
-		is_load = mnemonic == 'LDR'
-		if operand2.startswith('#'):
-			mem_instr = MemoryIntermediateInstruction(mnemonic=mnemonic, is_load=is_load, target_reg=operand1, source_reg=None, addr=operand2[1:])
-		else:
-			mem_instr = MemoryIntermediateInstruction(mnemonic=mnemonic, is_load=is_load, target_reg=operand1, source_reg=operand2, addr=None)
-		intermediate_instructions.append(mem_instr)
-	elif mnemonic in SUPPORTED_REGISTER_ONLY_INSTRUCTIONS:
-		intermediate_instructions.append(RegisterIntermediateInstruction(mnemonic=mnemonic, dest_reg=operand1, src_reg=operand2))
-	elif mnemonic in SUPPORTED_IMMEDIATE_ONLY_INSTRUCTIONS:
-		imm = operand2[1:]
-		intermediate_instructions.append(ImmediateIntermediateInstruction(mnemonic=mnemonic, dest_reg=operand1, imm=imm))
-	elif mnemonic in SUPPORTED_MULTI_INSTRUCTIONS:
-		if operand2.startswith('#'):
-			imm = operand2[1:]
-			intermediate_instructions.append(ImmediateIntermediateInstruction(mnemonic=mnemonic, dest_reg=operand1, imm=imm))
-		else:
-			intermediate_instructions.append(RegisterIntermediateInstruction(mnemonic=mnemonic, dest_reg=operand1, src_reg=operand2))
-	elif mnemonic in SUPPORTED_SINGLE_INSTRUCTIONS:
-		intermediate_instructions.append(RegisterIntermediateInstruction(mnemonic=mnemonic, dest_reg=operand1, src_reg=None))
+def build_memory_intermediate(raw_instr: RawInstruction) -> IntermediateInstruction:
+	is_load = raw_instr.mnemonic == 'LDR'
+	if raw_instr.operand2.startswith('#'):
+		return MemoryIntermediateInstruction(mnemonic=raw_instr.mnemonic, is_load=is_load, target_reg=raw_instr.operand1, source_reg=None, addr=raw_instr.operand2[1:])
 	else:
+		return MemoryIntermediateInstruction(mnemonic=raw_instr.mnemonic, is_load=is_load, target_reg=raw_instr.operand1, source_reg=raw_instr.operand2, addr=None)
+
+def build_branch_intermediate(raw_instr: RawInstruction) -> IntermediateInstruction:
+	return BranchIntermediateInstruction(mnemonic=raw_instr.mnemonic, operand_reg1=raw_instr.operand1, operand_reg2=raw_instr.operand2, tagname=raw_instr.tagname)
+
+def get_intermediate_instructions(raw_instr: RawInstruction) -> [IntermediateInstruction]:
+	spec = INSTRUCTION_TABLE.get(raw_instr.mnemonic)
+	if spec is None:
 		raise Exception(f'Invalid instruction: {raw_instr}')
-	return intermediate_instructions
+	return [spec.build(raw_instr)]
 	
 def process_source_artifacts(source_artifacts: [SourceArtifact]) -> [IntermediateInstruction]:
-	intermediate_instructions = []
 	for source_artifact in source_artifacts:
 		if isinstance(source_artifact, RawInstruction):
-			intermediate_instructions += get_intermediate_instructions(source_artifact)
+			yield from get_intermediate_instructions(source_artifact)
 		elif isinstance(source_artifact, Tag):
-			intermediate_instructions.append(TagIntermediateInstruction(mnemonic=None, tagname=source_artifact.name))
-	return intermediate_instructions
+			yield TagIntermediateInstruction(mnemonic=None, tagname=source_artifact.name)
 
 def process_general_register_instruction(reg_instr: RegisterIntermediateInstruction) -> [MachineInstruction]:
 	return [RegMachineInstr(mnemonic=reg_instr.mnemonic, dest_reg=reg_instr.dest_reg, src_reg=reg_instr.src_reg)]
 
 def process_general_immediate_instruction(imm_instr: ImmediateIntermediateInstruction) -> [MachineInstruction]:
-	print(imm_instr.imm)
 	left_imm, right_imm = get_half_imms(imm_instr.imm)
 	first_set_instr = SetMachineInstr(mnemonic='SET', flag=False, imm=left_imm)
 	second_set_instr = SetMachineInstr(mnemonic='SET', flag=True, imm=right_imm)
@@ -512,216 +587,1640 @@ def process_tag_instr(tag_instr: TagIntermediateInstruction) -> [MachineInstruct
 	return [TagMachineInstruction(mnemonic=None, tagname=tagname)]
 
 def process_intermediate_instruction(intermediate_instr: IntermediateInstruction) -> [MachineInstruction]:
-	mnemonic = intermediate_instr.mnemonic
 	if isinstance(intermediate_instr, TagIntermediateInstruction):
 		return process_tag_instr(intermediate_instr)
-	if mnemonic == 'ADD':
-		return process_add_instr(intermediate_instr)
-	elif mnemonic == 'SUB':
-		return process_sub_instr(intermediate_instr)
-	elif mnemonic == 'AND':
-		return process_and_instr(intermediate_instr)
-	elif mnemonic == 'LDR' or mnemonic == 'STR':
-		return process_mem_instruction(intermediate_instr)
-	elif mnemonic == 'XOR':
-		return process_xor_instr(intermediate_instr)
-	elif mnemonic == 'ROL':
-		return process_rol_instr(intermediate_instr)
-	elif mnemonic == 'ROR':
-		return process_ror_instr(intermediate_instr)
-	elif mnemonic == 'LSL':
-		return process_lsl_instr(intermediate_instr)
-	elif mnemonic == 'LSR':
-		return process_lsr_instr(intermediate_instr)
-	elif mnemonic == 'BEQ':
-		return process_beq_instr(intermediate_instr)
-	elif mnemonic == 'MOV':
-		return process_mov_instr(intermediate_instr)
-	elif mnemonic == 'ZER':
-		return process_zer_instr(intermediate_instr)
-	else:
+	spec = INSTRUCTION_TABLE.get(intermediate_instr.mnemonic)
+	if spec is None:
 		raise Exception(f'Invalid intermediate instruction: {intermediate_instr}')
+	return spec.lower(intermediate_instr)
 
 def process_intermediate_instructions(intermediate_instructions: [IntermediateInstruction]) -> [MachineInstruction]:
-	machine_instructions = []
 	for intermediate_instr in intermediate_instructions:
-		machine_instructions += process_intermediate_instruction(intermediate_instr)
-	return machine_instructions
+		yield from process_intermediate_instruction(intermediate_instr)
 
-def get_register_bits(reg: str) -> str:
-	if reg == 'R0':
-		return '000'
-	elif reg == 'R1':
-		return '001'
-	elif reg == 'R2':
-		return '010'
-	elif reg == 'R3':
-		return '011'
-	elif reg == 'R4':
-		return '100'
-	elif reg == 'R5':
-		return '101'
-	elif reg == 'R6':
-		return '110'
-	elif reg == 'R7':
-		return '111'
-	else:
+def get_register_bits(reg: str) -> int:
+	bits = REGISTER_BITS.get(reg)
+	if bits is None:
 		raise Exception(f'Invalid register: {reg}')
+	return bits
 	
-def get_opcode_bits(mnemonic: str) -> str:
-	if mnemonic == 'ADD':
-		return ADD_OPCODE
-	elif mnemonic == 'AND':
-		return AND_OPCODE
-	elif mnemonic == 'XOR':
-		return XOR_OPCODE
-	elif mnemonic == 'ROL':
-		return ROL_OPCODE
-	elif mnemonic == 'BEQ':
-		return BEQ_OPCODE
-	elif mnemonic == 'SET':
-		return SET_OPCODE
-	elif mnemonic == 'MEM':
-		return MEM_OPCODE
-	elif mnemonic == 'MOV':
-		return MOV_OPCODE
-	else:
+def get_opcode_bits(mnemonic: str) -> int:
+	opcode = OPCODES.get(mnemonic)
+	if opcode is None:
 		raise Exception(f'Invalid mnemonic: {mnemonic}')
+	return opcode
+
+def get_branch_fixup(machine_instr: BrnMachineInstr, address: int) -> BranchFixup:
+	preamble = tuple(range(address - BRANCH_PREAMBLE_LENGTH, address))
+	return BranchFixup(tagname=machine_instr.tagname, address=address, preamble=preamble)
 
 '''
-Returns the tagless version of the machine instructions with all the tag information being extracted
+Returns the tagless version of the machine instructions along with the symbol table built from them.
+Tag addresses and branch fixups are collected in a single pass.
 '''
-def extract_tag_information(machine_instructions: [MachineInstruction]) -> [MachineInstruction]:
-	ctr = 0
+def extract_tag_information(machine_instructions: [MachineInstruction]) -> ([MachineInstruction], SymbolTable):
+	symbol_table = SymbolTable(tags=dict(), fixups=[])
+	tagless_instructions = []
 	for machine_instr in machine_instructions:
 		if isinstance(machine_instr, TagMachineInstruction):
-			tag_map[machine_instr.tagname] = ctr
-			machine_instructions.remove(machine_instr)
-		else:
-			ctr += 1
+			symbol_table.tags[machine_instr.tagname] = len(tagless_instructions)
+			continue
+		if isinstance(machine_instr, BrnMachineInstr):
+			symbol_table.fixups.append(get_branch_fixup(machine_instr, len(tagless_instructions)))
+		tagless_instructions.append(machine_instr)
+	return tagless_instructions, symbol_table
+
+def get_branch_offset_nibbles(tag_offset: int) -> (str, str, str):
+	if tag_offset < -2048 or tag_offset > 2047:
+		raise Exception(f'Tag offset is too large: {tag_offset}')
+	# the 12 bit two's complement of the offset
+	return TWELVE_BIT_NIBBLES[tag_offset & 0xFFF]
+
+'''
+Fills in the SET/MEM preamble that process_beq_instr left in front of a branch.
+base is the address of machine_instructions[0], for callers that only hold a window of the program.
+'''
+def patch_branch_preamble(machine_instructions: [MachineInstruction], fixup: BranchFixup, tag_address: int, base: int = 0):
+	lower_right_imm, upper_left_imm, upper_right_imm = get_branch_offset_nibbles(tag_address - fixup.address)
+	preamble_instructions = [
+		SetMachineInstr(mnemonic='SET', flag=True, imm=lower_right_imm),
+		MemMachineInstr(mnemonic='MEM', is_load=False, target_reg=RESERVED_REGISTER_NAME, target_location='200'),
+		SetMachineInstr(mnemonic='SET', flag=False, imm=upper_left_imm),
+		SetMachineInstr(mnemonic='SET', flag=True, imm=upper_right_imm),
+		MemMachineInstr(mnemonic='MEM', is_load=False, target_reg=RESERVED_REGISTER_NAME, target_location='201'),
+	]
+	for addr, preamble_instr in zip(fixup.preamble, preamble_instructions):
+		if addr is not None:
+			machine_instructions[addr - base] = preamble_instr
+
+def tag_branch_instructions(machine_instructions: [MachineInstruction], symbol_table: SymbolTable) -> [MachineInstruction]:
+	# store the binary representation of the offset from each branch to its tag
+	for fixup in symbol_table.fixups:
+		if fixup.tagname not in symbol_table.tags:
+			raise Exception(f'Invalid tag: {fixup.tagname}')
+		patch_branch_preamble(machine_instructions, fixup, symbol_table.tags[fixup.tagname])
 	return machine_instructions
 
-def tag_branch_instructions(machine_instructions: [MachineInstruction]) -> [MachineInstruction]:
-	# store the binary representation of the offset from the current instruction to the tag
-	for i, machine_instr in enumerate(machine_instructions):
+'''
+Streaming replacement for extract_tag_information + tag_branch_instructions.
+Instructions are passed through as soon as they can no longer be part of an unpatched branch preamble.
+Only the window starting at the oldest branch with a forward (not yet seen) tag is buffered.
+'''
+def resolve_branch_instructions(machine_instructions: [MachineInstruction]) -> [MachineInstruction]:
+	symbol_table = SymbolTable(tags=dict(), fixups=[])
+	# fixups waiting for their tag, by tag name
+	unresolved = dict()
+	pending = []
+	pending_base = 0
+	addr = 0
+	for machine_instr in machine_instructions:
+		if isinstance(machine_instr, TagMachineInstruction):
+			symbol_table.tags[machine_instr.tagname] = addr
+			for fixup in unresolved.pop(machine_instr.tagname, []):
+				patch_branch_preamble(pending, fixup, addr, pending_base)
+			continue
+		pending.append(machine_instr)
 		if isinstance(machine_instr, BrnMachineInstr):
-			tagname = machine_instr.tagname
-			if tagname not in tag_map:
-				raise Exception(f'Invalid tag: {tagname}')
-			tag_offset = tag_map[tagname] - i
-			if tag_offset < -2048 or tag_offset > 2047:
-				raise Exception(f'Tag offset is too large: {tag_offset}')
-			if tag_offset < 0:
-				tag_offset = get_12_bit_twos_comp_negative(str(abs(tag_offset)))
+			fixup = get_branch_fixup(machine_instr, addr)
+			if fixup.tagname in symbol_table.tags:
+				patch_branch_preamble(pending, fixup, symbol_table.tags[fixup.tagname], pending_base)
 			else:
-				tag_offset = get_12_bit_memory_address(tag_offset)
-			lower_right_imm, upper_left_imm, upper_right_imm = tag_offset[0:4], tag_offset[4:8], tag_offset[8:12]
-			# verifying instructions
-			if not isinstance(machine_instructions[i-5], SetMachineInstr) or machine_instructions[i-5].imm is not None:
-				raise Exception(f'Invalid Branch Instruction State Detected, Expected Empty Set Instruction 5 indices earlier')
-			if not isinstance(machine_instructions[i-4], MemMachineInstr) or machine_instructions[i-4].target_location != '200':
-				raise Exception(f'Invalid Branch Instruction State Detected, Expected STR R7, 200 4 indices earlier')	
-			if not isinstance(machine_instructions[i-3], SetMachineInstr) or machine_instructions[i-3].imm is not None:
-				raise Exception(f'Invalid Branch Instruction State Detected, Expected Empty Set Instruction 3 indices earlier')
-			if not isinstance(machine_instructions[i-2], SetMachineInstr) or machine_instructions[i-2].imm is not None:
-				raise Exception(f'Invalid Branch Instruction State Detected, Expected Empty Set Instruction 2 indices earlier')
-			if not isinstance(machine_instructions[i-1], MemMachineInstr) or machine_instructions[i-1].target_location != '201':
-				raise Exception(f'Invalid Branch Instruction State Detected, Expected STR R7, 201 1 index before')
-			first_set_instr = SetMachineInstr(mnemonic='SET', flag=True, imm=lower_right_imm)
-			first_mem_instr = MemMachineInstr(mnemonic='MEM', is_load=False, target_reg=RESERVED_REGISTER_NAME, target_location='200')
-			second_set_instr = SetMachineInstr(mnemonic='SET', flag=False, imm=upper_left_imm)
-			third_set_instr = SetMachineInstr(mnemonic='SET', flag=True, imm=upper_right_imm)
-			second_mem_instr = MemMachineInstr(mnemonic='MEM', is_load=False, target_reg=RESERVED_REGISTER_NAME, target_location='201')
-			machine_instructions[i-5] = first_set_instr
-			machine_instructions[i-4] = first_mem_instr
-			machine_instructions[i-3] = second_set_instr
-			machine_instructions[i-2] = third_set_instr
-			machine_instructions[i-1] = second_mem_instr
-	return machine_instructions
-
-def encode_register_instruction(machine_instr: RegMachineInstr) -> str:
-	valid_instructions = ['ADD', 'AND', 'XOR', 'ROL', 'MOV']
-	if machine_instr.mnemonic not in valid_instructions:
+				unresolved.setdefault(fixup.tagname, []).append(fixup)
+		addr += 1
+		# keep the last few instructions around, they may be the preamble of the next branch
+		if not unresolved and len(pending) >= STREAM_FLUSH_SIZE:
+			flushed = len(pending) - BRANCH_PREAMBLE_LENGTH
+			yield from pending[:flushed]
+			del pending[:flushed]
+			pending_base += flushed
+	if unresolved:
+		raise Exception(f'Invalid tag: {next(iter(unresolved))}')
+	yield from pending
+
+def encode_register_instruction(machine_instr: RegMachineInstr) -> int:
+	if machine_instr.mnemonic not in REGISTER_FORM_MNEMONICS:
 		raise Exception(f'Invalid register instruction: {machine_instr}')
 	opcode = get_opcode_bits(machine_instr.mnemonic)
 	dest_reg = get_register_bits(machine_instr.dest_reg)
 	src_reg = get_register_bits(machine_instr.src_reg)
-	return opcode + dest_reg + src_reg
+	return (opcode << OPCODE_SHIFT) | (dest_reg << DEST_REG_SHIFT) | src_reg
 
-def encode_set_instruction(machine_instr: SetMachineInstr) -> str:
+def encode_set_instruction(machine_instr: SetMachineInstr) -> int:
 	if machine_instr.mnemonic != 'SET':
 		raise Exception(f'Invalid SET instruction: {machine_instr}')
 	opcode = get_opcode_bits(machine_instr.mnemonic)
-	flag = '0' if machine_instr.flag == False else '1'
-	imm = machine_instr.imm
-	if len(imm) != 4:
-		raise Exception(f'Invalid SET half immediate {imm} detected. Did you mean to zerofill the half immediate?')
-	return opcode + '0' + flag + imm
+	flag = 0 if machine_instr.flag == False else 1
+	imm = SET_NIBBLES.get(machine_instr.imm)
+	if imm is None:
+		raise Exception(f'Invalid SET half immediate {machine_instr.imm} detected. Did you mean to zerofill the half immediate?')
+	return (opcode << OPCODE_SHIFT) | (flag << SET_FLAG_SHIFT) | imm
 
-def encode_mem_instruction(machine_instr: MemMachineInstr) -> str:
+def encode_mem_instruction(machine_instr: MemMachineInstr) -> int:
 	if machine_instr.mnemonic != 'MEM':
 		raise Exception(f'Invalid MEM instruction: {machine_instr}')
 	opcode = get_opcode_bits(machine_instr.mnemonic)
-	is_load = '0' if machine_instr.is_load == True else '1'
+	is_store = 0 if machine_instr.is_load == True else 1
 	target_reg = get_register_bits(machine_instr.target_reg)
-	if machine_instr.target_location == RESERVED_REGISTER_NAME:
-		return opcode + target_reg + is_load + '00'
-	elif machine_instr.target_location == '200':
-		return opcode + target_reg + is_load + '01'
-	elif machine_instr.target_location == '201':
-		return opcode + target_reg + is_load + '10'	
-	else:
+	location = MEM_TARGET_LOCATION_BITS.get(machine_instr.target_location)
+	if location is None:
 		raise Exception(f'Invalid branch target location detected: {machine_instr.target_location}')
+	return (opcode << OPCODE_SHIFT) | (target_reg << DEST_REG_SHIFT) | (is_store << MEM_FLAG_SHIFT) | location
 
-def encode_brn_instruction(machine_instr: BrnMachineInstr) -> str:
+def encode_brn_instruction(machine_instr: BrnMachineInstr) -> int:
 	if machine_instr.mnemonic != 'BEQ':
 		raise Exception(f'Invalid BEQ instruction: {machine_instr}')
 	opcode = get_opcode_bits(machine_instr.mnemonic)
 	operand_reg1 = get_register_bits(machine_instr.operand_reg1)
 	operand_reg2 = get_register_bits(machine_instr.operand_reg2)
-	return opcode + operand_reg1 + operand_reg2
+	return (opcode << OPCODE_SHIFT) | (operand_reg1 << DEST_REG_SHIFT) | operand_reg2
+
+def encode_machine_instruction(machine_instr: MachineInstruction) -> int:
+	encoder = MACHINE_ENCODERS.get(type(machine_instr))
+	if encoder is None:
+		raise Exception(f'Invalid machine instruction: {machine_instr}')
+	return encoder(machine_instr)
+
+def encode_machine_instructions(machine_instructions: [MachineInstruction]) -> [int]:
+	for machine_instr in machine_instructions:
+		yield encode_machine_instruction(machine_instr)
+
+'''
+Vectorized encoding (NumPy)
+
+The instructions of each form are gathered into field arrays (opcode, register a, register b, flag, nibble)
+with one C level map per field, and the fields are combined with whole array shifts. Anything the field tables
+do not know makes the batch fall back to the one by one encoder, which reports it.
+'''
+
+def gather_field(machine_instructions: [MachineInstruction], name: str, bits: dict):
+	numpy = get_numpy()
+	return numpy.fromiter(map(bits.__getitem__, map(attrgetter(name), machine_instructions)), dtype=numpy.uint16, count=len(machine_instructions))
+
+def gather_flag(machine_instructions: [MachineInstruction], name: str):
+	numpy = get_numpy()
+	return numpy.fromiter(map(attrgetter(name), machine_instructions), dtype=bool, count=len(machine_instructions)).astype(numpy.uint16)
+
+def encode_register_fields(machine_instructions: [RegMachineInstr]):
+	opcodes = gather_field(machine_instructions, 'mnemonic', REGISTER_FORM_OPCODES)
+	dest_regs = gather_field(machine_instructions, 'dest_reg', REGISTER_BITS)
+	src_regs = gather_field(machine_instructions, 'src_reg', REGISTER_BITS)
+	return (opcodes << OPCODE_SHIFT) | (dest_regs << DEST_REG_SHIFT) | src_regs
+
+def encode_set_fields(machine_instructions: [SetMachineInstr]):
+	opcodes = gather_field(machine_instructions, 'mnemonic', {'SET': SET_OPCODE})
+	flags = gather_flag(machine_instructions, 'flag')
+	nibbles = gather_field(machine_instructions, 'imm', SET_NIBBLES)
+	return (opcodes << OPCODE_SHIFT) | (flags << SET_FLAG_SHIFT) | nibbles
+
+def encode_mem_fields(machine_instructions: [MemMachineInstr]):
+	opcodes = gather_field(machine_instructions, 'mnemonic', {'MEM': MEM_OPCODE})
+	target_regs = gather_field(machine_instructions, 'target_reg', REGISTER_BITS)
+	stores = 1 - gather_flag(machine_instructions, 'is_load')
+	locations = gather_field(machine_instructions, 'target_location', MEM_TARGET_LOCATION_BITS)
+	return (opcodes << OPCODE_SHIFT) | (target_regs << DEST_REG_SHIFT) | (stores << MEM_FLAG_SHIFT) | locations
+
+def encode_brn_fields(machine_instructions: [BrnMachineInstr]):
+	opcodes = gather_field(machine_instructions, 'mnemonic', {'BEQ': BEQ_OPCODE})
+	operand_regs1 = gather_field(machine_instructions, 'operand_reg1', REGISTER_BITS)
+	operand_regs2 = gather_field(machine_instructions, 'operand_reg2', REGISTER_BITS)
+	return (opcodes << OPCODE_SHIFT) | (operand_regs1 << DEST_REG_SHIFT) | operand_regs2
+
+def encode_machine_fields(machine_instructions: [MachineInstruction]):
+	numpy = get_numpy()
+	forms = list(MACHINE_FIELD_ENCODERS)
+	form_indices = {form: i for i, form in enumerate(forms)}
+	instruction_forms = numpy.fromiter(map(form_indices.__getitem__, map(type, machine_instructions)), dtype=numpy.uint8, count=len(machine_instructions))
+	words = numpy.zeros(len(machine_instructions), dtype=numpy.uint16)
+	for i, form in enumerate(forms):
+		addresses = numpy.flatnonzero(instruction_forms == i)
+		if len(addresses):
+			words[addresses] = MACHINE_FIELD_ENCODERS[form](list(map(machine_instructions.__getitem__, addresses.tolist())))
+	return words
+
+'''
+Encodes a list of machine instructions at once, into a NumPy uint16 array when the list is long and NumPy is
+installed, into a list otherwise
+'''
+def encode_machine_code(machine_instructions: [MachineInstruction]):
+	if len(machine_instructions) >= VECTORIZE_MIN_WORDS and get_numpy() is not None:
+		try:
+			return encode_machine_fields(machine_instructions)
+		except (KeyError, TypeError):
+			# the one by one encoder reports what is wrong
+			pass
+	return list(encode_machine_instructions(machine_instructions))
+
+'''
+Streaming version of encode_machine_code, WRITE_CHUNK_SIZE instructions at a time. encoded_words runs alongside
+the instructions with the words the expansions already hold, only the instructions whose word is None (branches
+and their preambles) are encoded. Without encoded_words every instruction is encoded.
+'''
+def encode_machine_code_chunks(machine_instructions: [MachineInstruction], encoded_words: [int] = None) -> [int]:
+	machine_instructions = iter(machine_instructions)
+	encoded_words = None if encoded_words is None else iter(encoded_words)
+	while True:
+		chunk = list(islice(machine_instructions, WRITE_CHUNK_SIZE))
+		if not chunk:
+			break
+		if encoded_words is None:
+			words = encode_machine_code(chunk)
+			yield from words if isinstance(words, list) else words.tolist()
+			continue
+		words = list(islice(encoded_words, len(chunk)))
+		missing = [addr for addr, word in enumerate(words) if word is None]
+		if missing:
+			encoded = encode_machine_code([chunk[addr] for addr in missing])
+			for addr, word in zip(missing, encoded if isinstance(encoded, list) else encoded.tolist()):
+				words[addr] = word
+		yield from words
+
+# ----------------------------------------------
+'''
+Instruction set specification
+
+Every programmer visible mnemonic is one InstructionSpec row: the operand shapes it accepts, how the
+RawInstruction becomes an IntermediateInstruction and how that is lowered into machine instructions.
+Every machine mnemonic is one MachineOpSpec row: its opcode and the machine instruction form it is encoded from.
+Both tables are compiled into dicts/frozensets below, adding an opcode only needs a new row.
+'''
+
+@dataclass(frozen=True)
+class InstructionSpec:
+	mnemonic: str
+	operand_shapes: tuple
+	build: object
+	lower: object
+	# immediates the lowering accepts, None when it takes any value
+	immediates: range = None
+
+@dataclass(frozen=True)
+class MachineOpSpec:
+	mnemonic: str
+	opcode: int
+	form: type
+
+REG_OR_IMM = ((REG, REG), (REG, IMM))
+IMM_ONLY = ((REG, IMM),)
+# an immediate is loaded into R7 with two SETs, SUB adds its negation which 0 does not have
+BYTE_IMMEDIATES = range(256)
+NEGATABLE_IMMEDIATES = range(1, 256)
+
+INSTRUCTION_SPECS = [
+	InstructionSpec('ADD', REG_OR_IMM, build_alu_intermediate, process_add_instr, BYTE_IMMEDIATES),
+	InstructionSpec('SUB', IMM_ONLY, build_alu_intermediate, process_sub_instr, NEGATABLE_IMMEDIATES),
+	InstructionSpec('AND', REG_OR_IMM, build_alu_intermediate, process_and_instr, BYTE_IMMEDIATES),
+	InstructionSpec('XOR', REG_OR_IMM, build_alu_intermediate, process_xor_instr, BYTE_IMMEDIATES),
+	InstructionSpec('ROL', REG_OR_IMM, build_alu_intermediate, process_rol_instr, BYTE_IMMEDIATES),
+	InstructionSpec('ROR', IMM_ONLY, build_alu_intermediate, process_ror_instr),
+	InstructionSpec('LSL', IMM_ONLY, build_alu_intermediate, process_lsl_instr),
+	InstructionSpec('LSR', IMM_ONLY, build_alu_intermediate, process_lsr_instr),
+	InstructionSpec('MOV', REG_OR_IMM, build_alu_intermediate, process_mov_instr, BYTE_IMMEDIATES),
+	InstructionSpec('ZER', ((REG,),), build_alu_intermediate, process_zer_instr),
+	InstructionSpec('LDR', REG_OR_IMM, build_memory_intermediate, process_mem_instruction, BYTE_IMMEDIATES),
+	InstructionSpec('STR', REG_OR_IMM, build_memory_intermediate, process_mem_instruction, BYTE_IMMEDIATES),
+	InstructionSpec('BEQ', ((REG, REG, TAG),), build_branch_intermediate, process_beq_instr),
+]
+
+MACHINE_OP_SPECS = [
+	MachineOpSpec('MEM', MEM_OPCODE, MemMachineInstr),
+	MachineOpSpec('ADD', ADD_OPCODE, RegMachineInstr),
+	MachineOpSpec('AND', AND_OPCODE, RegMachineInstr),
+	MachineOpSpec('XOR', XOR_OPCODE, RegMachineInstr),
+	MachineOpSpec('ROL', ROL_OPCODE, RegMachineInstr),
+	MachineOpSpec('BEQ', BEQ_OPCODE, BrnMachineInstr),
+	MachineOpSpec('SET', SET_OPCODE, SetMachineInstr),
+	MachineOpSpec('MOV', MOV_OPCODE, RegMachineInstr),
+]
+
+MACHINE_ENCODERS = {
+	RegMachineInstr: encode_register_instruction,
+	SetMachineInstr: encode_set_instruction,
+	MemMachineInstr: encode_mem_instruction,
+	BrnMachineInstr: encode_brn_instruction,
+}
+
+MACHINE_FIELD_ENCODERS = {
+	RegMachineInstr: encode_register_fields,
+	SetMachineInstr: encode_set_fields,
+	MemMachineInstr: encode_mem_fields,
+	BrnMachineInstr: encode_brn_fields,
+}
+
+INSTRUCTION_TABLE = {spec.mnemonic: spec for spec in INSTRUCTION_SPECS}
+VALID_OPERAND_SHAPES = {spec.mnemonic: frozenset(spec.operand_shapes) for spec in INSTRUCTION_SPECS}
+VALID_IMMEDIATES = {spec.mnemonic: spec.immediates for spec in INSTRUCTION_SPECS}
+TAG_OPERAND_POSITIONS = {spec.mnemonic: frozenset(position for shapes in spec.operand_shapes for position, shape in enumerate(shapes) if shape == TAG) for spec in INSTRUCTION_SPECS}
+OPCODES = {spec.mnemonic: spec.opcode for spec in MACHINE_OP_SPECS}
+REGISTER_FORM_MNEMONICS = frozenset(spec.mnemonic for spec in MACHINE_OP_SPECS if spec.form is RegMachineInstr)
+REGISTER_FORM_OPCODES = {spec.mnemonic: spec.opcode for spec in MACHINE_OP_SPECS if spec.form is RegMachineInstr}
+# the 4 bit strings a SET carries, by string
+SET_NIBBLES = {format(nibble, '04b'): nibble for nibble in range(16)}
+
+# ----------------------------------------------
+'''
+Source lines are context free except for branches, so the lowered and encoded form of every other line
+is cached by its text. The branch preamble depends on where the branch ends up, so BEQ lines are always
+expanded again and their words are filled in by encode_branch_fixups once the tags are resolved.
+'''
+
+@dataclass(frozen=True)
+class LineExpansion:
+	machine_instructions: tuple
+	# one entry per non-tag machine instruction, None for words that still need a branch fixup
+	encoded_words: tuple
+
+class ExpansionCache:
+	def __init__(self, maxsize: int = EXPANSION_CACHE_SIZE):
+		self.maxsize = maxsize
+		self.entries = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, line: str) -> LineExpansion:
+		expansion = self.entries.get(line)
+		if expansion is None:
+			self.misses += 1
+		else:
+			self.hits += 1
+			self.entries.move_to_end(line)
+		return expansion
+
+	def put(self, line: str, expansion: LineExpansion):
+		if self.maxsize <= 0:
+			return
+		self.entries[line] = expansion
+		if len(self.entries) > self.maxsize:
+			self.entries.popitem(last=False)
+
+'''
+Lowers one line produced by lex_source_lines, its tokens are separated by single spaces
+'''
+def expand_source_line(line: str, profiler: Profiler = DISABLED_PROFILER) -> LineExpansion:
+	source_artifacts = profiler.iterate('parse', [get_source_artifact(line.split(' '))])
+	intermediate_instructions = profiler.iterate('intermediate', process_source_artifacts(source_artifacts))
+	machine_instructions = tuple(profiler.iterate('lower', process_intermediate_instructions(intermediate_instructions)))
+	words = [machine_instr for machine_instr in machine_instructions if not isinstance(machine_instr, TagMachineInstruction)]
+	if any(isinstance(machine_instr, BrnMachineInstr) for machine_instr in words):
+		encoded_words = (None,) * len(words)
+	else:
+		encoded_words = tuple(profiler.iterate('encode lines', encode_machine_instructions(words)))
+	return LineExpansion(machine_instructions=machine_instructions, encoded_words=encoded_words)
+
+def expand_source_lines(cleaned_lines: [str], cache: ExpansionCache, profiler: Profiler = DISABLED_PROFILER) -> [LineExpansion]:
+	for line in cleaned_lines:
+		expansion = cache.get(line)
+		if expansion is None:
+			expansion = expand_source_line(line, profiler)
+			if None not in expansion.encoded_words:
+				cache.put(line, expansion)
+		if profiler.enabled and not line.startswith('@'):
+			profiler.count_expansion(line.split(None, 1)[0].upper(), len(expansion.encoded_words))
+		yield expansion
+
+'''
+Returns the machine instructions (tags included) along with the encoded words (tags excluded).
+When line_lengths is given, the number of machine instructions of every source line is appended to it.
+'''
+def assemble_source_lines(cleaned_lines: [str], cache: ExpansionCache, profiler: Profiler = DISABLED_PROFILER, line_lengths: [int] = None) -> ([MachineInstruction], [int]):
+	machine_instructions = []
+	encoded_machine_instructions = []
+	for expansion in expand_source_lines(cleaned_lines, cache, profiler):
+		machine_instructions += expansion.machine_instructions
+		encoded_machine_instructions += expansion.encoded_words
+		if line_lengths is not None:
+			line_lengths.append(len(expansion.machine_instructions))
+	return machine_instructions, encoded_machine_instructions
+
+def encode_branch_fixups(machine_instructions: [MachineInstruction], encoded_machine_instructions: [int], symbol_table: SymbolTable) -> [int]:
+	for fixup in symbol_table.fixups:
+		for addr in fixup.preamble + (fixup.address,):
+			if addr is None:
+				continue
+			encoded_machine_instructions[addr] = encode_machine_instruction(machine_instructions[addr])
+	return encoded_machine_instructions
+
+# ----------------------------------------------
+'''
+Decoding
+
+Every one of the 512 possible words is decoded once into its lowered form, the disassembler and the
+incremental cache rebuild instructions from their words with one table lookup.
+'''
+
+REGISTER_NAMES = {bits: reg for reg, bits in REGISTER_BITS.items()}
+MNEMONICS = {opcode: mnemonic for mnemonic, opcode in OPCODES.items()}
+MEM_TARGET_LOCATIONS = {bits: location for location, bits in MEM_TARGET_LOCATION_BITS.items()}
+# bit 5 of a SET word, the assembler never sets it
+SET_UNUSED_BIT = 1 << 5
+
+def decode_machine_word(word: int) -> MachineInstruction:
+	mnemonic = MNEMONICS[word >> OPCODE_SHIFT]
+	reg_a = REGISTER_NAMES[(word >> DEST_REG_SHIFT) & 0b111]
+	reg_b = REGISTER_NAMES[word & 0b111]
+	if mnemonic == 'MEM':
+		location = MEM_TARGET_LOCATIONS.get(word & 0b11)
+		if location is None:
+			return None
+		return MemMachineInstr(mnemonic='MEM', is_load=not (word >> MEM_FLAG_SHIFT) & 1, target_reg=reg_a, target_location=location)
+	elif mnemonic == 'SET':
+		if word & SET_UNUSED_BIT:
+			return None
+		return SetMachineInstr(mnemonic='SET', flag=bool((word >> SET_FLAG_SHIFT) & 1), imm=format(word & 0x0F, '04b'))
+	elif mnemonic == 'BEQ':
+		return BrnMachineInstr(mnemonic='BEQ', operand_reg1=reg_a, operand_reg2=reg_b, tagname=None)
+	return RegMachineInstr(mnemonic=mnemonic, dest_reg=reg_a, src_reg=reg_b)
+
+# lowered instruction of every possible 9 bit word, None for words the assembler never emits.
+# The entries are shared, branches are copied before their target is filled in.
+DISASSEMBLY_TABLE = [decode_machine_word(word) for word in range(1 << WORD_BITS)]
+
+
+# ----------------------------------------------
+'''
+Incremental assembly
+
+The source is split into regions that start at a tag. The lowered form of each region only depends on
+its own lines, so it is stored on disk keyed by a hash of those lines. On a rebuild only the regions
+that changed are lowered again, the tag addresses and branch fixups are always recomputed afterwards.
+
+The regions of a source live in a single file that is read once and rewritten once per build with only
+the regions of that build, so regions that were edited away do not pile up. Instructions are stored as
+their word and rebuilt from DISASSEMBLY_TABLE, only tags and branches with their unresolved preamble
+keep their fields.
+'''
+
+MACHINE_INSTRUCTION_FORMS = {form.__name__: form for form in (RegMachineInstr, SetMachineInstr, MemMachineInstr, BrnMachineInstr, TagMachineInstruction)}
+
+def split_tag_regions(cleaned_lines: [str]) -> [[str]]:
+	region = []
+	for line in cleaned_lines:
+		if line.startswith('@') and region:
+			yield region
+			region = []
+		region.append(line)
+	if region:
+		yield region
+
+def get_region_key(region: [str]) -> str:
+	content = f'{REGION_CACHE_VERSION}\n' + '\n'.join(region)
+	return hashlib.sha256(content.encode()).hexdigest()
+
+def pack_machine_instructions(machine_instructions: [MachineInstruction], encoded_words: [int]) -> list:
+	packed = []
+	words = iter(encoded_words)
+	for machine_instr in machine_instructions:
+		word = None if isinstance(machine_instr, TagMachineInstruction) else next(words)
+		# the encoder tables are one to one, so an encoded word decodes back to an equal instruction
+		if word is not None:
+			packed.append(word)
+		else:
+			packed.append([type(machine_instr).__name__, *vars(machine_instr).values()])
+	return packed
+
+def unpack_machine_instructions(packed: list) -> [MachineInstruction]:
+	return [DISASSEMBLY_TABLE[item] if isinstance(item, int) else MACHINE_INSTRUCTION_FORMS[item[0]](*item[1:]) for item in packed]
+
+'''
+Holds the lowered regions of one source at a time. open_source reads the regions of its last build, save
+writes back the regions that were loaded or stored since then and removes the files of the least recently
+built sources beyond max_sources.
+'''
+class RegionCache:
+	def __init__(self, cache_dir: str = REGION_CACHE_DIR, max_sources: int = REGION_CACHE_SOURCES):
+		self.cache_dir = cache_dir
+		self.max_sources = max_sources
+		self.hits = 0
+		self.misses = 0
+		self.source_file = None
+		self.regions = dict()
+		self.used = dict()
+		os.makedirs(cache_dir, exist_ok=True)
+
+	def get_path(self, source_file: str) -> str:
+		name = hashlib.sha256(os.path.abspath(source_file).encode()).hexdigest()
+		return os.path.join(self.cache_dir, name + REGION_CACHE_EXTENSION)
+
+	def open_source(self, source_file: str):
+		self.source_file = source_file
+		self.used = dict()
+		try:
+			with open(self.get_path(source_file)) as f:
+				content = json.load(f)
+		except (OSError, ValueError):
+			content = None
+		if isinstance(content, dict) and content.get('version') == REGION_CACHE_VERSION:
+			self.regions = content['regions']
+		else:
+			self.regions = dict()
+
+	def load(self, key: str) -> ([MachineInstruction], [int], [int]):
+		entry = self.regions.get(key)
+		if entry is None:
+			self.misses += 1
+			return None
+		self.hits += 1
+		self.used[key] = entry
+		return unpack_machine_instructions(entry['machine_instructions']), entry['encoded_words'], entry['line_lengths']
+
+	def store(self, key: str, machine_instructions: [MachineInstruction], encoded_words: [int], line_lengths: [int]):
+		self.used[key] = {
+			'machine_instructions': pack_machine_instructions(machine_instructions, encoded_words),
+			'encoded_words': encoded_words,
+			'line_lengths': line_lengths,
+		}
+
+	def save(self):
+		if self.source_file is None:
+			return
+		path = self.get_path(self.source_file)
+		if self.used.keys() == self.regions.keys() and os.path.exists(path):
+			# nothing was lowered or dropped, only mark the source as recently built
+			os.utime(path)
+		else:
+			# write to a temporary file first so an interrupted run never leaves a truncated file behind
+			with open(path + '.tmp', 'w') as f:
+				f.write(json.dumps({'version': REGION_CACHE_VERSION, 'regions': self.used}))
+			os.replace(path + '.tmp', path)
+		self.regions = self.used
+		self.evict()
+
+	def evict(self):
+		paths = [entry.path for entry in os.scandir(self.cache_dir) if entry.name.endswith(REGION_CACHE_EXTENSION)]
+		if len(paths) <= self.max_sources:
+			return
+		paths.sort(key=os.path.getmtime)
+		for path in paths[:len(paths) - self.max_sources]:
+			try:
+				os.remove(path)
+			except OSError:
+				pass
+
+def assemble_source_regions(cleaned_lines: [str], cache: ExpansionCache, region_cache: RegionCache, profiler: Profiler = DISABLED_PROFILER, line_lengths: [int] = None) -> ([MachineInstruction], [int]):
+	machine_instructions = []
+	encoded_machine_instructions = []
+	for region in split_tag_regions(cleaned_lines):
+		key = get_region_key(region)
+		lowered = region_cache.load(key)
+		if lowered is None:
+			region_line_lengths = []
+			lowered = assemble_source_lines(region, cache, profiler, region_line_lengths) + (region_line_lengths,)
+			region_cache.store(key, *lowered)
+		machine_instructions += lowered[0]
+		encoded_machine_instructions += lowered[1]
+		if line_lengths is not None:
+			line_lengths += lowered[2]
+	region_cache.save()
+	return machine_instructions, encoded_machine_instructions
+
+# ----------------------------------------------
+'''
+Compact IR (--compact)
+
+The program is held as columns of small ints (struct of arrays) instead of one dataclass per word: opcode,
+register a, register b, flag and nibble, plus the index of the branch fixup for BEQ words. Each distinct
+source line is still lowered once through the machine instruction objects, the cache keeps its rows and
+the columns are extended from them. Branch offsets are patched in the nibble column and the words are
+encoded straight from the columns.
+
+	register/BEQ: reg_a = dest/operand 1, reg_b = src/operand 2
+	SET:          flag, nibble
+	MEM:          reg_a = target register, flag = store, reg_b = location
+'''
+
+# position of the flag bit by opcode, only SET and MEM words carry one
+COMPACT_FLAG_SHIFTS = [0] * (1 << (WORD_BITS - OPCODE_SHIFT))
+COMPACT_FLAG_SHIFTS[SET_OPCODE] = SET_FLAG_SHIFT
+COMPACT_FLAG_SHIFTS[MEM_OPCODE] = MEM_FLAG_SHIFT
+# fixup column value of the words that are not a branch
+NO_FIXUP = -1
+# preamble slots that receive the offset nibbles, in get_branch_offset_nibbles order
+PREAMBLE_NIBBLE_SLOTS = (0, 2, 3)
+
+@dataclass(frozen=True)
+class CompactLine:
+	# the line's values for the opcode, reg_a, reg_b, flag, nibble and fixup columns
+	columns: tuple
+	# set for tag lines, which have no rows
+	tagname: str = None
+	# set for BEQ lines, the branch is the last row
+	branch_tagname: str = None
+
+class CompactProgram:
+	__slots__ = ('opcodes', 'reg_a', 'reg_b', 'flags', 'nibbles', 'fixups', 'symbol_table')
+
+	def __init__(self):
+		self.opcodes = array('B')
+		self.reg_a = array('B')
+		self.reg_b = array('B')
+		self.flags = array('B')
+		self.nibbles = array('B')
+		self.fixups = array('i')
+		self.symbol_table = SymbolTable(tags=dict(), fixups=[])
+
+	def __len__(self) -> int:
+		return len(self.opcodes)
+
+	def append_line(self, compact_line: CompactLine):
+		if compact_line.tagname is not None:
+			self.symbol_table.tags[compact_line.tagname] = len(self)
+			return
+		opcodes, reg_a, reg_b, flags, nibbles, fixups = compact_line.columns
+		self.opcodes.extend(opcodes)
+		self.reg_a.extend(reg_a)
+		self.reg_b.extend(reg_b)
+		self.flags.extend(flags)
+		self.nibbles.extend(nibbles)
+		self.fixups.extend(fixups)
+		if compact_line.branch_tagname is not None:
+			address = len(self) - 1
+			self.fixups[address] = len(self.symbol_table.fixups)
+			self.symbol_table.fixups.append(BranchFixup(tagname=compact_line.branch_tagname, address=address, preamble=tuple(range(address - BRANCH_PREAMBLE_LENGTH, address))))
+
+def split_machine_word(word: int) -> (int, int, int, int, int):
+	opcode = word >> OPCODE_SHIFT
+	if opcode == SET_OPCODE:
+		return opcode, 0, 0, (word >> SET_FLAG_SHIFT) & 1, word & 0b1111
+	elif opcode == MEM_OPCODE:
+		return opcode, (word >> DEST_REG_SHIFT) & 0b111, word & 0b11, (word >> MEM_FLAG_SHIFT) & 1, 0
+	return opcode, (word >> DEST_REG_SHIFT) & 0b111, word & 0b111, 0, 0
+
+def get_compact_row(machine_instr: MachineInstruction) -> (int, int, int, int, int):
+	# the empty SETs of a branch preamble are filled in once the tags are resolved
+	if isinstance(machine_instr, SetMachineInstr) and machine_instr.imm is None:
+		return SET_OPCODE, 0, 0, int(machine_instr.flag), 0
+	return split_machine_word(encode_machine_instruction(machine_instr))
+
+def get_compact_line(line: str, cache: ExpansionCache) -> CompactLine:
+	compact_line = cache.get(line)
+	if compact_line is None:
+		machine_instructions = expand_source_line(line).machine_instructions
+		if len(machine_instructions) == 1 and isinstance(machine_instructions[0], TagMachineInstruction):
+			compact_line = CompactLine(columns=(), tagname=machine_instructions[0].tagname)
+		else:
+			branch_tagname = machine_instructions[-1].tagname if isinstance(machine_instructions[-1], BrnMachineInstr) else None
+			rows = [get_compact_row(machine_instr) + (NO_FIXUP,) for machine_instr in machine_instructions]
+			compact_line = CompactLine(columns=tuple(zip(*rows)), branch_tagname=branch_tagname)
+		cache.put(line, compact_line)
+	return compact_line
+
+'''
+Lowers the program into a CompactProgram, the cache holds CompactLine entries in this mode
+'''
+def lower_compact_program(cleaned_lines: [str], cache: ExpansionCache) -> CompactProgram:
+	program = CompactProgram()
+	for line in cleaned_lines:
+		program.append_line(get_compact_line(line, cache))
+	return program
+
+def resolve_compact_branches(program: CompactProgram):
+	symbol_table = program.symbol_table
+	for fixup in symbol_table.fixups:
+		if fixup.tagname not in symbol_table.tags:
+			raise Exception(f'Invalid tag: {fixup.tagname}')
+		nibbles = get_branch_offset_nibbles(symbol_table.tags[fixup.tagname] - fixup.address)
+		for slot, nibble in zip(PREAMBLE_NIBBLE_SLOTS, nibbles):
+			program.nibbles[fixup.preamble[slot]] = int(nibble, 2)
+
+def encode_compact_program(program: CompactProgram) -> array:
+	if len(program) >= VECTORIZE_MIN_WORDS and get_numpy() is not None:
+		return encode_compact_columns(program)
+	flag_shifts = COMPACT_FLAG_SHIFTS
+	columns = zip(program.opcodes, program.reg_a, program.reg_b, program.flags, program.nibbles)
+	return array('H', ((opcode << OPCODE_SHIFT) | (reg_a << DEST_REG_SHIFT) | reg_b | (flag << flag_shifts[opcode]) | nibble for (opcode, reg_a, reg_b, flag, nibble) in columns))
+
+# the same as encode_compact_program with NumPy, one shift and or per column over the whole program
+def encode_compact_columns(program: CompactProgram):
+	numpy = get_numpy()
+	opcodes, reg_a, reg_b, flags, nibbles = (numpy.frombuffer(column, dtype=numpy.uint8).astype(numpy.uint16) for column in (program.opcodes, program.reg_a, program.reg_b, program.flags, program.nibbles))
+	flag_shifts = numpy.array(COMPACT_FLAG_SHIFTS, dtype=numpy.uint16)[opcodes]
+	return (opcodes << OPCODE_SHIFT) | (reg_a << DEST_REG_SHIFT) | reg_b | (flags << flag_shifts) | nibbles
+
+def assemble_compact_program(cleaned_lines: [str], cache: ExpansionCache, profiler: Profiler = DISABLED_PROFILER) -> array:
+	with profiler.stage('lower'):
+		program = lower_compact_program(cleaned_lines, cache)
+	profiler.add_items('lower', len(program))
+	with profiler.stage('branches'):
+		resolve_compact_branches(program)
+	profiler.add_items('branches', len(program.symbol_table.fixups))
+	with profiler.stage('encode'):
+		return encode_compact_program(program)
+
+# ----------------------------------------------
+'''
+Optimization passes (opt-in with -O <pass>)
+
+They run on the lowered machine instructions before tag resolution, so every address they
+change is still free to move.
+'''
+
+def writes_reserved_register(machine_instr: MachineInstruction) -> bool:
+	if isinstance(machine_instr, RegMachineInstr):
+		return machine_instr.dest_reg == RESERVED_REGISTER_NAME
+	elif isinstance(machine_instr, MemMachineInstr):
+		return machine_instr.is_load and machine_instr.target_reg == RESERVED_REGISTER_NAME
+	return False
+
+'''
+Tracks the known nibbles of R7 inside each basic block and drops the SETs that would not change them.
+Tags and branches end a block. The empty SETs of a branch preamble are never dropped, their value is
+only known once the tags are resolved.
+'''
+def eliminate_redundant_sets(machine_instructions: [MachineInstruction]) -> [MachineInstruction]:
+	# SET flag False writes the upper nibble, flag True the lower one
+	known_nibbles = {False: None, True: None}
+	for machine_instr in machine_instructions:
+		if isinstance(machine_instr, SetMachineInstr):
+			if machine_instr.imm is not None and known_nibbles[machine_instr.flag] == machine_instr.imm:
+				continue
+			known_nibbles[machine_instr.flag] = machine_instr.imm
+		elif isinstance(machine_instr, (TagMachineInstruction, BrnMachineInstr)) or writes_reserved_register(machine_instr):
+			known_nibbles[False] = None
+			known_nibbles[True] = None
+		yield machine_instr
+
+# preamble slots written by each data memory store, see process_beq_instr
+PREAMBLE_MEM_200_SLOTS = (0, 1)
+PREAMBLE_MEM_201_SLOTS = (2, 3, 4)
+
+'''
+Returns the symbol table of the program once the given preamble slots, (fixup index, slot) pairs, are removed
+'''
+def relocate_symbol_table(symbol_table: SymbolTable, instruction_count: int, dropped: set) -> SymbolTable:
+	dropped_addresses = set()
+	for (i, slot) in dropped:
+		dropped_addresses.add(symbol_table.fixups[i].preamble[slot])
+	# new_address[addr] is the number of kept instructions in front of addr
+	new_address = []
+	kept = 0
+	for addr in range(instruction_count + 1):
+		new_address.append(kept)
+		if addr not in dropped_addresses:
+			kept += 1
+	tags = {tagname: new_address[addr] for tagname, addr in symbol_table.tags.items()}
+	fixups = []
+	for fixup in symbol_table.fixups:
+		preamble = tuple(None if addr is None or addr in dropped_addresses else new_address[addr] for addr in fixup.preamble)
+		fixups.append(BranchFixup(tagname=fixup.tagname, address=new_address[fixup.address], preamble=preamble))
+	return SymbolTable(tags=tags, fixups=fixups)
+
+'''
+Walks the straight-line code and returns the preamble slots that would store a value data_mem[200]/[201]
+already holds. Tags clear what is known, and so does any store through an R7 that could point at 200/201.
+'''
+def find_redundant_preamble_slots(machine_instructions: [MachineInstruction], symbol_table: SymbolTable, relocated: SymbolTable) -> set:
+	tag_addresses = set(symbol_table.tags.values())
+	fixup_by_address = {fixup.address: i for i, fixup in enumerate(symbol_table.fixups)}
+	preamble_addresses = set(addr for fixup in symbol_table.fixups for addr in fixup.preamble if addr is not None)
+	redundant = set()
+	mem_200 = None
+	mem_201 = None
+	r7 = {False: None, True: None}
+	for addr, machine_instr in enumerate(machine_instructions):
+		if addr in tag_addresses:
+			mem_200 = mem_201 = None
+			r7[False] = r7[True] = None
+		if addr in fixup_by_address:
+			i = fixup_by_address[addr]
+			fixup = relocated.fixups[i]
+			lower_right_imm, upper_left_imm, upper_right_imm = get_branch_offset_nibbles(relocated.tags[fixup.tagname] - fixup.address)
+			if mem_200 == lower_right_imm:
+				redundant.update((i, slot) for slot in PREAMBLE_MEM_200_SLOTS)
+			else:
+				r7[True] = mem_200 = lower_right_imm
+			if mem_201 == upper_left_imm + upper_right_imm:
+				redundant.update((i, slot) for slot in PREAMBLE_MEM_201_SLOTS)
+			else:
+				r7[False], r7[True] = upper_left_imm, upper_right_imm
+				mem_201 = upper_left_imm + upper_right_imm
+		elif addr in preamble_addresses:
+			continue
+		elif isinstance(machine_instr, SetMachineInstr):
+			r7[machine_instr.flag] = machine_instr.imm
+		elif writes_reserved_register(machine_instr):
+			r7[False] = r7[True] = None
+		elif isinstance(machine_instr, MemMachineInstr) and not machine_instr.is_load:
+			if r7[False] is None or r7[True] is None or int(r7[False] + r7[True], 2) in (200, 201):
+				mem_200 = mem_201 = None
+	return redundant
+
+'''
+Runs after tag_branch_instructions and drops the preamble stores (with their SETs) that rewrite the offset
+nibbles the previous branch already left in data_mem[200]/[201]. Dropping words moves the tags, which
+changes the offsets, so the layout is recomputed until it is stable. A slot that turns out to be needed
+after a relayout is kept from then on, which guarantees termination.
+'''
+def deduplicate_branch_preambles(machine_instructions: [MachineInstruction], symbol_table: SymbolTable) -> ([MachineInstruction], SymbolTable):
+	dropped = set()
+	pinned = set()
+	while True:
+		relocated = relocate_symbol_table(symbol_table, len(machine_instructions), dropped)
+		redundant = find_redundant_preamble_slots(machine_instructions, symbol_table, relocated)
+		pinned |= dropped - redundant
+		next_dropped = redundant - pinned
+		if next_dropped == dropped:
+			break
+		dropped = next_dropped
+	dropped_addresses = set(symbol_table.fixups[i].preamble[slot] for (i, slot) in dropped)
+	machine_instructions = [machine_instr for addr, machine_instr in enumerate(machine_instructions) if addr not in dropped_addresses]
+	return tag_branch_instructions(machine_instructions, relocated), relocated
+
+# ----------------------------------------------
+'''
+Peephole pass (opt-in with -O peephole)
+
+Runs on the preprocessed source lines in front of the lexer. Every ALU line is built into its
+IntermediateInstruction, adjacent ones on the same register are folded and the ones that leave it
+unchanged are deleted:
+
+	ROL R1, #3 / ROR R1, #1			->	ROL R1, #2
+	LSL R1, #2 / LSR R1, #2			->	AND R1, #63
+	MOV R1, #4 / ADD R1, #1			->	MOV R1, #5
+	ADD R1, R2 / ZER R1				->	ZER R1
+	ADD R1, #0, MOV R1, R1, ROR R1, #8	->	nothing
+
+Registers hold 8 bits. R7 is the scratch register of the immediate forms, its value after one of them is not
+kept, and instructions that name R7 are left alone. Tags, branches and memory accesses end the window, so no
+fold crosses a tag. The rewritten instructions are passed on as canonical source lines, so the expansion
+cache and every later stage work as before. Immediates the lowering would reject are never folded, the
+error is still reported for them.
+'''
+
+# the instructions the pass folds, everything else ends the window
+PEEPHOLE_MNEMONICS = frozenset(['ADD', 'SUB', 'AND', 'XOR', 'ROL', 'ROR', 'LSL', 'LSR', 'MOV', 'ZER'])
+# foldable instructions held back at once, the oldest one is passed on when the window is full
+PEEPHOLE_WINDOW_SIZE = 16
+BYTE_MASK = 0xFF
+
+def rotate_left(value: int, amount: int) -> int:
+	amount %= 8
+	return ((value << amount) | (value >> (8 - amount))) & BYTE_MASK
+
+# value of the register after <mnemonic> Rd, #imm
+IMMEDIATE_OPERATIONS = {
+	'ADD': lambda value, imm: (value + imm) & BYTE_MASK,
+	'SUB': lambda value, imm: (value - imm) & BYTE_MASK,
+	'AND': lambda value, imm: value & imm,
+	'XOR': lambda value, imm: value ^ imm,
+	'ROL': rotate_left,
+	'ROR': lambda value, imm: rotate_left(value, -imm),
+	'LSL': lambda value, imm: (value << imm) & BYTE_MASK,
+	'LSR': lambda value, imm: value >> imm,
+	'MOV': lambda value, imm: imm,
+}
+ADDITIVE_SIGNS = {'ADD': 1, 'SUB': -1}
+ROTATION_SIGNS = {'ROL': 1, 'ROR': -1}
+
+'''
+Returns the immediate of an immediate instruction as an int, None for the register forms and for the
+immediates the lowering would reject
+'''
+def get_foldable_immediate(intermediate_instr: IntermediateInstruction) -> int:
+	if not isinstance(intermediate_instr, ImmediateIntermediateInstruction):
+		return None
+	imm = int(intermediate_instr.imm)
+	if intermediate_instr.mnemonic in ('LSL', 'LSR', 'ROR'):
+		return imm
+	if intermediate_instr.mnemonic == 'SUB':
+		return imm if 0 < imm <= BYTE_MASK else None
+	return imm if imm <= BYTE_MASK else None
+
+def is_identity_instruction(intermediate_instr: IntermediateInstruction) -> bool:
+	if isinstance(intermediate_instr, RegisterIntermediateInstruction):
+		return intermediate_instr.mnemonic == 'MOV' and intermediate_instr.src_reg == intermediate_instr.dest_reg
+	imm = get_foldable_immediate(intermediate_instr)
+	if imm is None:
+		return False
+	if intermediate_instr.mnemonic in ('ADD', 'SUB', 'XOR'):
+		return imm == 0
+	if intermediate_instr.mnemonic == 'AND':
+		return imm == BYTE_MASK
+	if intermediate_instr.mnemonic in ROTATION_SIGNS:
+		return imm % 8 == 0
+	if intermediate_instr.mnemonic in ('LSL', 'LSR'):
+		return imm == 0
+	return False
+
+# the register gets a new value that does not depend on the old one
+def overwrites_register(intermediate_instr: IntermediateInstruction) -> bool:
+	if intermediate_instr.mnemonic == 'ZER':
+		return True
+	if intermediate_instr.mnemonic != 'MOV':
+		return False
+	return isinstance(intermediate_instr, ImmediateIntermediateInstruction) or intermediate_instr.src_reg != intermediate_instr.dest_reg
+
+def get_constant(intermediate_instr: IntermediateInstruction) -> int:
+	if intermediate_instr.mnemonic == 'ZER':
+		return 0
+	if intermediate_instr.mnemonic == 'MOV':
+		return get_foldable_immediate(intermediate_instr)
+	return None
+
+def build_immediate_instruction(mnemonic: str, dest_reg: str, imm: int) -> [IntermediateInstruction]:
+	if mnemonic == 'MOV' and imm == 0:
+		return [RegisterIntermediateInstruction(mnemonic='ZER', dest_reg=dest_reg, src_reg=None)]
+	if mnemonic in ('LSL', 'LSR') and imm >= 8:
+		return [RegisterIntermediateInstruction(mnemonic='ZER', dest_reg=dest_reg, src_reg=None)]
+	intermediate_instr = ImmediateIntermediateInstruction(mnemonic=mnemonic, dest_reg=dest_reg, imm=str(imm))
+	return [] if is_identity_instruction(intermediate_instr) else [intermediate_instr]
+
+'''
+Returns what replaces first followed by second, both on the same register, or None when they do not fold
+'''
+def fold_intermediate_pair(first: IntermediateInstruction, second: IntermediateInstruction) -> [IntermediateInstruction]:
+	dest_reg = second.dest_reg
+	if overwrites_register(second):
+		return [second]
+	b = get_foldable_immediate(second)
+	if b is None:
+		return None
+	value = get_constant(first)
+	if value is not None:
+		return build_immediate_instruction('MOV', dest_reg, IMMEDIATE_OPERATIONS[second.mnemonic](value, b))
+	a = get_foldable_immediate(first)
+	if a is None:
+		return None
+	mnemonics = (first.mnemonic, second.mnemonic)
+	if first.mnemonic in ADDITIVE_SIGNS and second.mnemonic in ADDITIVE_SIGNS:
+		return build_immediate_instruction('ADD', dest_reg, (ADDITIVE_SIGNS[first.mnemonic] * a + ADDITIVE_SIGNS[second.mnemonic] * b) & BYTE_MASK)
+	if first.mnemonic in ROTATION_SIGNS and second.mnemonic in ROTATION_SIGNS:
+		return build_immediate_instruction('ROL', dest_reg, (ROTATION_SIGNS[first.mnemonic] * a + ROTATION_SIGNS[second.mnemonic] * b) % 8)
+	if mnemonics == ('AND', 'AND'):
+		return build_immediate_instruction('AND', dest_reg, a & b)
+	if mnemonics == ('XOR', 'XOR'):
+		return build_immediate_instruction('XOR', dest_reg, a ^ b)
+	if mnemonics in (('LSL', 'LSL'), ('LSR', 'LSR')):
+		return build_immediate_instruction(first.mnemonic, dest_reg, a + b)
+	if mnemonics == ('LSL', 'LSR') and a == b:
+		return build_immediate_instruction('AND', dest_reg, BYTE_MASK >> a)
+	if mnemonics == ('LSR', 'LSL') and a == b:
+		return build_immediate_instruction('AND', dest_reg, (BYTE_MASK << a) & BYTE_MASK)
+	return None
+
+# words the lowering emits for a foldable instruction, see the process_*_instr functions
+def get_lowered_length(intermediate_instr: IntermediateInstruction) -> int:
+	if not isinstance(intermediate_instr, ImmediateIntermediateInstruction):
+		return 1
+	if intermediate_instr.mnemonic in ('LSL', 'LSR'):
+		return 1 if int(intermediate_instr.imm) >= 8 else 6
+	return 3
+
+def format_intermediate_instruction(intermediate_instr: IntermediateInstruction) -> str:
+	if isinstance(intermediate_instr, ImmediateIntermediateInstruction):
+		return f'{intermediate_instr.mnemonic} {intermediate_instr.dest_reg} #{intermediate_instr.imm}'
+	if intermediate_instr.src_reg is None:
+		return f'{intermediate_instr.mnemonic} {intermediate_instr.dest_reg}'
+	return f'{intermediate_instr.mnemonic} {intermediate_instr.dest_reg} {intermediate_instr.src_reg}'
+
+'''
+Returns the intermediate instruction of the lexed tokens when the pass may fold it, None otherwise
+'''
+def get_foldable_instruction(tokens: (str, ...)) -> IntermediateInstruction:
+	if tokens[0] not in PEEPHOLE_MNEMONICS or RESERVED_REGISTER_NAME in tokens:
+		return None
+	return INSTRUCTION_TABLE[tokens[0]].build(get_source_artifact(tokens))
+
+@dataclass
+class PeepholeEntry:
+	line_number: int
+	# the source line, None once the instruction was rewritten
+	line: str
+	instruction: IntermediateInstruction
+
+class PeepholeOptimizer:
+	def __init__(self):
+		self.removed_instructions = 0
+		self.saved_words = 0
+
+	'''
+	Takes and yields (line number, line) pairs like the preprocessor. A folded instruction keeps the line
+	number of the first instruction it replaces.
+	'''
+	def optimize(self, numbered_lines: [(int, str)]) -> [(int, str)]:
+		window = []
+		for line_number, line in numbered_lines:
+			try:
+				tokens = lex_source_line(line)
+			except Exception:
+				# passed on as it is, the lexer reports it
+				tokens = None
+			if tokens == ():
+				continue
+			instruction = get_foldable_instruction(tokens) if tokens else None
+			if instruction is None:
+				yield from self.flush(window)
+				yield line_number, line
+				continue
+			self.removed_instructions += 1
+			self.saved_words += get_lowered_length(instruction)
+			entry = PeepholeEntry(line_number, line, instruction)
+			if is_identity_instruction(instruction):
+				continue
+			while window and window[-1].instruction.dest_reg == instruction.dest_reg:
+				folded = fold_intermediate_pair(window[-1].instruction, instruction)
+				if folded is None:
+					break
+				previous = window.pop()
+				if not folded:
+					entry = None
+					break
+				if folded[0] is not instruction:
+					instruction = folded[0]
+					entry = PeepholeEntry(previous.line_number, None, instruction)
+			if entry is None:
+				continue
+			window.append(entry)
+			if len(window) > PEEPHOLE_WINDOW_SIZE:
+				yield self.emit(window.pop(0))
+		yield from self.flush(window)
+
+	def emit(self, entry: PeepholeEntry) -> (int, str):
+		self.removed_instructions -= 1
+		self.saved_words -= get_lowered_length(entry.instruction)
+		if entry.line is None:
+			return entry.line_number, format_intermediate_instruction(entry.instruction)
+		return entry.line_number, entry.line
+
+	def flush(self, window: [PeepholeEntry]) -> [(int, str)]:
+		for entry in window:
+			yield self.emit(entry)
+		window.clear()
+
+OPTIMIZATION_PASSES = {
+	'sets': eliminate_redundant_sets,
+}
+
+# passes that need the resolved program, they are not available with --stream
+RESOLVED_OPTIMIZATION_PASSES = {
+	'branches': deduplicate_branch_preambles,
+}
+
+# passes over the source lines, they run in front of the lexer on every path
+SOURCE_OPTIMIZATION_PASSES = {
+	'peephole': PeepholeOptimizer,
+}
+
+def optimize_machine_instructions(machine_instructions: [MachineInstruction], passes: [str]) -> [MachineInstruction]:
+	for name in passes:
+		if name in OPTIMIZATION_PASSES:
+			machine_instructions = OPTIMIZATION_PASSES[name](machine_instructions)
+	return machine_instructions
+
+def optimize_resolved_instructions(machine_instructions: [MachineInstruction], symbol_table: SymbolTable, passes: [str]) -> ([MachineInstruction], SymbolTable):
+	for name in passes:
+		if name in RESOLVED_OPTIMIZATION_PASSES:
+			machine_instructions, symbol_table = RESOLVED_OPTIMIZATION_PASSES[name](machine_instructions, symbol_table)
+	return machine_instructions, symbol_table
+
+'''
+Assembles the whole program in memory, returns the machine instructions and their encoded words (tags excluded).
+When source_lines is given, the index of the cleaned source line of every word is appended to it.
+When tag_addresses is given, the final address of every tag is stored in it.
+'''
+def assemble_program(cleaned_lines: [str], args, cache: ExpansionCache, region_cache: RegionCache = None, profiler: Profiler = DISABLED_PROFILER, source_lines: [int] = None, tag_addresses: dict = None) -> ([MachineInstruction], [int]):
+	line_lengths = [] if source_lines is not None else None
+	with profiler.stage('expand'):
+		if region_cache is not None:
+			machine_instructions, encoded_machine_instructions = assemble_source_regions(cleaned_lines, cache, region_cache, profiler, line_lengths)
+		else:
+			machine_instructions, encoded_machine_instructions = assemble_source_lines(cleaned_lines, cache, profiler, line_lengths)
+	profiler.add_items('expand', len(encoded_machine_instructions))
+	if source_lines is not None:
+		machine_instructions, origins = get_instruction_origins(machine_instructions, line_lengths)
+	if args.optimize:
+		# the cached words no longer line up once instructions are dropped
+		with profiler.stage('optimize'):
+			machine_instructions = list(optimize_machine_instructions(machine_instructions, args.optimize))
+	with profiler.stage('tags'):
+		machine_instructions, symbol_table = extract_tag_information(machine_instructions)
+	profiler.add_items('tags', len(symbol_table.tags))
+	with profiler.stage('branches'):
+		machine_instructions = tag_branch_instructions(machine_instructions, symbol_table)
+	profiler.add_items('branches', len(symbol_table.fixups))
+	if args.optimize:
+		with profiler.stage('optimize resolved'):
+			machine_instructions, symbol_table = optimize_resolved_instructions(machine_instructions, symbol_table, args.optimize)
+		with profiler.stage('encode'):
+			encoded_machine_instructions = encode_machine_code(machine_instructions)
+	else:
+		with profiler.stage('encode fixups'):
+			encoded_machine_instructions = encode_branch_fixups(machine_instructions, encoded_machine_instructions, symbol_table)
+	if source_lines is not None:
+		source_lines += get_source_line_indices(machine_instructions, origins)
+	if tag_addresses is not None:
+		tag_addresses.update(symbol_table.tags)
+	return machine_instructions, encoded_machine_instructions
+
+'''
+Returns the canonical lines of source_file, preprocessed and run through the source passes in args.
+The line number of every canonical line is appended to line_numbers when it is given.
+'''
+def get_source_lines(source_file: str, args, profiler: Profiler = DISABLED_PROFILER, lines: [str] = None, peephole: PeepholeOptimizer = None, line_numbers: [int] = None) -> [str]:
+	numbered_lines = profiler.iterate('preprocess', Preprocessor(frozenset(INSTRUCTION_TABLE)).preprocess(source_file, lines))
+	if 'peephole' in args.optimize:
+		# the caller passes its own optimizer to read how many words were saved
+		peephole = peephole if peephole is not None else PeepholeOptimizer()
+		numbered_lines = profiler.iterate('peephole', peephole.optimize(numbered_lines))
+	return profiler.iterate('lex', lex_source_lines(numbered_lines, line_numbers))
+
+'''
+Assembles source_file with the options in args and returns its encoded words, lazily in --stream mode.
+The source is read from lines instead of the file when they are given, source_file then only names it.
+'''
+def assemble_source(source_file: str, args, cache: ExpansionCache, region_cache: RegionCache = None, profiler: Profiler = DISABLED_PROFILER, lines: [str] = None, peephole: PeepholeOptimizer = None) -> [int]:
+	line_numbers = [] if args.listing or args.cost_report else None
+	cleaned_lines = get_source_lines(source_file, args, profiler, lines, peephole, line_numbers)
+	if args.cost_report:
+		# the report names the statements of the hottest lines
+		cleaned_lines = list(cleaned_lines)
+	if args.stream:
+		# every stage is a generator here, the profiler charges each one for the time spent producing its items
+		expansions = profiler.iterate('expand', expand_source_lines(cleaned_lines, cache, profiler))
+		# the instructions and the cached words of every expansion, consumed side by side
+		instruction_expansions, word_expansions = tee(expansions)
+		machine_instructions = chain.from_iterable(map(attrgetter('machine_instructions'), instruction_expansions))
+		encoded_words = chain.from_iterable(map(attrgetter('encoded_words'), word_expansions))
+		if args.optimize:
+			# the passes drop instructions, what is left is encoded once they are done
+			machine_instructions = profiler.iterate('optimize', optimize_machine_instructions(machine_instructions, args.optimize))
+			encoded_words = None
+		machine_instructions = profiler.iterate('resolve', resolve_branch_instructions(machine_instructions))
+		return profiler.iterate('encode', encode_machine_code_chunks(machine_instructions, encoded_words))
+	if args.compact:
+		return assemble_compact_program(cleaned_lines, cache, profiler)
+	if region_cache is not None:
+		region_cache.open_source(source_file)
+	source_lines = [] if args.listing or args.cost_report else None
+	machine_instructions, encoded_machine_instructions = assemble_program(cleaned_lines, args, cache, region_cache, profiler, source_lines)
+	if args.listing:
+		with profiler.stage('listing'):
+			write_listing(args.listing, machine_instructions, encoded_machine_instructions, source_lines, line_numbers)
+	if args.cost_report:
+		with profiler.stage('cost report'):
+			write_cost_report(args.cost_report, cleaned_lines, source_lines, line_numbers, args.cost_top)
+	return encoded_machine_instructions
+
+'''
+Assembles source_file into output_file with the options in args, returns the number of words written
+'''
+def assemble_file(source_file: str, output_file: str, args, cache: ExpansionCache, region_cache: RegionCache = None, profiler: Profiler = DISABLED_PROFILER, peephole: PeepholeOptimizer = None) -> int:
+	if args.object:
+		return assemble_object_file(source_file, output_file, args, cache, region_cache, profiler, peephole=peephole)
+	encoded_machine_instructions = assemble_source(source_file, args, cache, region_cache, profiler, peephole=peephole)
+	with profiler.stage('write'):
+		words = write_machine_code(output_file, encoded_machine_instructions, args.format, args.base_address)
+	profiler.add_items('write', words)
+	return words
+
+# ----------------------------------------------
+'''
+Relocatable objects (--object)
+
+A module is assembled on its own into an object file that linker.py concatenates with other modules.
+Branches to tags of the module itself are resolved right away, their offsets do not depend on where the
+module ends up. Branches to tags of other modules keep a zero offset in their preamble and are listed as
+fixups, the linker patches the SET nibbles once the module addresses are known.
+
+The first line of an object file is a small JSON header with the key of the canonical lines the object was
+assembled from, an object whose key matches is reused without assembling the module again. The second
+line holds the words as 4 hex digits each, the exported tags and the fixups.
+'''
+
+OBJECT_FORMAT = 'datalore-object'
+# bump the version whenever the layout or the lowering changes, objects of another version are reassembled
+OBJECT_FORMAT_VERSION = 2
+OBJECT_EXTENSION = '.dlo'
+
+@dataclass
+class ObjectModule:
+	key: str
+	words: [int]
+	# exported tags, by address within the module
+	tags: dict
+	# branches to tags of other modules
+	fixups: [BranchFixup]
+
+def get_object_key(cleaned_lines: [str], args) -> str:
+	content = f'{OBJECT_FORMAT_VERSION}\n{REGION_CACHE_VERSION}\n{",".join(args.optimize)}\n' + '\n'.join(cleaned_lines)
+	return hashlib.sha256(content.encode()).hexdigest()
+
+def write_object_file(output_file: str, module: ObjectModule):
+	header = {'format': OBJECT_FORMAT, 'version': OBJECT_FORMAT_VERSION, 'key': module.key, 'words': len(module.words)}
+	body = {
+		'code': pack_machine_code(module.words).hex(),
+		'tags': module.tags,
+		'fixups': [(fixup.tagname, fixup.address, fixup.preamble) for fixup in module.fixups],
+	}
+	if output_file == STANDARD_STREAM:
+		print(json.dumps(header), json.dumps(body), sep='\n')
+		return
+	# write to a temporary file first so an interrupted run never leaves a truncated object behind
+	with open(output_file + '.tmp', 'w') as f:
+		print(json.dumps(header), json.dumps(body), sep='\n', file=f)
+	os.replace(output_file + '.tmp', output_file)
+
+def read_object_header(object_file: str) -> dict:
+	with open(object_file) as f:
+		try:
+			header = json.loads(f.readline())
+		except ValueError:
+			header = None
+	if not isinstance(header, dict) or header.get('format') != OBJECT_FORMAT:
+		raise Exception(f'{object_file} is not an object file')
+	if header.get('version') != OBJECT_FORMAT_VERSION:
+		raise Exception(f'{object_file} has object format version {header.get("version")}, expected {OBJECT_FORMAT_VERSION}')
+	return header
+
+def read_object_file(object_file: str) -> ObjectModule:
+	header = read_object_header(object_file)
+	with open(object_file) as f:
+		f.readline()
+		body = json.loads(f.readline())
+	words = unpack_machine_code(bytes.fromhex(body['code']))
+	if len(words) != header['words']:
+		raise Exception(f'{object_file} holds {len(words)} words, its header says {header["words"]}')
+	fixups = [BranchFixup(tagname=tagname, address=address, preamble=tuple(preamble)) for tagname, address, preamble in body['fixups']]
+	return ObjectModule(key=header['key'], words=words, tags=body['tags'], fixups=fixups)
+
+'''
+Returns the header of object_file, None when there is no readable object
+'''
+def find_object_header(object_file: str) -> dict:
+	try:
+		return read_object_header(object_file)
+	except Exception:
+		return None
+
+def assemble_object(cleaned_lines: [str], args, cache: ExpansionCache, region_cache: RegionCache = None, profiler: Profiler = DISABLED_PROFILER, key: str = None) -> ObjectModule:
+	with profiler.stage('expand'):
+		if region_cache is not None:
+			machine_instructions, encoded_machine_instructions = assemble_source_regions(cleaned_lines, cache, region_cache, profiler)
+		else:
+			machine_instructions, encoded_machine_instructions = assemble_source_lines(cleaned_lines, cache, profiler)
+	profiler.add_items('expand', len(encoded_machine_instructions))
+	if args.optimize:
+		with profiler.stage('optimize'):
+			machine_instructions = list(optimize_machine_instructions(machine_instructions, args.optimize))
+	with profiler.stage('tags'):
+		machine_instructions, symbol_table = extract_tag_information(machine_instructions)
+	profiler.add_items('tags', len(symbol_table.tags))
+	with profiler.stage('branches'):
+		local_fixups = [fixup for fixup in symbol_table.fixups if fixup.tagname in symbol_table.tags]
+		external_fixups = [fixup for fixup in symbol_table.fixups if fixup.tagname not in symbol_table.tags]
+		tag_branch_instructions(machine_instructions, SymbolTable(tags=symbol_table.tags, fixups=local_fixups))
+		# the linker fills in the offset, the zero offset only gives the preamble its SET and MEM words
+		for fixup in external_fixups:
+			patch_branch_preamble(machine_instructions, fixup, fixup.address)
+	profiler.add_items('branches', len(symbol_table.fixups))
+	with profiler.stage('encode'):
+		if args.optimize:
+			encoded_machine_instructions = encode_machine_code(machine_instructions)
+			if not isinstance(encoded_machine_instructions, list):
+				encoded_machine_instructions = encoded_machine_instructions.tolist()
+		else:
+			encoded_machine_instructions = encode_branch_fixups(machine_instructions, encoded_machine_instructions, symbol_table)
+	# the local tags of macro expansions stay private to the module
+	tags = {tagname: addr for tagname, addr in symbol_table.tags.items() if not is_local_tagname(tagname)}
+	return ObjectModule(key=key, words=encoded_machine_instructions, tags=tags, fixups=external_fixups)
+
+'''
+Assembles source_file into the object file output_file and returns its number of words. The object is left
+as it is when it was already assembled from the same canonical lines with the same options.
+'''
+def assemble_object_file(source_file: str, output_file: str, args, cache: ExpansionCache, region_cache: RegionCache = None, profiler: Profiler = DISABLED_PROFILER, lines: [str] = None, peephole: PeepholeOptimizer = None) -> int:
+	cleaned_lines = list(get_source_lines(source_file, args, profiler, lines, peephole))
+	key = get_object_key(cleaned_lines, args)
+	header = find_object_header(output_file) if output_file != STANDARD_STREAM else None
+	if header is not None and header.get('key') == key:
+		return header['words']
+	if region_cache is not None:
+		region_cache.open_source(source_file)
+	module = assemble_object(cleaned_lines, args, cache, region_cache, profiler, key)
+	with profiler.stage('write'):
+		write_object_file(output_file, module)
+	profiler.add_items('write', len(module.words))
+	return len(module.words)
+
+# ----------------------------------------------
+'''
+Listing (--listing FILE)
 
-def encode_machine_instruction(machine_instr: MachineInstruction) -> str:
+Lowered instructions are shared between identical source lines by the expansion cache, so before the
+passes run every instruction is copied and remembered with the source line it came from. The passes
+only drop instructions or replace branch preamble words, a replaced word belongs to the branch that
+follows it.
+'''
+
+def get_instruction_origins(machine_instructions: [MachineInstruction], line_lengths: [int]) -> ([MachineInstruction], dict):
+	copies = []
+	# id -> (instruction, line index), the instruction is kept so that its id is never reused
+	origins = dict()
+	instructions = iter(machine_instructions)
+	for line_index, line_length in enumerate(line_lengths):
+		for _ in range(line_length):
+			machine_instr = copy(next(instructions))
+			copies.append(machine_instr)
+			origins[id(machine_instr)] = (machine_instr, line_index)
+	return copies, origins
+
+def get_source_line_indices(machine_instructions: [MachineInstruction], origins: dict) -> [int]:
+	line_indices = [None] * len(machine_instructions)
+	line_index = None
+	for addr in range(len(machine_instructions) - 1, -1, -1):
+		origin = origins.get(id(machine_instructions[addr]))
+		if origin is not None:
+			line_index = origin[1]
+		line_indices[addr] = line_index
+	return line_indices
+
+def format_machine_instruction(machine_instr: MachineInstruction) -> str:
 	if isinstance(machine_instr, RegMachineInstr):
-		return encode_register_instruction(machine_instr)
+		return f'{machine_instr.mnemonic} {machine_instr.dest_reg} {machine_instr.src_reg}'
 	elif isinstance(machine_instr, SetMachineInstr):
-		return encode_set_instruction(machine_instr)
+		return f'SET {"lower" if machine_instr.flag else "upper"} {machine_instr.imm}'
 	elif isinstance(machine_instr, MemMachineInstr):
-		return encode_mem_instruction(machine_instr)
+		return f'MEM {"load" if machine_instr.is_load else "store"} {machine_instr.target_reg} {machine_instr.target_location}'
 	elif isinstance(machine_instr, BrnMachineInstr):
-		return encode_brn_instruction(machine_instr)
+		return f'BEQ {machine_instr.operand_reg1} {machine_instr.operand_reg2} @{machine_instr.tagname}'
+	raise Exception(f'Invalid machine instruction: {machine_instr}')
+
+def write_listing(listing_file: str, machine_instructions: [MachineInstruction], encoded_machine_instructions: [int], source_lines: [int], line_numbers: [int]):
+	# address, encoded word, source line number, lowered instruction
+	lines = [f'{"addr":<6}{"word":<11}{"line":<7}instruction']
+	for addr, (machine_instr, word, line_index) in enumerate(zip(machine_instructions, encoded_machine_instructions, source_lines)):
+		lines.append(f'{addr:<6}{format_machine_word(word):<11}{line_numbers[line_index]:<7}{format_machine_instruction(machine_instr)}')
+	lines.append('')
+	with open_output(listing_file, False) as f:
+		f.write('\n'.join(lines))
+
+# ----------------------------------------------
+'''
+Cost report (--cost-report FILE)
+
+Static view of where the words of the image come from. Every word is charged to the source line it was
+lowered from, like in the listing, and the words are then summed per source line, per mnemonic and per
+block (the lines from one tag to the next). Source lines and blocks are ranked, the most expensive first.
+The lines of an include or a macro call are charged to the line of the .include or the call.
+'''
+
+# entries per ranking in the cost report
+COST_REPORT_TOP = 20
+# name of the block in front of the first tag
+START_BLOCK_NAME = '(start)'
+
+@dataclass
+class CostEntry:
+	name: str
+	# source instructions, tags excluded
+	instructions: int = 0
+	words: int = 0
+	# first canonical statement, for source lines
+	statement: str = None
+
+def get_cost_entry(entries: dict, key, name: str) -> CostEntry:
+	entry = entries.get(key)
+	if entry is None:
+		entry = entries[key] = CostEntry(name=name)
+	return entry
+
+def rank_cost_entries(entries: dict) -> [CostEntry]:
+	return sorted(entries.values(), key=lambda entry: entry.words, reverse=True)
+
+'''
+Returns the cost entries by source line, by mnemonic and by block. source_lines holds the index of the cleaned
+line of every word and line_numbers the source line number of every cleaned line.
+'''
+def get_cost_entries(cleaned_lines: [str], source_lines: [int], line_numbers: [int]) -> (dict, dict, dict):
+	line_words = [0] * len(cleaned_lines)
+	for line_index in source_lines:
+		line_words[line_index] += 1
+	by_line = dict()
+	by_mnemonic = dict()
+	by_block = dict()
+	block = get_cost_entry(by_block, START_BLOCK_NAME, START_BLOCK_NAME)
+	for line_index, line in enumerate(cleaned_lines):
+		if line.startswith('@'):
+			block = get_cost_entry(by_block, line, line)
+			continue
+		line_number = line_numbers[line_index]
+		line_entry = get_cost_entry(by_line, line_number, str(line_number))
+		if line_entry.statement is None:
+			line_entry.statement = line
+		mnemonic = line.split(None, 1)[0]
+		for entry in (line_entry, get_cost_entry(by_mnemonic, mnemonic, mnemonic), block):
+			entry.instructions += 1
+			entry.words += line_words[line_index]
+	if not by_block[START_BLOCK_NAME].instructions:
+		del by_block[START_BLOCK_NAME]
+	return by_line, by_mnemonic, by_block
+
+def format_cost_share(words: int, total: int) -> str:
+	return f'{words / total * 100 if total > 0 else 0:>7.1f}%'
+
+def format_cost_report(cleaned_lines: [str], source_lines: [int], line_numbers: [int], top: int = COST_REPORT_TOP) -> str:
+	by_line, by_mnemonic, by_block = get_cost_entries(cleaned_lines, source_lines, line_numbers)
+	total = len(source_lines)
+	instructions = sum(entry.instructions for entry in by_mnemonic.values())
+	lines = [f'{total} words from {instructions} source instructions, {len(by_block)} blocks', '']
+	lines.append(f'{"mnemonic":<12}{"source":>10}{"words":>12}{"words/source":>14}{"share":>9}')
+	for entry in rank_cost_entries(by_mnemonic):
+		lines.append(f'{entry.name:<12}{entry.instructions:>10}{entry.words:>12}{entry.words / entry.instructions:>14.2f}{format_cost_share(entry.words, total)}')
+	lines.append('')
+	lines.append(f'hottest source lines (top {top})')
+	lines.append(f'{"line":<10}{"source":>10}{"words":>12}{"share":>9}  statement')
+	for entry in rank_cost_entries(by_line)[:top]:
+		# an include or a macro call stands for several statements, only the first one is shown
+		statement = entry.statement if entry.instructions == 1 else f'{entry.statement} ...'
+		lines.append(f'{entry.name:<10}{entry.instructions:>10}{entry.words:>12}{format_cost_share(entry.words, total)}  {statement}')
+	lines.append('')
+	lines.append(f'hottest blocks (top {top})')
+	lines.append(f'{"block":<30}{"source":>10}{"words":>12}{"share":>9}')
+	for entry in rank_cost_entries(by_block)[:top]:
+		lines.append(f'{entry.name:<30}{entry.instructions:>10}{entry.words:>12}{format_cost_share(entry.words, total)}')
+	lines.append('')
+	return '\n'.join(lines)
+
+def write_cost_report(report_file: str, cleaned_lines: [str], source_lines: [int], line_numbers: [int], top: int = COST_REPORT_TOP):
+	with open_output(report_file, False) as f:
+		f.write(format_cost_report(cleaned_lines, source_lines, line_numbers, top))
+
+# ----------------------------------------------
+'''
+Batch mode
+
+Every input is assembled in its own worker process, a failing file is reported and the rest of the batch carries on.
+'''
+
+@dataclass
+class BatchResult:
+	source_file: str
+	output_file: str
+	words: int
+	seconds: float
+	error: str = None
+
+def get_batch_inputs(patterns: [str], manifest: str = None) -> [str]:
+	source_files = []
+	for pattern in patterns:
+		matches = sorted(glob.glob(pattern, recursive=True))
+		if not matches:
+			raise Exception(f'No input files match {pattern}')
+		source_files += matches
+	if manifest is not None:
+		# the listed paths are relative to the manifest, not to the working directory
+		manifest_dir = os.path.dirname(manifest)
+		source_files += [os.path.join(manifest_dir, line) for line in get_cleaned_lines(manifest)]
+	# the same file may be matched by several patterns
+	return list(dict.fromkeys(source_files))
+
+def get_batch_output_file(source_file: str, output_dir: str, output_format: str, is_object: bool = False) -> str:
+	stem = os.path.splitext(os.path.basename(source_file))[0]
+	return os.path.join(output_dir, stem + (OBJECT_EXTENSION if is_object else OUTPUT_EXTENSIONS[output_format]))
+
+def assemble_batch_file(source_file: str, output_file: str, args) -> BatchResult:
+	start = time.perf_counter()
+	try:
+		region_cache = RegionCache(args.cache_dir) if args.incremental else None
+		words = assemble_file(source_file, output_file, args, ExpansionCache(args.cache_size), region_cache)
+	except Exception as e:
+		return BatchResult(source_file=source_file, output_file=output_file, words=0, seconds=time.perf_counter() - start, error=str(e))
+	return BatchResult(source_file=source_file, output_file=output_file, words=words, seconds=time.perf_counter() - start)
+
+def assemble_batch(source_files: [str], args) -> [BatchResult]:
+	os.makedirs(args.output_dir, exist_ok=True)
+	output_files = [get_batch_output_file(source_file, args.output_dir, args.format, args.object) for source_file in source_files]
+	duplicates = set(output_file for output_file in output_files if output_files.count(output_file) > 1)
+	# a source assembled with -d next to itself and the same extension would be overwritten by its own output
+	inputs = set(os.path.realpath(source_file) for source_file in source_files)
+	results = []
+	with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+		futures = []
+		for source_file, output_file in zip(source_files, output_files):
+			if output_file in duplicates:
+				results.append(BatchResult(source_file=source_file, output_file=output_file, words=0, seconds=0.0, error=f'Output file {output_file} is shared with another input'))
+			elif os.path.realpath(output_file) in inputs:
+				results.append(BatchResult(source_file=source_file, output_file=output_file, words=0, seconds=0.0, error=f'Output file {output_file} would overwrite an input'))
+			else:
+				futures.append(executor.submit(assemble_batch_file, source_file, output_file, args))
+		for result in results:
+			print_batch_result(result)
+		for future in as_completed(futures):
+			result = future.result()
+			print_batch_result(result)
+			results.append(result)
+	return results
+
+def print_batch_result(result: BatchResult):
+	if result.error is None:
+		print(f'ok      {result.source_file} -> {result.output_file} ({result.words} words, {result.seconds * 1000:.1f} ms)')
 	else:
-		raise Exception(f'Invalid machine instruction: {machine_instr}')
+		print(f'FAILED  {result.source_file}: {result.error}')
 
-def encode_machine_instructions(machine_instructions: [MachineInstruction]) -> [str]:
-	encoded_machine_instructions = []
-	for machine_instr in machine_instructions:
-		encoded_machine_instructions.append(encode_machine_instruction(machine_instr))
-	return encoded_machine_instructions
+def print_batch_summary(results: [BatchResult], wall_seconds: float):
+	failed = [result for result in results if result.error is not None]
+	words = sum(result.words for result in results)
+	cpu_seconds = sum(result.seconds for result in results)
+	print(f'Assembled {len(results) - len(failed)}/{len(results)} files, {words} words in {wall_seconds:.2f} s ({cpu_seconds:.2f} s summed over files)')
+	for result in failed:
+		print(f'  failed: {result.source_file}')
 
 def parse_args():
 	parser = argparse.ArgumentParser()
-	parser.add_argument('-i', '--input', help='Input File Path', required=True)
-	parser.add_argument('-o', '--output', help='Output File Path', required=True)
+	parser.add_argument('-i', '--input', help='Input File Path (- for stdin)')
+	parser.add_argument('-o', '--output', help='Output File Path (- for stdout)')
+	parser.add_argument('-b', '--batch', help='Assemble every file matching these glob patterns', nargs='+', default=[])
+	parser.add_argument('-m', '--manifest', help='Assemble every file listed (one path per line) in this file')
+	parser.add_argument('-d', '--output-dir', help='Output directory for --batch/--manifest')
+	parser.add_argument('-j', '--jobs', help='Number of worker processes for --batch/--manifest', type=int, default=os.cpu_count())
+	parser.add_argument('-s', '--stream', help='Assemble in a single streaming pass with bounded memory', action='store_true')
+	parser.add_argument('--compact', help='Hold the lowered program in compact columns of small ints (no optimization or listing)', action='store_true')
+	parser.add_argument('--cache-size', help='Number of distinct source lines kept in the expansion cache (0 disables it)', type=int, default=EXPANSION_CACHE_SIZE)
+	parser.add_argument('--cache-stats', help='Print expansion cache hits and misses', action='store_true')
+	parser.add_argument('--incremental', help='Reuse the lowered tag regions stored in the cache directory', action='store_true')
+	parser.add_argument('--cache-dir', help='Directory of the incremental cache', default=REGION_CACHE_DIR)
+	parser.add_argument('-O', '--optimize', help='Enable an optimization pass (may be repeated)', action='append', choices=list(OPTIMIZATION_PASSES) + list(RESOLVED_OPTIMIZATION_PASSES) + list(SOURCE_OPTIMIZATION_PASSES), default=[])
+	parser.add_argument('-p', '--profile', help='Report time, allocations and item counts per stage on stderr', nargs='?', const='text', choices=PROFILE_FORMATS)
+	parser.add_argument('-l', '--listing', help='Write a listing (address, word, source line, lowered instruction) to this file (- for stdout)')
+	parser.add_argument('--cost-report', help='Write the words per source line, mnemonic and tag block, hottest first, to this file (- for stdout)')
+	parser.add_argument('--cost-top', help='Number of source lines and blocks ranked in the cost report', type=int, default=COST_REPORT_TOP)
+	parser.add_argument('-f', '--format', help='Output Format (text/readmemb: one 9 bit string per line, readmemh: 3 hex digits per line, bin: 2 big endian bytes per word, ihex: Intel HEX of the bin bytes, npy: uint16 array)', choices=OUTPUT_FORMATS, default='text')
+	parser.add_argument('-c', '--object', help=f'Write a relocatable object ({OBJECT_EXTENSION}) for linker.py instead of machine code, objects that are up to date are kept', action='store_true')
+	parser.add_argument('--base-address', help='Byte address the ihex image is loaded at', type=lambda value: int(value, 0), default=0)
 	args = parser.parse_args()
+	if args.batch or args.manifest:
+		if args.input or args.output:
+			parser.error('-i/-o cannot be combined with --batch/--manifest')
+		if not args.output_dir:
+			parser.error('--batch/--manifest need an --output-dir')
+		if args.listing or args.cost_report:
+			parser.error('--listing and --cost-report cannot be combined with --batch/--manifest')
+	elif not args.input or not args.output:
+		parser.error('-i and -o are required')
+	try:
+		check_options(args)
+		check_output_files(args.input, [args.output, args.listing, args.cost_report])
+	except Exception as e:
+		parser.error(str(e))
 	return args
 
+# raises when an output would truncate the source before it was read, the input is read lazily
+def check_output_files(source_file: str, output_files: [str]):
+	if source_file is None or source_file == STANDARD_STREAM:
+		return
+	for output_file in output_files:
+		if output_file is not None and output_file != STANDARD_STREAM and os.path.realpath(output_file) == os.path.realpath(source_file):
+			raise Exception(f'Output file {output_file} is the input file')
+
+# raises on the assembly options that cannot be combined
+def check_options(args):
+	if args.stream and args.incremental:
+		raise Exception('--incremental cannot be used with --stream')
+	if args.stream and (args.listing or args.cost_report):
+		raise Exception('--listing and --cost-report cannot be used with --stream')
+	if args.compact and (args.stream or args.incremental or args.listing or args.cost_report or any(name not in SOURCE_OPTIMIZATION_PASSES for name in args.optimize)):
+		raise Exception(f'--compact cannot be combined with --stream, --incremental, --listing, --cost-report or -O other than {"/".join(SOURCE_OPTIMIZATION_PASSES)}')
+	if args.stream and any(name in RESOLVED_OPTIMIZATION_PASSES for name in args.optimize):
+		raise Exception(f'-O {"/".join(RESOLVED_OPTIMIZATION_PASSES)} cannot be used with --stream')
+	if args.object and (args.stream or args.compact or args.listing or args.cost_report):
+		raise Exception('--object cannot be combined with --stream, --compact, --listing or --cost-report')
+	if args.object and any(name in RESOLVED_OPTIMIZATION_PASSES for name in args.optimize):
+		# the linker patches every preamble slot of a branch to another module
+		raise Exception(f'-O {"/".join(RESOLVED_OPTIMIZATION_PASSES)} cannot be used with --object')
+	for name in args.optimize:
+		if name not in OPTIMIZATION_PASSES and name not in RESOLVED_OPTIMIZATION_PASSES and name not in SOURCE_OPTIMIZATION_PASSES:
+			raise Exception(f'Invalid optimization pass: {name}')
+	if args.format not in OUTPUT_FORMATS:
+		raise Exception(f'Invalid output format: {args.format}')
+	if args.base_address < 0:
+		raise Exception(f'Invalid base address: {args.base_address}')
+	if args.cost_top < 0:
+		raise Exception(f'Invalid number of ranked cost entries: {args.cost_top}')
+
 def main():
 	# use argparse to parse the arguments
-	# python3 assembler.py -i <input_file> -o <output_file>
+	# python3 assembler.py -i <input_file> -o <output_file> [-f text|bin]
+	# python3 assembler.py -b 'programs/*.txt' -d <output_dir> [-j <jobs>]
+	# python3 assembler.py --object -b 'modules/*.txt' -d <object_dir>, then linker.py
 	args = parse_args()
-	source_file = args.input
-	output_file = args.output
-	cleaned_lines = get_cleaned_lines(source_file)
-	source_artifacts = get_source_artifacts(cleaned_lines)
-	intermediate_instructions = process_source_artifacts(source_artifacts)
-	machine_instructions = process_intermediate_instructions(intermediate_instructions)
-	machine_instructions = extract_tag_information(machine_instructions)
-	machine_instructions = tag_branch_instructions(machine_instructions)
-	encoded_machine_instructions = encode_machine_instructions(machine_instructions)
-	for (machine_instruction, encoded_machine_instruction) in zip(machine_instructions, encoded_machine_instructions):
-		print(f'{encoded_machine_instruction} <- {machine_instruction}')
-	write_machine_code(output_file, encoded_machine_instructions)
+	if args.batch or args.manifest:
+		start = time.perf_counter()
+		results = assemble_batch(get_batch_inputs(args.batch, args.manifest), args)
+		print_batch_summary(results, time.perf_counter() - start)
+		if any(result.error is not None for result in results):
+			sys.exit(1)
+		return
+	cache = ExpansionCache(args.cache_size)
+	region_cache = RegionCache(args.cache_dir) if args.incremental else None
+	profiler = Profiler() if args.profile else DISABLED_PROFILER
+	peephole = PeepholeOptimizer() if 'peephole' in args.optimize else None
+	assemble_file(args.input, args.output, args, cache, region_cache, profiler=profiler, peephole=peephole)
+	if peephole is not None:
+		print(f'Peephole: {peephole.saved_words} words saved, {peephole.removed_instructions} instructions removed', file=sys.stderr)
+	if args.profile:
+		profiler.print_report(args.profile)
+	if args.cache_stats:
+		print(f'Expansion cache: {cache.hits} hits, {cache.misses} misses', file=sys.stderr)
+		if region_cache is not None:
+			print(f'Region cache: {region_cache.hits} regions reused, {region_cache.misses} regions lowered', file=sys.stderr)
 
 if __name__ == '__main__':
-	main()
\ No newline at end of file
+	main()
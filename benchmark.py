@@ -0,0 +1,205 @@
+from assembler import *
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+
+'''
+Benchmark harness for the assembler pipeline.
+
+Synthetic DataLore sources are generated for every requested size and each stage of the pipeline is
+timed on its own. Every size is measured in a fresh process, so its peak RSS is not inflated by the
+larger sizes measured before it. Results (seconds per stage, lines/s and peak RSS) are written as JSON,
+which can later be passed to --compare to flag stages that got slower.
+
+	python3 benchmark.py --sizes 1000 100000 10000000 -o baseline.json
+	python3 benchmark.py --compare baseline.json
+'''
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+DEFAULT_MIX = {'imm': 35, 'reg': 25, 'shift': 10, 'mem': 20, 'zer': 5, 'beq': 5}
+# a tag is placed every TAG_SPACING lines, branches only target nearby tags so the offsets fit in 12 bits
+DEFAULT_TAG_SPACING = 64
+DEFAULT_SEED = 0
+DEFAULT_THRESHOLD = 0.10
+
+REGISTERS = ['R0', 'R1', 'R2', 'R3', 'R4', 'R5', 'R6']
+ALU_MNEMONICS = ['ADD', 'AND', 'XOR', 'ROL', 'MOV']
+
+def parse_mix(mix: str) -> dict:
+	weights = dict()
+	for item in mix.split(','):
+		kind, weight = item.split('=')
+		if kind not in DEFAULT_MIX:
+			raise Exception(f'Invalid instruction kind {kind}, expected one of {", ".join(DEFAULT_MIX)}')
+		weights[kind] = int(weight)
+	return weights
+
+def generate_instruction(kind: str, rng: random.Random, tag_index: int, tag_count: int) -> str:
+	reg = rng.choice(REGISTERS)
+	if kind == 'imm':
+		mnemonic = rng.choice(ALU_MNEMONICS + ['SUB'])
+		# SUB #0 has no 8 bit two's complement
+		return f'{mnemonic} {reg}, #{rng.randrange(1 if mnemonic == "SUB" else 0, 256)}'
+	elif kind == 'reg':
+		return f'{rng.choice(ALU_MNEMONICS)} {reg}, {rng.choice(REGISTERS)}'
+	elif kind == 'shift':
+		return f'{rng.choice(["LSL", "LSR", "ROR"])} {reg}, #{rng.randrange(1, 8)}'
+	elif kind == 'mem':
+		if rng.random() < 0.5:
+			return f'{rng.choice(["LDR", "STR"])} {reg}, #{rng.randrange(200)}'
+		return f'{rng.choice(["LDR", "STR"])} {reg}, {rng.choice(REGISTERS)}'
+	elif kind == 'zer':
+		return f'ZER {reg}'
+	else:
+		# previous or next tag
+		target = min(max(tag_index + rng.choice([0, 1]), 0), tag_count - 1)
+		return f'BEQ {reg}, {rng.choice(REGISTERS)}, t{target}'
+
+def generate_source(line_count: int, mix: dict, tag_spacing: int = DEFAULT_TAG_SPACING, seed: int = DEFAULT_SEED) -> [str]:
+	rng = random.Random(seed)
+	kinds = list(mix)
+	weights = [mix[kind] for kind in kinds]
+	tag_count = max(1, (line_count + tag_spacing - 1) // tag_spacing)
+	lines = []
+	for i in range(line_count):
+		if i % tag_spacing == 0:
+			lines.append(f'@t{i // tag_spacing}:')
+			continue
+		kind = rng.choices(kinds, weights)[0]
+		lines.append(generate_instruction(kind, rng, i // tag_spacing, tag_count))
+	return lines
+
+def get_peak_rss_kb() -> int:
+	# ru_maxrss is in kilobytes on Linux and in bytes on macOS
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	if platform.system() == 'Darwin':
+		peak //= 1024
+	return peak
+
+'''
+Runs the pipeline of assembler.main on source_file one stage at a time, returns seconds per stage
+'''
+def time_stages(source_file: str, output_file: str) -> dict:
+	timings = dict()
+	def timed(name, stage, *stage_args):
+		start = time.perf_counter()
+		result = stage(*stage_args)
+		timings[name] = time.perf_counter() - start
+		return result
+	cleaned_lines = timed('lex', lambda: list(lex_source_lines(enumerate(get_lines(source_file), 1))))
+	source_artifacts = timed('parse', lambda: [get_source_artifact(line.split(' ')) for line in cleaned_lines])
+	intermediate_instructions = timed('intermediate', lambda: list(process_source_artifacts(source_artifacts)))
+	machine_instructions = timed('lower', lambda: list(process_intermediate_instructions(intermediate_instructions)))
+	machine_instructions, symbol_table = timed('tags', extract_tag_information, machine_instructions)
+	machine_instructions = timed('branches', tag_branch_instructions, machine_instructions, symbol_table)
+	encoded_machine_instructions = timed('encode', lambda: list(encode_machine_instructions(machine_instructions)))
+	timed('write', write_machine_code, output_file, encoded_machine_instructions)
+	# the whole batch pipeline as main runs it, expansion cache included
+	args = argparse.Namespace(optimize=[])
+	timed('assemble', assemble_program, cleaned_lines, args, ExpansionCache())
+	return timings
+
+'''
+Returns the fastest seconds per stage over repeat runs and the peak RSS of the process that ran them
+'''
+def measure_stages(source_file: str, output_file: str, repeat: int) -> (dict, int):
+	best = None
+	for _ in range(repeat):
+		timings = time_stages(source_file, output_file)
+		if best is None:
+			best = timings
+		else:
+			best = {stage: min(best[stage], seconds) for stage, seconds in timings.items()}
+	return best, get_peak_rss_kb()
+
+def run_benchmark(sizes: [int], mix: dict, tag_spacing: int, seed: int, repeat: int) -> dict:
+	results = dict()
+	# ru_maxrss only ever grows, a spawned process per size starts from a clean interpreter
+	context = multiprocessing.get_context('spawn')
+	with tempfile.TemporaryDirectory() as tmp_dir:
+		source_file = os.path.join(tmp_dir, 'source.txt')
+		output_file = os.path.join(tmp_dir, 'machine_code.txt')
+		for size in sizes:
+			with open(source_file, 'w') as f:
+				f.write('\n'.join(generate_source(size, mix, tag_spacing, seed)) + '\n')
+			with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+				best, peak_rss_kb = executor.submit(measure_stages, source_file, output_file, repeat).result()
+			pipeline_seconds = sum(seconds for stage, seconds in best.items() if stage != 'assemble')
+			results[str(size)] = {
+				'stages': best,
+				'lines_per_second': size / pipeline_seconds,
+				'assemble_lines_per_second': size / best['assemble'],
+				'peak_rss_kb': peak_rss_kb,
+			}
+			print(f'{size:>10} lines  {size / pipeline_seconds:>12.0f} lines/s  ' + '  '.join(f'{stage} {seconds * 1000:.1f} ms' for stage, seconds in best.items()))
+	return results
+
+'''
+Returns a message for every stage that is more than threshold slower than in the baseline
+'''
+def compare_results(baseline: dict, results: dict, threshold: float) -> [str]:
+	regressions = []
+	for size, result in results.items():
+		if size not in baseline['sizes']:
+			continue
+		baseline_stages = baseline['sizes'][size]['stages']
+		for stage, seconds in result['stages'].items():
+			# a stage the baseline did not time, or timed below the clock resolution, has nothing to compare to
+			if baseline_stages.get(stage, 0) <= 0:
+				continue
+			ratio = seconds / baseline_stages[stage]
+			if ratio > 1 + threshold:
+				regressions.append(f'{size} lines, {stage}: {baseline_stages[stage] * 1000:.1f} ms -> {seconds * 1000:.1f} ms ({(ratio - 1) * 100:+.0f}%)')
+	return regressions
+
+def parse_args():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-s', '--sizes', help='Source sizes in lines', type=int, nargs='+')
+	parser.add_argument('-m', '--mix', help=f'Instruction mix as kind=weight pairs, kinds: {", ".join(DEFAULT_MIX)}')
+	parser.add_argument('-t', '--tag-spacing', help=f'Lines between tags (default {DEFAULT_TAG_SPACING})', type=int)
+	parser.add_argument('-r', '--repeat', help='Runs per size, the fastest is kept', type=int, default=3)
+	parser.add_argument('--seed', help='Random seed of the generator (default 0)', type=int)
+	parser.add_argument('-o', '--output', help='Write the results to this JSON file')
+	parser.add_argument('-c', '--compare', help='Baseline JSON file to compare against')
+	parser.add_argument('--threshold', help='Relative slowdown reported as a regression', type=float, default=DEFAULT_THRESHOLD)
+	args = parser.parse_args()
+	return args
+
+def main():
+	args = parse_args()
+	baseline = None
+	if args.compare:
+		with open(args.compare) as f:
+			baseline = json.load(f)
+	# a comparison reruns the baseline configuration unless it is overridden
+	sizes = args.sizes or (baseline['config']['sizes'] if baseline else DEFAULT_SIZES)
+	mix = parse_mix(args.mix) if args.mix else (baseline['config']['mix'] if baseline else DEFAULT_MIX)
+	tag_spacing = args.tag_spacing if args.tag_spacing is not None else (baseline['config']['tag_spacing'] if baseline else DEFAULT_TAG_SPACING)
+	seed = args.seed if args.seed is not None else (baseline['config']['seed'] if baseline else DEFAULT_SEED)
+	results = run_benchmark(sizes, mix, tag_spacing, seed, args.repeat)
+	report = {
+		'config': {'sizes': sizes, 'mix': mix, 'tag_spacing': tag_spacing, 'seed': seed},
+		'python': platform.python_version(),
+		'sizes': results,
+	}
+	if args.output:
+		with open(args.output, 'w') as f:
+			json.dump(report, f, indent='\t')
+	if baseline is not None:
+		regressions = compare_results(baseline, results, args.threshold)
+		for regression in regressions:
+			print(f'REGRESSION  {regression}')
+		if regressions:
+			sys.exit(1)
+		print('No regressions')
+
+if __name__ == '__main__':
+	main()
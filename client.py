@@ -0,0 +1,71 @@
+from util import OUTPUT_FORMATS, SERVER_SOCKET
+import argparse
+import json
+import os
+import socket
+import sys
+
+'''
+Thin client for server.py, a drop in for "python3 assembler.py -i ... -o ..." in build steps.
+It only imports what it needs to send one request, the assembler itself stays loaded in the server.
+
+	python3 client.py -i prog.txt -o prog.bin -f bin [--socket .datalore.sock]
+'''
+
+def send_request(request: dict, socket_path: str = SERVER_SOCKET) -> dict:
+	with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+		connection.connect(socket_path)
+		connection.sendall((json.dumps(request) + '\n').encode())
+		with connection.makefile('rb') as responses:
+			response = responses.readline()
+	if not response:
+		raise Exception('The server closed the connection without answering')
+	return json.loads(response)
+
+def parse_args():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-i', '--input', help='Input File Path', required=True)
+	parser.add_argument('-o', '--output', help='Output File Path', required=True)
+	parser.add_argument('-f', '--format', help='Output Format', choices=OUTPUT_FORMATS, default='text')
+	parser.add_argument('--base-address', help='Byte address the ihex image is loaded at', type=lambda value: int(value, 0), default=0)
+	parser.add_argument('-O', '--optimize', help='Enable an optimization pass (may be repeated)', action='append', default=[])
+	parser.add_argument('-l', '--listing', help='Write a listing to this file')
+	parser.add_argument('--cost-report', help='Write the words per source line, mnemonic and tag block to this file')
+	parser.add_argument('-s', '--stream', help='Assemble in a single streaming pass', action='store_true')
+	parser.add_argument('--compact', help='Hold the lowered program in compact columns', action='store_true')
+	parser.add_argument('--incremental', help='Reuse the lowered tag regions of the server cache directory', action='store_true')
+	parser.add_argument('-c', '--object', help='Write a relocatable object for linker.py', action='store_true')
+	parser.add_argument('--socket', help='Unix socket of the server', default=SERVER_SOCKET)
+	args = parser.parse_args()
+	return args
+
+def main():
+	# python3 client.py -i <input_file> -o <output_file> [-f text|bin]
+	args = parse_args()
+	# the server may run in another directory
+	request = {
+		'input': os.path.abspath(args.input),
+		'output': os.path.abspath(args.output),
+		'format': args.format,
+		'base_address': args.base_address,
+		'optimize': args.optimize,
+		'stream': args.stream,
+		'compact': args.compact,
+		'incremental': args.incremental,
+		'object': args.object,
+	}
+	if args.listing:
+		request['listing'] = os.path.abspath(args.listing)
+	if args.cost_report:
+		request['cost_report'] = os.path.abspath(args.cost_report)
+	try:
+		response = send_request(request, args.socket)
+	except OSError as e:
+		print(f'Cannot reach the assembler server on {args.socket}: {e.strerror}', file=sys.stderr)
+		sys.exit(2)
+	if not response['ok']:
+		print(response['error'], file=sys.stderr)
+		sys.exit(1)
+
+if __name__ == '__main__':
+	main()
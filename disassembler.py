@@ -0,0 +1,148 @@
+from assembler import *
+import argparse
+
+'''
+Disassembler for DataLore machine code.
+
+	python3 disassembler.py -i machine_code.txt [-f text|bin] [-o program.dis]
+	python3 disassembler.py --verify -i input.txt [-O sets ...]
+
+The assembler decodes every one of the 512 possible words once into its lowered form (RegMachineInstr,
+SetMachineInstr, MemMachineInstr or BrnMachineInstr), disassembling is then one table lookup per word. Branch
+targets are rebuilt from the SET/MEM preambles: the nibbles in R7 and the offset in data_mem[200]/[201] are followed
+along the straight-line code, which also finds the targets of branches whose preamble -O branches dropped.
+Targets are named @L<address>.
+
+--verify assembles the source, disassembles the words and compares the result with the lowered program
+of the assembler, branch targets against the tag addresses.
+'''
+
+# target name of a branch whose offset cannot be followed
+UNKNOWN_TAGNAME = '?'
+# mismatches printed by --verify
+VERIFY_REPORT_LIMIT = 20
+
+'''
+Returns the address every branch jumps to, by branch address. The target is None when the offset in
+data_mem[200]/[201] cannot be followed back to the SETs that produced it.
+'''
+def get_branch_targets(machine_instructions: [MachineInstruction]) -> dict:
+	targets = dict()
+	# nibbles of R7 by SET flag (False is the upper one) and the offset nibbles in data memory
+	r7 = {False: None, True: None}
+	mem_200 = None
+	mem_201 = None
+	for addr, machine_instr in enumerate(machine_instructions):
+		if isinstance(machine_instr, SetMachineInstr):
+			r7[machine_instr.flag] = int(machine_instr.imm, 2)
+		elif isinstance(machine_instr, BrnMachineInstr):
+			targets[addr] = None
+			if mem_200 is not None and mem_201 is not None:
+				offset = (mem_200 << 8) | mem_201
+				targets[addr] = addr + (offset - 0x1000 if offset & 0x800 else offset)
+		elif writes_reserved_register(machine_instr):
+			r7[False] = r7[True] = None
+		elif isinstance(machine_instr, MemMachineInstr) and not machine_instr.is_load:
+			from_r7 = machine_instr.target_reg == RESERVED_REGISTER_NAME
+			if machine_instr.target_location == '200':
+				mem_200 = r7[True] if from_r7 else None
+			elif machine_instr.target_location == '201':
+				mem_201 = (r7[False] << 4) | r7[True] if from_r7 and r7[False] is not None and r7[True] is not None else None
+			elif r7[False] is None or r7[True] is None or (r7[False] << 4) | r7[True] in (200, 201):
+				mem_200 = mem_201 = None
+	return targets
+
+def get_target_tagname(target: int) -> str:
+	return UNKNOWN_TAGNAME if target is None else f'L{target}'
+
+'''
+Returns the lowered instructions of machine_code with the branch targets filled in, and the address of
+every target by name
+'''
+def disassemble_machine_code(machine_code: [int]) -> ([MachineInstruction], dict):
+	machine_instructions = [DISASSEMBLY_TABLE[word] for word in machine_code]
+	for addr, machine_instr in enumerate(machine_instructions):
+		if machine_instr is None:
+			raise Exception(f'Invalid machine word {format_machine_word(machine_code[addr])} at address {addr}')
+	tag_addresses = dict()
+	for addr, target in get_branch_targets(machine_instructions).items():
+		branch = machine_instructions[addr]
+		tagname = get_target_tagname(target)
+		machine_instructions[addr] = BrnMachineInstr(mnemonic='BEQ', operand_reg1=branch.operand_reg1, operand_reg2=branch.operand_reg2, tagname=tagname)
+		if target is not None:
+			tag_addresses[tagname] = target
+	return machine_instructions, tag_addresses
+
+def format_disassembly(machine_instructions: [MachineInstruction], machine_code: [int], tag_addresses: dict) -> str:
+	tags = dict()
+	for tagname, addr in tag_addresses.items():
+		tags[addr] = tagname
+	# address, encoded word, lowered instruction, targets on a line of their own like in the source
+	lines = [f'{"addr":<6}{"word":<11}instruction']
+	for addr, (machine_instr, word) in enumerate(zip(machine_instructions, machine_code)):
+		if addr in tags:
+			lines.append(f'@{tags[addr]}:')
+		lines.append(f'{addr:<6}{format_machine_word(word):<11}{format_machine_instruction(machine_instr)}')
+	if len(machine_instructions) in tags:
+		lines.append(f'@{tags[len(machine_instructions)]}:')
+	lines.append('')
+	return '\n'.join(lines)
+
+'''
+Compares the disassembly of the encoded words with the lowered program they were encoded from and
+returns the mismatches, one message each
+'''
+def compare_disassembly(machine_instructions: [MachineInstruction], machine_code: [int], tag_addresses: dict) -> [str]:
+	if len(machine_instructions) != len(machine_code):
+		return [f'{len(machine_instructions)} instructions were encoded into {len(machine_code)} words']
+	mismatches = []
+	disassembled_instructions, _ = disassemble_machine_code(machine_code)
+	for addr, (expected, disassembled) in enumerate(zip(machine_instructions, disassembled_instructions)):
+		if isinstance(expected, BrnMachineInstr):
+			target = tag_addresses.get(expected.tagname)
+			expected = BrnMachineInstr(mnemonic='BEQ', operand_reg1=expected.operand_reg1, operand_reg2=expected.operand_reg2, tagname=get_target_tagname(target))
+		if disassembled != expected:
+			mismatches.append(f'address {addr}: expected {format_machine_instruction(expected)}, disassembled {format_machine_instruction(disassembled)}')
+	return mismatches
+
+def verify_source(source_file: str, args) -> ([str], int):
+	tag_addresses = dict()
+	cleaned_lines = get_source_lines(source_file, args)
+	machine_instructions, machine_code = assemble_program(cleaned_lines, args, ExpansionCache(), tag_addresses=tag_addresses)
+	if not isinstance(machine_code, list):
+		# the words come as a NumPy array when the vectorized encoder ran
+		machine_code = machine_code.tolist()
+	return compare_disassembly(machine_instructions, machine_code, tag_addresses), len(machine_code)
+
+def parse_args():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-i', '--input', help='Machine Code File Path, the source with --verify (- for stdin)', required=True)
+	parser.add_argument('-o', '--output', help='Disassembly File Path (- for stdout)', default=STANDARD_STREAM)
+	parser.add_argument('-f', '--format', help='Input Format', choices=INPUT_FORMATS, default='text')
+	parser.add_argument('--verify', help='Assemble the source, disassemble it and compare with the lowered program', action='store_true')
+	parser.add_argument('-O', '--optimize', help='Optimization pass for --verify (may be repeated)', action='append', choices=list(OPTIMIZATION_PASSES) + list(RESOLVED_OPTIMIZATION_PASSES) + list(SOURCE_OPTIMIZATION_PASSES), default=[])
+	args = parser.parse_args()
+	if args.optimize and not args.verify:
+		parser.error('-O needs --verify')
+	return args
+
+def main():
+	# python3 disassembler.py -i <machine_code_file> [-f text|bin] [-o <output_file>]
+	# python3 disassembler.py --verify -i <source_file> [-O <pass>]
+	args = parse_args()
+	if args.verify:
+		mismatches, words = verify_source(args.input, args)
+		for mismatch in mismatches[:VERIFY_REPORT_LIMIT]:
+			print(mismatch, file=sys.stderr)
+		if mismatches:
+			print(f'{len(mismatches)} of {words} words do not match', file=sys.stderr)
+			sys.exit(1)
+		print(f'Verified {words} words')
+		return
+	machine_code = read_machine_code(args.input, args.format)
+	machine_instructions, tag_addresses = disassemble_machine_code(machine_code)
+	with open_output(args.output, False) as f:
+		f.write(format_disassembly(machine_instructions, machine_code, tag_addresses))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,82 @@
+from assembler import *
+import argparse
+
+'''
+Linker for the relocatable objects of assembler.py --object.
+
+	python3 assembler.py --object -b 'modules/*.txt' -d build		# every module in its own process, unchanged ones are kept
+	python3 linker.py build/main.dlo build/motor.dlo -o firmware.txt [-f bin]
+
+The modules are placed one after the other in the order they are given, execution starts at the first word of
+the first module. Tags are global across the modules, except the local tags of macro expansions. A branch to a
+tag of another module gets the 3 offset nibbles written into the SET words of its preamble, the other words of
+the modules are copied as they are.
+'''
+
+@dataclass
+class LinkedModule:
+	object_file: str
+	module: ObjectModule
+	# address of the first word of the module in the image
+	base: int
+
+'''
+Returns the image address of every exported tag, a tag defined by two modules is an error
+'''
+def get_link_symbols(linked_modules: [LinkedModule]) -> dict:
+	symbols = dict()
+	owners = dict()
+	for linked in linked_modules:
+		for tagname, addr in linked.module.tags.items():
+			if tagname in symbols:
+				raise Exception(f'Tag {tagname} is defined in {owners[tagname]} and {linked.object_file}')
+			symbols[tagname] = linked.base + addr
+			owners[tagname] = linked.object_file
+	return symbols
+
+def patch_branch_nibbles(machine_code: [int], fixup: BranchFixup, tag_address: int, base: int):
+	nibbles = get_branch_offset_nibbles(tag_address - (base + fixup.address))
+	for slot, nibble in zip(PREAMBLE_NIBBLE_SLOTS, nibbles):
+		addr = base + fixup.preamble[slot]
+		machine_code[addr] = (machine_code[addr] & ~0b1111) | SET_NIBBLES[nibble]
+
+def link_modules(object_files: [str], modules: [ObjectModule]) -> [int]:
+	linked_modules = []
+	base = 0
+	for object_file, module in zip(object_files, modules):
+		linked_modules.append(LinkedModule(object_file=object_file, module=module, base=base))
+		base += len(module.words)
+	symbols = get_link_symbols(linked_modules)
+	machine_code = []
+	for linked in linked_modules:
+		machine_code += linked.module.words
+	for linked in linked_modules:
+		for fixup in linked.module.fixups:
+			if fixup.tagname not in symbols:
+				raise Exception(f'{linked.object_file}: Invalid tag: {fixup.tagname}')
+			try:
+				patch_branch_nibbles(machine_code, fixup, symbols[fixup.tagname], linked.base)
+			except Exception as e:
+				raise Exception(f'{linked.object_file}: branch to {fixup.tagname}: {e}')
+	return machine_code
+
+def parse_args():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('objects', help=f'Object files ({OBJECT_EXTENSION}) in image order', nargs='+')
+	parser.add_argument('-o', '--output', help='Output File Path (- for stdout)', required=True)
+	parser.add_argument('-f', '--format', help='Output Format', choices=OUTPUT_FORMATS, default='text')
+	parser.add_argument('--base-address', help='Byte address the ihex image is loaded at', type=lambda value: int(value, 0), default=0)
+	args = parser.parse_args()
+	if args.base_address < 0:
+		parser.error(f'Invalid base address: {args.base_address}')
+	return args
+
+def main():
+	# python3 linker.py <object_file> ... -o <output_file> [-f text|bin]
+	args = parse_args()
+	modules = [read_object_file(object_file) for object_file in args.objects]
+	machine_code = link_modules(args.objects, modules)
+	write_machine_code(args.output, machine_code, args.format, args.base_address)
+
+if __name__ == '__main__':
+	main()
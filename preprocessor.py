@@ -0,0 +1,182 @@
+from dataclasses import dataclass
+from util import get_lines, STANDARD_STREAM
+import os
+import re
+
+'''
+Preprocessor for .include and .macro, it runs on the raw source lines in front of the lexer.
+
+	.include "common.txt"		// path relative to the including file
+	.macro COUNTDOWN reg, step
+	@again:						// tags defined in a macro are local to every expansion
+	SUB \reg, \step
+	BEQ \reg, R0, again
+	.endm
+	COUNTDOWN R1, #1
+
+Every line that is passed on carries the number of the top level source line it came from, so errors
+and listings inside includes and macros point at the .include or the macro call.
+Included files are read once per run. The body of a macro is instantiated once per distinct argument list,
+later calls only number their local tags, and the identical lines hit the expansion cache of the assembler.
+'''
+
+INCLUDE_DIRECTIVE = '.include'
+MACRO_DIRECTIVE = '.macro'
+END_MACRO_DIRECTIVE = '.endm'
+# bounds the nesting of includes and macro calls, a macro that calls itself never terminates
+MAX_EXPANSION_DEPTH = 64
+
+MACRO_NAME_PATTERN = re.compile(r'[A-Za-z_]\w*')
+PARAMETER_PATTERN = re.compile(r'\\(\w+)')
+TOKEN_SEPARATOR_PATTERN = re.compile(r'\s*,\s*|\s+')
+# stands for the expansion number in the local tags of an instantiated macro body
+LOCAL_TAG_MARK = '\0'
+# tag name of a local tag once its expansion is numbered
+LOCAL_TAGNAME_PATTERN = re.compile(r'[A-Za-z_][\w.]*\.[A-Z_][A-Z0-9_]*\.\d+')
+
+@dataclass
+class Macro:
+	name: str
+	parameters: [str]
+	body: [str]
+	# tags defined in the body, renamed in every expansion
+	local_tags: frozenset
+
+def get_statement(line: str) -> str:
+	return line.partition('//')[0].strip()
+
+def get_tag_definition(statement: str) -> str:
+	return statement[1:].rstrip(':')
+
+def get_local_tagname(tagname: str, macro: Macro) -> str:
+	return f'{tagname}.{macro.name}.{LOCAL_TAG_MARK}'
+
+def is_local_tagname(tagname: str) -> bool:
+	return LOCAL_TAGNAME_PATTERN.fullmatch(tagname) is not None
+
+class Preprocessor:
+	def __init__(self, reserved_names: frozenset = frozenset()):
+		# mnemonics, a macro may not hide one of them
+		self.reserved_names = reserved_names
+		self.macros = dict()
+		self.included_files = dict()
+		# (macro name, arguments) -> instantiated body
+		self.instances = dict()
+		# number of macro calls so far, it tells the local tags of every expansion apart
+		self.expansions = 0
+
+	'''
+	Yields (line number, line) for every line of filename once the directives and macro calls are expanded.
+	The lines are read from the file unless they are given.
+	'''
+	def preprocess(self, filename: str, lines: [str] = None) -> [(int, str)]:
+		directory = '' if filename == STANDARD_STREAM else os.path.dirname(filename)
+		if lines is None:
+			lines = get_lines(filename)
+		yield from self.preprocess_lines(lines, filename, directory, None, 0)
+
+	'''
+	source names the lines in error messages, directory is where their includes are looked up
+	'''
+	def preprocess_lines(self, lines: [str], source: str, directory: str, origin: int, depth: int) -> [(int, str)]:
+		if depth > MAX_EXPANSION_DEPTH:
+			raise Exception(f'line {origin}: includes or macro calls are nested more than {MAX_EXPANSION_DEPTH} deep')
+		numbered_lines = enumerate(lines, 1)
+		for line_number, line in numbered_lines:
+			location = line_number if origin is None else origin
+			# plain lines go straight through until the first macro is defined
+			if not self.macros and ('.' not in line or not line.lstrip().startswith('.')):
+				yield location, line
+				continue
+			statement = get_statement(line)
+			tokens = statement.split(None, 1)
+			if not tokens:
+				continue
+			directive = tokens[0].lower()
+			arguments = tokens[1] if len(tokens) > 1 else ''
+			if directive == INCLUDE_DIRECTIVE:
+				included_file = self.get_included_file(arguments, directory, f'{source}:{line_number}')
+				yield from self.preprocess_lines(self.get_included_lines(included_file), included_file, os.path.dirname(included_file), location, depth + 1)
+			elif directive == MACRO_DIRECTIVE:
+				self.define_macro(arguments, numbered_lines, f'{source}:{line_number}')
+			elif directive == END_MACRO_DIRECTIVE:
+				raise Exception(f'{source}:{line_number}: {END_MACRO_DIRECTIVE} without {MACRO_DIRECTIVE}')
+			elif directive.startswith('.'):
+				raise Exception(f'{source}:{line_number}: Invalid directive: {tokens[0]}')
+			elif directive.upper() in self.macros:
+				macro = self.macros[directive.upper()]
+				body = self.instantiate_macro(macro, TOKEN_SEPARATOR_PATTERN.split(arguments) if arguments else [], f'{source}:{line_number}')
+				self.expansions += 1
+				suffix = str(self.expansions)
+				expansion = [line.replace(LOCAL_TAG_MARK, suffix) for line in body]
+				yield from self.preprocess_lines(expansion, f'{source}:{line_number} ({macro.name})', directory, location, depth + 1)
+			else:
+				yield location, line
+
+	def get_included_file(self, arguments: str, directory: str, location: str) -> str:
+		path = arguments.strip().strip('"')
+		if not path:
+			raise Exception(f'{location}: {INCLUDE_DIRECTIVE} needs a file name')
+		return os.path.normpath(os.path.join(directory, path))
+
+	def get_included_lines(self, included_file: str) -> [str]:
+		lines = self.included_files.get(included_file)
+		if lines is None:
+			try:
+				lines = self.included_files[included_file] = list(get_lines(included_file))
+			except OSError as e:
+				raise Exception(f'Cannot include {included_file}: {e.strerror}')
+		return lines
+
+	def define_macro(self, arguments: str, numbered_lines, location: str):
+		tokens = TOKEN_SEPARATOR_PATTERN.split(arguments) if arguments else []
+		if not tokens or not MACRO_NAME_PATTERN.fullmatch(tokens[0]):
+			raise Exception(f'{location}: {MACRO_DIRECTIVE} needs a name')
+		name = tokens[0].upper()
+		if name in self.reserved_names:
+			raise Exception(f'{location}: Macro {name} would hide the instruction of the same name')
+		if name in self.macros:
+			raise Exception(f'{location}: Macro {name} is already defined')
+		body = []
+		for _, line in numbered_lines:
+			statement = get_statement(line)
+			directive = statement.split(None, 1)[0].lower() if statement else ''
+			if directive == END_MACRO_DIRECTIVE:
+				break
+			if directive == MACRO_DIRECTIVE:
+				raise Exception(f'{location}: Macro {name} defines another macro')
+			body.append(statement)
+		else:
+			raise Exception(f'{location}: Macro {name} has no {END_MACRO_DIRECTIVE}')
+		local_tags = frozenset(get_tag_definition(statement) for statement in body if statement.startswith('@'))
+		self.macros[name] = Macro(name=name, parameters=tokens[1:], body=body, local_tags=local_tags)
+
+	'''
+	Returns the body of macro with the arguments substituted and the local tags marked for numbering
+	'''
+	def instantiate_macro(self, macro: Macro, arguments: [str], location: str) -> [str]:
+		key = (macro.name, tuple(arguments))
+		body = self.instances.get(key)
+		if body is not None:
+			return body
+		if len(arguments) != len(macro.parameters):
+			raise Exception(f'{location}: Macro {macro.name} takes {len(macro.parameters)} arguments, got {len(arguments)}')
+		values = dict(zip(macro.parameters, arguments))
+		def substitute(match: re.Match) -> str:
+			if match.group(1) not in values:
+				raise Exception(f'{location}: Macro {macro.name} has no parameter {match.group(1)}')
+			return values[match.group(1)]
+		body = []
+		for statement in macro.body:
+			statement = PARAMETER_PATTERN.sub(substitute, statement)
+			if statement.startswith('@'):
+				tagname = get_tag_definition(statement)
+				if tagname in macro.local_tags:
+					statement = f'@{get_local_tagname(tagname, macro)}:'
+			elif macro.local_tags and statement:
+				tokens = TOKEN_SEPARATOR_PATTERN.split(statement)
+				operands = [get_local_tagname(token, macro) if token in macro.local_tags else token for token in tokens[1:]]
+				statement = ' '.join([tokens[0], ', '.join(operands)]) if operands else tokens[0]
+			body.append(statement)
+		self.instances[key] = body
+		return body
@@ -0,0 +1,139 @@
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, asdict
+import json
+import sys
+import time
+
+'''
+Per-stage instrumentation for the assembler (enabled with --profile).
+
+Stages are either blocks of code (Profiler.stage) or generators (Profiler.iterate). Time and memory are
+charged exclusively: while a stage pulls items out of an upstream generator, that time is charged to the
+upstream stage. A disabled profiler hands back the iterables untouched and a shared null context, so the
+instrumented pipeline costs next to nothing when the flag is off.
+'''
+
+PROFILE_FORMATS = ['text', 'json']
+
+@dataclass
+class StageProfile:
+	name: str
+	seconds: float = 0.0
+	items: int = 0
+	# net change in allocated memory blocks (sys.getallocatedblocks) while the stage was running
+	allocated_blocks: int = 0
+
+@dataclass
+class ExpansionProfile:
+	mnemonic: str
+	source_instructions: int = 0
+	machine_words: int = 0
+
+class Profiler:
+	def __init__(self, enabled: bool = True):
+		self.enabled = enabled
+		self.stages = dict()
+		self.expansions = dict()
+		self.stack = []
+		self.start_time = time.perf_counter()
+		self.mark_time = self.start_time
+		self.mark_blocks = sys.getallocatedblocks()
+
+	def get_stage(self, name: str) -> StageProfile:
+		stage = self.stages.get(name)
+		if stage is None:
+			stage = self.stages[name] = StageProfile(name=name)
+		return stage
+
+	def charge(self):
+		now = time.perf_counter()
+		blocks = sys.getallocatedblocks()
+		if self.stack:
+			stage = self.stages[self.stack[-1]]
+			stage.seconds += now - self.mark_time
+			stage.allocated_blocks += blocks - self.mark_blocks
+		self.mark_time = now
+		self.mark_blocks = blocks
+
+	def enter(self, name: str):
+		self.charge()
+		self.get_stage(name)
+		self.stack.append(name)
+
+	def exit(self):
+		self.charge()
+		self.stack.pop()
+
+	def stage(self, name: str):
+		if not self.enabled:
+			return nullcontext()
+		return self.timed_stage(name)
+
+	@contextmanager
+	def timed_stage(self, name: str):
+		self.enter(name)
+		try:
+			yield
+		finally:
+			self.exit()
+
+	def iterate(self, name: str, iterable):
+		if not self.enabled:
+			return iterable
+		return self.timed_iterate(name, iterable)
+
+	def timed_iterate(self, name: str, iterable):
+		iterator = iter(iterable)
+		stage = self.get_stage(name)
+		while True:
+			self.enter(name)
+			try:
+				item = next(iterator)
+			except StopIteration:
+				return
+			finally:
+				self.exit()
+			stage.items += 1
+			yield item
+
+	def add_items(self, name: str, count: int):
+		if self.enabled:
+			self.get_stage(name).items += count
+
+	def count_expansion(self, mnemonic: str, machine_words: int):
+		expansion = self.expansions.get(mnemonic)
+		if expansion is None:
+			expansion = self.expansions[mnemonic] = ExpansionProfile(mnemonic=mnemonic)
+		expansion.source_instructions += 1
+		expansion.machine_words += machine_words
+
+	def get_report(self) -> dict:
+		return {
+			'total_seconds': time.perf_counter() - self.start_time,
+			'stages': [asdict(stage) for stage in self.stages.values()],
+			'expansions': [asdict(expansion) for expansion in sorted(self.expansions.values(), key=lambda expansion: expansion.machine_words, reverse=True)],
+		}
+
+	def format_report(self) -> str:
+		report = self.get_report()
+		total = report['total_seconds']
+		lines = [f'{"stage":<20}{"time (ms)":>12}{"share":>8}{"items":>12}{"alloc blocks":>14}']
+		for stage in report['stages']:
+			share = stage['seconds'] / total * 100 if total > 0 else 0
+			lines.append(f'{stage["name"]:<20}{stage["seconds"] * 1000:>12.2f}{share:>7.1f}%{stage["items"]:>12}{stage["allocated_blocks"]:>14}')
+		lines.append(f'{"total":<20}{total * 1000:>12.2f}')
+		if report['expansions']:
+			lines.append('')
+			lines.append(f'{"mnemonic":<20}{"source":>12}{"words":>12}{"words/source":>14}')
+			for expansion in report['expansions']:
+				ratio = expansion['machine_words'] / expansion['source_instructions']
+				lines.append(f'{expansion["mnemonic"]:<20}{expansion["source_instructions"]:>12}{expansion["machine_words"]:>12}{ratio:>14.2f}')
+		return '\n'.join(lines)
+
+	def print_report(self, profile_format: str = 'text', file=sys.stderr):
+		if profile_format == 'json':
+			print(json.dumps(self.get_report()), file=file)
+		else:
+			print(self.format_report(), file=file)
+
+DISABLED_PROFILER = Profiler(enabled=False)
@@ -0,0 +1,145 @@
+from assembler import *
+import argparse
+import json
+import signal
+import socketserver
+
+'''
+Long running assembler, it saves the interpreter start, the imports and the table setup of a
+fresh assembler.py process per file. The expansion cache, the lexer cache and the region cache stay
+warm across requests. Requests are served one at a time.
+
+	python3 server.py							# JSON lines on stdin, responses on stdout
+	python3 server.py --socket .datalore.sock	# JSON lines over a unix socket, see client.py
+
+Request, one JSON object per line, input is a source path and source an inline program:
+
+	{"id": 1, "input": "prog.txt", "output": "prog.bin", "format": "bin", "optimize": ["sets"]}
+	{"id": 2, "source": "ZER R1\nADD R1, #3\n"}
+
+Response, machine_code is only sent back when there is no output file and saved_words only with -O peephole:
+
+	{"id": 1, "ok": true, "words": 52, "seconds": 0.004}
+	{"id": 2, "ok": true, "words": 4, "machine_code": [...], "seconds": 0.001}
+	{"id": 3, "ok": false, "error": "Invalid tag: done"}
+'''
+
+# per request options and their defaults, named like the assembler.py flags
+REQUEST_OPTIONS = {'format': 'text', 'base_address': 0, 'optimize': [], 'stream': False, 'compact': False, 'incremental': False, 'listing': None, 'cost_report': None, 'cost_top': COST_REPORT_TOP, 'object': False}
+REQUEST_FIELDS = frozenset(REQUEST_OPTIONS) | {'id', 'input', 'source', 'output'}
+# names an inline source in error messages, its includes are relative to the working directory of the server
+INLINE_SOURCE_NAME = '<source>'
+
+class AssemblerServer:
+	def __init__(self, cache_size: int = EXPANSION_CACHE_SIZE, cache_dir: str = REGION_CACHE_DIR):
+		self.cache = ExpansionCache(cache_size)
+		# --compact keeps CompactLine entries under the same line keys, so it gets a cache of its own
+		self.compact_cache = ExpansionCache(cache_size)
+		self.cache_dir = cache_dir
+		self.region_cache = None
+		self.requests = 0
+
+	def get_region_cache(self) -> RegionCache:
+		if self.region_cache is None:
+			self.region_cache = RegionCache(self.cache_dir)
+		return self.region_cache
+
+	def get_cache(self, args) -> ExpansionCache:
+		return self.compact_cache if args.compact else self.cache
+
+	def assemble(self, request: dict) -> dict:
+		unknown = set(request) - REQUEST_FIELDS
+		if unknown:
+			raise Exception(f'Invalid request fields: {", ".join(sorted(unknown))}')
+		if ('input' in request) == ('source' in request):
+			raise Exception('A request needs either an input or a source')
+		args = argparse.Namespace(**{name: request.get(name, default) for name, default in REQUEST_OPTIONS.items()})
+		check_options(args)
+		# stdin carries the requests and stdout the responses, a file of - would corrupt them
+		for name in ('input', 'output', 'listing', 'cost_report'):
+			if request.get(name) == STANDARD_STREAM:
+				raise Exception(f'Invalid {name} for a server request: {STANDARD_STREAM}')
+		cache = self.get_cache(args)
+		region_cache = self.get_region_cache() if args.incremental else None
+		peephole = PeepholeOptimizer() if 'peephole' in args.optimize else None
+		lines = request['source'].splitlines() if 'source' in request else None
+		source_file = request.get('input', INLINE_SOURCE_NAME)
+		if 'input' in request:
+			check_output_files(source_file, [request.get('output'), args.listing, args.cost_report])
+		if args.object:
+			if 'output' not in request:
+				raise Exception('An object request needs an output')
+			response = {'words': assemble_object_file(source_file, request['output'], args, cache, region_cache, lines=lines, peephole=peephole)}
+		else:
+			machine_code = assemble_source(source_file, args, cache, region_cache, lines=lines, peephole=peephole)
+			if 'output' in request:
+				response = {'words': write_machine_code(request['output'], machine_code, args.format, args.base_address)}
+			else:
+				# NumPy and compact arrays convert to plain ints in one call
+				machine_code = machine_code.tolist() if hasattr(machine_code, 'tolist') else list(machine_code)
+				response = {'words': len(machine_code), 'machine_code': machine_code}
+		if peephole is not None:
+			response['saved_words'] = peephole.saved_words
+		return response
+
+	def handle(self, line: str) -> str:
+		start = time.perf_counter()
+		self.requests += 1
+		request_id = None
+		try:
+			request = json.loads(line)
+			if not isinstance(request, dict):
+				raise Exception('A request is a JSON object')
+			request_id = request.get('id')
+			response = {'id': request_id, 'ok': True, **self.assemble(request)}
+		except Exception as e:
+			response = {'id': request_id, 'ok': False, 'error': str(e)}
+		response['seconds'] = time.perf_counter() - start
+		return json.dumps(response)
+
+	def serve_lines(self, lines: [str], output):
+		for line in lines:
+			if line.strip():
+				output.write(self.handle(line) + '\n')
+				output.flush()
+
+def serve_socket(server: AssemblerServer, socket_path: str):
+	class RequestHandler(socketserver.StreamRequestHandler):
+		def handle(self):
+			for line in self.rfile:
+				if line.strip():
+					self.wfile.write((server.handle(line) + '\n').encode())
+	# a socket left behind by a server that was killed
+	if os.path.exists(socket_path):
+		os.remove(socket_path)
+	try:
+		with socketserver.UnixStreamServer(socket_path, RequestHandler) as unix_server:
+			unix_server.serve_forever()
+	finally:
+		if os.path.exists(socket_path):
+			os.remove(socket_path)
+
+def parse_args():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--socket', help=f'Listen on this unix socket instead of stdin (default: {SERVER_SOCKET})', nargs='?', const=SERVER_SOCKET)
+	parser.add_argument('--cache-size', help='Number of distinct source lines kept in the expansion cache', type=int, default=EXPANSION_CACHE_SIZE)
+	parser.add_argument('--cache-dir', help='Directory of the incremental cache', default=REGION_CACHE_DIR)
+	args = parser.parse_args()
+	return args
+
+def main():
+	# python3 server.py [--socket [<path>]]
+	args = parse_args()
+	server = AssemblerServer(args.cache_size, args.cache_dir)
+	if args.socket:
+		# exit through the finally of serve_socket so the socket file is removed
+		signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+		try:
+			serve_socket(server, args.socket)
+		except KeyboardInterrupt:
+			pass
+	else:
+		server.serve_lines(sys.stdin, sys.stdout)
+
+if __name__ == '__main__':
+	main()
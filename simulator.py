@@ -0,0 +1,192 @@
+from dataclasses import dataclass
+from util import *
+import argparse
+import json
+
+'''
+Instruction set simulator for DataLore machine code.
+
+Registers and data memory are 8 bits wide. The semantics follow how assembler.py lowers programs:
+
+MEM		load/store the target register from/to data_mem[R7], data_mem[200] or data_mem[201]
+ADD		dest = dest + src
+AND		dest = dest & src
+XOR		dest = dest ^ src
+ROL		dest = dest rotated left by src (mod 8)
+BEQ		if (r1 == r2) PC += the 12 bit two's complement offset in data_mem[200][3:0]:data_mem[201]
+SET		flag 0 writes the upper nibble of R7, flag 1 the lower nibble
+MOV		dest = src
+
+Every one of the 512 possible words is decoded once into a handler up front, running a program is
+then one table lookup and one call per cycle.
+'''
+
+REGISTER_COUNT = 8
+DATA_MEMORY_SIZE = 256
+BYTE_MASK = 0xFF
+BRANCH_OFFSET_HIGH_ADDRESS = 200
+BRANCH_OFFSET_LOW_ADDRESS = 201
+DEFAULT_MAX_CYCLES = 10_000_000
+RESERVED_REGISTER = 7
+
+@dataclass
+class SimulationResult:
+	cycles: int
+	halted: bool
+	pc: int
+	registers: [int]
+	data_memory: bytearray
+	# number of times each instruction address was executed
+	pc_hits: [int]
+
+def get_fields(word: int) -> (int, int, int):
+	return word >> 6, (word >> 3) & 0b111, word & 0b111
+
+def decode_mem(word: int):
+	_, target_reg, low = get_fields(word)
+	is_store = (low >> 2) & 1
+	location = low & 0b11
+	if location == 0b00:
+		get_address = lambda regs: regs[RESERVED_REGISTER]
+	elif location == 0b01:
+		get_address = lambda regs: BRANCH_OFFSET_HIGH_ADDRESS
+	elif location == 0b10:
+		get_address = lambda regs: BRANCH_OFFSET_LOW_ADDRESS
+	else:
+		return None
+	if is_store:
+		def handler(regs, mem, pc):
+			mem[get_address(regs)] = regs[target_reg]
+			return pc + 1
+	else:
+		def handler(regs, mem, pc):
+			regs[target_reg] = mem[get_address(regs)]
+			return pc + 1
+	return handler
+
+def decode_alu(word: int):
+	opcode, dest_reg, src_reg = get_fields(word)
+	if opcode == 0b001:
+		def handler(regs, mem, pc):
+			regs[dest_reg] = (regs[dest_reg] + regs[src_reg]) & BYTE_MASK
+			return pc + 1
+	elif opcode == 0b010:
+		def handler(regs, mem, pc):
+			regs[dest_reg] = regs[dest_reg] & regs[src_reg]
+			return pc + 1
+	elif opcode == 0b011:
+		def handler(regs, mem, pc):
+			regs[dest_reg] = regs[dest_reg] ^ regs[src_reg]
+			return pc + 1
+	elif opcode == 0b100:
+		def handler(regs, mem, pc):
+			value = regs[dest_reg]
+			shamt = regs[src_reg] % 8
+			regs[dest_reg] = ((value << shamt) | (value >> (8 - shamt))) & BYTE_MASK
+			return pc + 1
+	else:
+		def handler(regs, mem, pc):
+			regs[dest_reg] = regs[src_reg]
+			return pc + 1
+	return handler
+
+def decode_beq(word: int):
+	_, operand_reg1, operand_reg2 = get_fields(word)
+	def handler(regs, mem, pc):
+		if regs[operand_reg1] != regs[operand_reg2]:
+			return pc + 1
+		offset = ((mem[BRANCH_OFFSET_HIGH_ADDRESS] & 0x0F) << 8) | mem[BRANCH_OFFSET_LOW_ADDRESS]
+		if offset & 0x800:
+			offset -= 0x1000
+		return pc + offset
+	return handler
+
+def decode_set(word: int):
+	is_lower = (word >> 4) & 1
+	imm = word & 0x0F
+	if is_lower:
+		def handler(regs, mem, pc):
+			regs[RESERVED_REGISTER] = (regs[RESERVED_REGISTER] & 0xF0) | imm
+			return pc + 1
+	else:
+		def handler(regs, mem, pc):
+			regs[RESERVED_REGISTER] = (regs[RESERVED_REGISTER] & 0x0F) | (imm << 4)
+			return pc + 1
+	return handler
+
+# by opcode
+DECODERS = [decode_mem, decode_alu, decode_alu, decode_alu, decode_alu, decode_beq, decode_set, decode_alu]
+
+def decode_word(word: int):
+	return DECODERS[word >> 6](word)
+
+# handler for every possible 9 bit word, None for words that are not valid instructions
+DECODE_TABLE = [decode_word(word) for word in range(1 << WORD_BITS)]
+
+def predecode(machine_code: [int]) -> list:
+	program = []
+	for pc, word in enumerate(machine_code):
+		handler = DECODE_TABLE[word]
+		if handler is None:
+			raise Exception(f'Invalid machine word {format_machine_word(word)} at address {pc}')
+		program.append(handler)
+	return program
+
+'''
+Runs until the PC leaves the program or max_cycles instructions have been executed
+'''
+def simulate(machine_code: [int], max_cycles: int = DEFAULT_MAX_CYCLES, registers: [int] = None, data_memory: bytearray = None) -> SimulationResult:
+	program = predecode(machine_code)
+	regs = list(registers) if registers is not None else [0] * REGISTER_COUNT
+	mem = bytearray(data_memory) if data_memory is not None else bytearray(DATA_MEMORY_SIZE)
+	pc_hits = [0] * len(program)
+	program_length = len(program)
+	pc = 0
+	cycles = 0
+	while 0 <= pc < program_length and cycles < max_cycles:
+		pc_hits[pc] += 1
+		pc = program[pc](regs, mem, pc)
+		cycles += 1
+	halted = not (0 <= pc < program_length)
+	return SimulationResult(cycles=cycles, halted=halted, pc=pc, registers=regs, data_memory=mem, pc_hits=pc_hits)
+
+def get_hot_addresses(result: SimulationResult, count: int) -> [(int, int)]:
+	hits = [(pc, hits) for pc, hits in enumerate(result.pc_hits) if hits > 0]
+	hits.sort(key=lambda item: item[1], reverse=True)
+	return hits[:count]
+
+def print_simulation_result(result: SimulationResult, machine_code: [int], hot_count: int):
+	status = 'halted' if result.halted else 'stopped at the cycle limit'
+	print(f'{status} after {result.cycles} cycles, pc = {result.pc}')
+	print('registers: ' + ' '.join(f'R{i}={value}' for i, value in enumerate(result.registers)))
+	for pc, hits in get_hot_addresses(result, hot_count):
+		print(f'{pc:6d}  {format_machine_word(machine_code[pc])}  {hits}')
+
+def parse_args():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-i', '--input', help='Machine Code File Path (- for stdin)', required=True)
+	parser.add_argument('-f', '--format', help='Input Format', choices=INPUT_FORMATS, default='text')
+	parser.add_argument('-c', '--max-cycles', help='Stop after this many cycles', type=int, default=DEFAULT_MAX_CYCLES)
+	parser.add_argument('-t', '--top', help='Number of most executed addresses to report', type=int, default=10)
+	parser.add_argument('--json', help='Print the result as JSON', action='store_true')
+	args = parser.parse_args()
+	return args
+
+def main():
+	# python3 simulator.py -i <machine_code_file> [-f text|bin] [-c <max_cycles>]
+	args = parse_args()
+	machine_code = read_machine_code(args.input, args.format)
+	result = simulate(machine_code, args.max_cycles)
+	if args.json:
+		print(json.dumps({
+			'cycles': result.cycles,
+			'halted': result.halted,
+			'pc': result.pc,
+			'registers': result.registers,
+			'pc_hits': result.pc_hits,
+		}))
+	else:
+		print_simulation_result(result, machine_code, args.top)
+
+if __name__ == '__main__':
+	main()
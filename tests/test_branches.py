@@ -0,0 +1,98 @@
+from assembler import *
+from simulator import simulate, RESERVED_REGISTER
+import argparse
+import itertools
+import pytest
+
+'''
+-O branches drops the preamble stores that rewrite the offset already in data_mem[200]/[201]. Every program is
+run in the simulator with and without the pass, for every assignment of 0-2 to R1-R6, and must halt with the
+same registers and data memory. R7 is the scratch register and data_mem[200]/[201] hold the offset of the last
+branch, which moves with the layout, so they are not compared.
+'''
+
+# (program, words the pass drops)
+PROGRAMS = {
+	# the second preamble is dropped, which moves @a and changes the offset of the first branch
+	'offset': ([
+		'ADD R3, #1',
+		'BEQ R1, R2, a',
+		'BEQ R1, R4, b',
+		'@a',
+		'ADD R3, #2',
+		'@b',
+		'ADD R6, #1',
+	], 2),
+	# both preambles store the same offset, but @t can be reached from the backward branch with another one
+	'tag': ([
+		'ZER R5',
+		'BEQ R1, R2, a',
+		'@t',
+		'BEQ R1, R3, b',
+		'@a',
+		'ADD R4, #1',
+		'ADD R4, #2',
+		'@b',
+		'ADD R5, #1',
+		'BEQ R5, R6, t',
+		'ADD R4, #4',
+	], 0),
+	# the same program without @t, the second preamble is dropped
+	'untagged': ([
+		'ZER R5',
+		'BEQ R1, R2, a',
+		'BEQ R1, R3, b',
+		'@a',
+		'ADD R4, #1',
+		'ADD R4, #2',
+		'@b',
+		'ADD R5, #1',
+		'BEQ R5, R6, b',
+		'ADD R4, #4',
+	], 2),
+	# two backward branches with the same offset
+	'backward': ([
+		'ZER R5',
+		'@t1',
+		'ADD R5, #1',
+		'ADD R5, #2',
+		'@t2',
+		'ADD R4, #1',
+		'ADD R4, #2',
+		'BEQ R5, R6, t1',
+		'BEQ R3, R4, t2',
+		'ADD R2, #4',
+	], 2),
+}
+
+def get_args(optimize: [str]) -> argparse.Namespace:
+	return argparse.Namespace(optimize=optimize, stream=False, compact=False, incremental=False, listing=None, cost_report=None, cost_top=COST_REPORT_TOP, object=False)
+
+def assemble(lines: [str], optimize: [str]) -> ([int], dict):
+	args = get_args(optimize)
+	tag_addresses = {}
+	_, words = assemble_program(get_source_lines(STANDARD_STREAM, args, lines=lines), args, ExpansionCache(), tag_addresses=tag_addresses)
+	return list(words), tag_addresses
+
+def get_final_state(words: [int], registers: [int]) -> ([int], bytearray):
+	result = simulate(words, registers=registers)
+	assert result.halted
+	data_memory = bytearray(result.data_memory)
+	data_memory[200] = data_memory[201] = 0
+	return result.registers[:RESERVED_REGISTER], data_memory
+
+@pytest.mark.parametrize('name', PROGRAMS)
+def test_branches_keep_final_state(name: str):
+	lines, dropped_words = PROGRAMS[name]
+	words, _ = assemble(lines, [])
+	optimized_words, _ = assemble(lines, ['branches'])
+	assert len(words) - len(optimized_words) == dropped_words
+	for values in itertools.product(range(3), repeat=RESERVED_REGISTER - 1):
+		registers = [0, *values, 0]
+		assert get_final_state(optimized_words, registers) == get_final_state(words, registers)
+
+def test_dropped_slots_move_the_tags():
+	lines, _ = PROGRAMS['offset']
+	_, tag_addresses = assemble(lines, [])
+	_, optimized_tag_addresses = assemble(lines, ['branches'])
+	assert optimized_tag_addresses == {tagname: address - 2 for tagname, address in tag_addresses.items()}
@@ -0,0 +1,23 @@
+from disassembler import *
+import argparse
+import os
+import pytest
+
+INPUT_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'input.txt')
+
+@pytest.mark.parametrize('optimize', [[], ['sets'], ['branches'], ['peephole'], ['peephole', 'sets', 'branches']])
+def test_verify_input(optimize: [str]):
+	mismatches, words = verify_source(INPUT_FILE, argparse.Namespace(optimize=optimize))
+	assert words > 0
+	assert mismatches == []
+
+def test_verify_reports_a_changed_word():
+	args = argparse.Namespace(optimize=[])
+	tag_addresses = dict()
+	machine_instructions, machine_code = assemble_program(get_source_lines(INPUT_FILE, args), args, ExpansionCache(), tag_addresses=tag_addresses)
+	machine_code = list(machine_code)
+	addr = next(addr for addr, machine_instr in enumerate(machine_instructions) if isinstance(machine_instr, RegMachineInstr))
+	machine_code[addr] ^= 1
+	mismatches = compare_disassembly(machine_instructions, machine_code, tag_addresses)
+	assert len(mismatches) == 1
+	assert mismatches[0].startswith(f'address {addr}: expected ')
@@ -0,0 +1,76 @@
+from util import *
+import pytest
+
+'''
+Every output format is written and read back. text and bin are read with read_machine_code, the formats the
+tools do not read are parsed here.
+'''
+
+# every word value, long enough to need several write chunks and Intel HEX segments
+MACHINE_CODE = list(range(1 << WORD_BITS)) * 200
+# not aligned to a 64 KiB segment, the image crosses the next segment boundary
+IHEX_BASE_ADDRESS = 0x1FFF0
+
+def write(tmp_path, output_format: str, machine_code, base_address: int = 0) -> str:
+	output_file = str(tmp_path / f'out{OUTPUT_EXTENSIONS[output_format]}')
+	assert write_machine_code(output_file, machine_code, output_format, base_address) == len(machine_code)
+	return output_file
+
+def read_intel_hex(input_file: str) -> (int, bytes):
+	upper = 0
+	data = dict()
+	with open(input_file) as f:
+		lines = f.read().splitlines()
+	assert lines[-1] == ':00000001FF'
+	for line in lines[:-1]:
+		assert line.startswith(':')
+		record = bytes.fromhex(line[1:])
+		assert sum(record) & 0xFF == 0
+		size, record_type, payload = record[0], record[3], record[4:-1]
+		assert size == len(payload)
+		address = int.from_bytes(record[1:3], 'big')
+		if record_type == INTEL_HEX_EXTENDED_LINEAR_ADDRESS:
+			upper = int.from_bytes(payload, 'big') << 16
+			continue
+		assert record_type == INTEL_HEX_DATA
+		# a record never crosses a 64 KiB segment
+		assert address + size <= 0x10000
+		for i, byte in enumerate(payload):
+			data[upper + address + i] = byte
+	start = min(data)
+	assert sorted(data) == list(range(start, start + len(data)))
+	return start, bytes(data[address] for address in sorted(data))
+
+@pytest.mark.parametrize('output_format', ['text', 'bin'])
+def test_read_back(tmp_path, output_format: str):
+	assert read_machine_code(write(tmp_path, output_format, MACHINE_CODE), output_format) == MACHINE_CODE
+
+def test_readmemb(tmp_path):
+	with open(write(tmp_path, 'readmemb', MACHINE_CODE)) as f:
+		assert [int(line, 2) for line in f.read().splitlines()] == MACHINE_CODE
+
+def test_readmemh(tmp_path):
+	with open(write(tmp_path, 'readmemh', MACHINE_CODE)) as f:
+		lines = f.read().splitlines()
+	assert all(len(line) == 3 for line in lines)
+	assert [int(line, 16) for line in lines] == MACHINE_CODE
+
+@pytest.mark.parametrize('base_address', [0, IHEX_BASE_ADDRESS])
+def test_intel_hex(tmp_path, base_address: int):
+	start, data = read_intel_hex(write(tmp_path, 'ihex', MACHINE_CODE, base_address))
+	assert start == base_address
+	assert unpack_machine_code(data) == MACHINE_CODE
+
+def test_npy(tmp_path):
+	numpy = pytest.importorskip('numpy')
+	machine_code = numpy.load(write(tmp_path, 'npy', MACHINE_CODE))
+	assert machine_code.dtype == numpy.dtype('<u2')
+	assert machine_code.tolist() == MACHINE_CODE
+
+@pytest.mark.parametrize('output_format', [name for name in OUTPUT_FORMATS if OUTPUT_FORMAT_TABLE[name].pack_array is not None])
+def test_array_matches_list(tmp_path, output_format: str):
+	numpy = pytest.importorskip('numpy')
+	with open(write(tmp_path, output_format, MACHINE_CODE), 'rb') as f:
+		expected = f.read()
+	with open(write(tmp_path, output_format, numpy.array(MACHINE_CODE, dtype=numpy.uint16)), 'rb') as f:
+		assert f.read() == expected
@@ -0,0 +1,31 @@
+from assembler import *
+import argparse
+import pytest
+
+def get_args() -> argparse.Namespace:
+	return argparse.Namespace(optimize=[], stream=False, compact=False, incremental=False, listing=None, cost_report=None, cost_top=COST_REPORT_TOP, object=False)
+
+def assemble(lines: [str]) -> [int]:
+	return list(assemble_source(STANDARD_STREAM, get_args(), ExpansionCache(), lines=lines))
+
+@pytest.mark.parametrize('tagname', ['r1', 'R1', 'r7'])
+def test_register_named_tag(tagname: str):
+	assert lex_source_line(f'@{tagname}:') == (f'@{tagname}',)
+	assert lex_source_line(f'BEQ R1, R2, {tagname}') == ('BEQ', 'R1', 'R2', tagname)
+	program = ['@{}:', 'ADD R1, #1', 'BEQ R1, R2, {}']
+	expected = assemble([line.format('loop') for line in program])
+	assert assemble([line.format(tagname) for line in program]) == expected
+
+def test_register_in_tag_position_of_other_instructions():
+	# only the third operand of BEQ is a tag, a tag name elsewhere is still rejected
+	with pytest.raises(Exception, match='Invalid operands for ADD'):
+		lex_source_line('ADD R1, loop')
+
+def test_every_malformed_line_is_reported():
+	lines = ['ADD R1, #300', 'SUB R1, #0', 'FOO R1', '@9bad', 'BEQ R1, R2, #3']
+	with pytest.raises(Exception) as error:
+		list(lex_source_lines(enumerate(lines, 1)))
+	message = str(error.value)
+	assert message.startswith('5 invalid source line(s)')
+	for line_number in range(1, 6):
+		assert f'line {line_number}:' in message
@@ -0,0 +1,56 @@
+from assembler import *
+from linker import link_modules
+import argparse
+import pytest
+
+# modules in image order, each branches into the others forward and backward
+MODULES = {
+	'main': [
+		'@main',
+		'ADD R1, #1',
+		'BEQ R1, R2, motor',
+		'BEQ R1, R3, sensor',
+		'@main_done',
+		'STR R1, #200',
+	],
+	'motor': [
+		'@motor',
+		'SUB R2, #5',
+		'BEQ R2, R3, sensor',
+		'BEQ R2, R4, main_done',
+		'LSL R2, #2',
+	],
+	'sensor': [
+		'@sensor',
+		'XOR R3, #0x5a',
+		'BEQ R3, R4, main',
+		'BEQ R3, R1, motor',
+	],
+}
+
+def get_args(as_object: bool) -> argparse.Namespace:
+	return argparse.Namespace(optimize=[], stream=False, compact=False, incremental=False, listing=None, cost_report=None, cost_top=COST_REPORT_TOP, object=as_object)
+
+def assemble_objects(tmp_path, modules: dict) -> ([str], [ObjectModule]):
+	object_files = []
+	for name, lines in modules.items():
+		object_file = str(tmp_path / f'{name}{OBJECT_EXTENSION}')
+		assemble_object_file(str(tmp_path / f'{name}.txt'), object_file, get_args(True), ExpansionCache(), lines=lines)
+		object_files.append(object_file)
+	return object_files, [read_object_file(object_file) for object_file in object_files]
+
+def test_linked_image_equals_whole_program(tmp_path):
+	object_files, modules = assemble_objects(tmp_path, MODULES)
+	whole_program = [line for lines in MODULES.values() for line in lines]
+	expected = list(assemble_source(STANDARD_STREAM, get_args(False), ExpansionCache(), lines=whole_program))
+	assert link_modules(object_files, modules) == expected
+
+def test_undefined_tag(tmp_path):
+	object_files, modules = assemble_objects(tmp_path, {'main': MODULES['main'], 'motor': MODULES['motor']})
+	with pytest.raises(Exception, match='Invalid tag: sensor'):
+		link_modules(object_files, modules)
+
+def test_duplicate_tag(tmp_path):
+	object_files, modules = assemble_objects(tmp_path, {**MODULES, 'copy': MODULES['sensor']})
+	with pytest.raises(Exception, match='Tag sensor is defined in'):
+		link_modules(object_files, modules)
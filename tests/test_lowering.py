@@ -0,0 +1,35 @@
+from assembler import *
+from simulator import simulate
+import argparse
+import pytest
+
+'''
+The lowered shifts are run in the simulator: LSL/LSR #n rotate by n and mask off the bits the rotation
+brought around, so every value of the register must come out as a plain shift.
+'''
+
+def get_args() -> argparse.Namespace:
+	return argparse.Namespace(optimize=[], stream=False, compact=False, incremental=False, listing=None, cost_report=None, cost_top=COST_REPORT_TOP, object=False)
+
+def run_shift(line: str, value: int) -> int:
+	words = assemble_source(STANDARD_STREAM, get_args(), ExpansionCache(), lines=[line])
+	registers = [0] * 8
+	registers[1] = value
+	return simulate(list(words), registers=registers).registers[1]
+
+@pytest.mark.parametrize('shamt', range(1, 8))
+def test_lsl_mask(shamt: int):
+	assert get_mask_bits_rtl(shamt) == format((0xFF << shamt) & 0xFF, '08b')
+	for value in range(256):
+		assert run_shift(f'LSL R1, #{shamt}', value) == (value << shamt) & 0xFF
+
+@pytest.mark.parametrize('shamt', range(1, 8))
+def test_lsr_mask(shamt: int):
+	for value in range(256):
+		assert run_shift(f'LSR R1, #{shamt}', value) == value >> shamt
+
+@pytest.mark.parametrize('mnemonic', ['LSL', 'LSR'])
+def test_shift_out_of_byte(mnemonic: str):
+	for value in (0, 1, 0x80, 0xFF):
+		assert run_shift(f'{mnemonic} R1, #8', value) == 0
+		assert run_shift(f'{mnemonic} R1, #0', value) == value
@@ -0,0 +1,51 @@
+from assembler import *
+from benchmark import generate_source, DEFAULT_MIX
+import argparse
+import pytest
+
+'''
+Every assembly path must produce the same image as the default one, for a generated program with all the
+instruction kinds of the benchmark and branches to nearby tags.
+'''
+
+LINE_COUNT = 2000
+MODES = ['default', 'stream', 'compact', 'incremental']
+
+def get_args(mode: str) -> argparse.Namespace:
+	return argparse.Namespace(optimize=[], stream=mode == 'stream', compact=mode == 'compact', incremental=mode == 'incremental', listing=None, cost_report=None, cost_top=COST_REPORT_TOP, object=False, format='text', base_address=0)
+
+def write_source(tmp_path, lines: [str]) -> str:
+	source_file = str(tmp_path / 'prog.txt')
+	with open(source_file, 'w') as f:
+		f.write('\n'.join(lines) + '\n')
+	return source_file
+
+def assemble(source_file: str, mode: str, cache_dir: str = None) -> str:
+	output_file = f'{source_file}.{mode}.out'
+	region_cache = RegionCache(cache_dir) if mode == 'incremental' else None
+	assemble_file(source_file, output_file, get_args(mode), ExpansionCache(), region_cache)
+	with open(output_file) as f:
+		return f.read()
+
+@pytest.fixture(scope='module')
+def source_lines() -> [str]:
+	return generate_source(LINE_COUNT, DEFAULT_MIX)
+
+@pytest.mark.parametrize('mode', MODES)
+def test_mode_matches_default(tmp_path, source_lines: [str], mode: str):
+	source_file = write_source(tmp_path, source_lines)
+	expected = assemble(source_file, 'default')
+	assert assemble(source_file, mode, str(tmp_path / 'cache')) == expected
+
+def test_incremental_rebuild_after_edit(tmp_path, source_lines: [str]):
+	source_file = write_source(tmp_path, source_lines)
+	cache_dir = str(tmp_path / 'cache')
+	assert assemble(source_file, 'incremental', cache_dir) == assemble(source_file, 'default')
+	# a shorter instruction in the middle moves every tag behind it
+	edited_lines = list(source_lines)
+	edited_lines[LINE_COUNT // 2] = 'ZER R1'
+	write_source(tmp_path, edited_lines)
+	expected = assemble(source_file, 'default')
+	assert assemble(source_file, 'incremental', cache_dir) == expected
+	# and again once the regions of the edited source are cached
+	assert assemble(source_file, 'incremental', cache_dir) == expected
@@ -0,0 +1,28 @@
+from util import open_output
+import pytest
+
+def test_failed_write_keeps_the_old_file(tmp_path):
+	output_file = tmp_path / 'out.txt'
+	output_file.write_text('old\n')
+	with pytest.raises(Exception, match='malformed'):
+		with open_output(str(output_file), False) as f:
+			f.write('new\n')
+			raise Exception('malformed')
+	assert output_file.read_text() == 'old\n'
+	assert [path.name for path in tmp_path.iterdir()] == ['out.txt']
+
+def test_failed_write_leaves_no_file(tmp_path):
+	output_file = tmp_path / 'out.txt'
+	with pytest.raises(Exception):
+		with open_output(str(output_file), True) as f:
+			f.write(b'\x01')
+			raise Exception('malformed')
+	assert list(tmp_path.iterdir()) == []
+
+def test_write_replaces_the_file(tmp_path):
+	output_file = tmp_path / 'out.txt'
+	output_file.write_text('old\n')
+	with open_output(str(output_file), False) as f:
+		f.write('new\n')
+	assert output_file.read_text() == 'new\n'
+	assert [path.name for path in tmp_path.iterdir()] == ['out.txt']
@@ -0,0 +1,109 @@
+from assembler import *
+from simulator import simulate, REGISTER_COUNT, RESERVED_REGISTER
+import argparse
+import random
+import pytest
+
+'''
+Every fold of the peephole pass is checked twice: the pass must rewrite the lines into the expected ones,
+and the program with the pass must leave R0-R6 exactly as the program without it, for every value of the
+folded register. R7 is the scratch register of the immediate forms and is not compared.
+'''
+
+# (source lines, the lines the pass should leave)
+FOLDS = [
+	# rotations
+	(['ROL R1, #3', 'ROR R1, #1'], ['ROL R1, #2']),
+	(['ROR R1, #3', 'ROR R1, #2'], ['ROL R1, #3']),
+	(['ROL R1, #3', 'ROL R1, #5'], []),
+	# additions
+	(['ADD R1, #200', 'ADD R1, #100'], ['ADD R1, #44']),
+	(['ADD R1, #5', 'SUB R1, #5'], []),
+	(['SUB R1, #3', 'SUB R1, #4'], ['ADD R1, #249']),
+	# masks
+	(['AND R1, #12', 'AND R1, #10'], ['AND R1, #8']),
+	(['XOR R1, #12', 'XOR R1, #10'], ['XOR R1, #6']),
+	(['XOR R1, #0x5a', 'XOR R1, #0x5a'], []),
+	# shifts
+	(['LSL R1, #2', 'LSL R1, #3'], ['LSL R1, #5']),
+	(['LSL R1, #5', 'LSL R1, #4'], ['ZER R1']),
+	(['LSR R1, #1', 'LSR R1, #2'], ['LSR R1, #3']),
+	(['LSR R1, #6', 'LSR R1, #2'], ['ZER R1']),
+	(['LSL R1, #2', 'LSR R1, #2'], ['AND R1, #63']),
+	(['LSR R1, #3', 'LSL R1, #3'], ['AND R1, #248']),
+	# constants
+	(['MOV R1, #4', 'ADD R1, #1'], ['MOV R1, #5']),
+	(['ZER R1', 'ADD R1, #7'], ['MOV R1, #7']),
+	(['MOV R1, #4', 'SUB R1, #4'], ['ZER R1']),
+	(['MOV R1, #0x81', 'ROL R1, #1'], ['MOV R1, #3']),
+	(['MOV R1, #255', 'LSR R1, #4'], ['MOV R1, #15']),
+	(['MOV R1, #3', 'LSL R1, #9'], ['ZER R1']),
+	# the second instruction overwrites the first
+	(['ADD R1, R2', 'ZER R1'], ['ZER R1']),
+	(['XOR R1, #7', 'MOV R1, #9'], ['MOV R1, #9']),
+	(['ADD R1, #7', 'MOV R1, R2'], ['MOV R1, R2']),
+	# identities
+	(['ADD R1, #0'], []),
+	(['XOR R1, #0'], []),
+	(['AND R1, #255'], []),
+	(['ROL R1, #8'], []),
+	(['ROR R1, #0'], []),
+	(['ROR R1, #16'], []),
+	(['LSL R1, #0'], []),
+	(['LSR R1, #0'], []),
+	(['MOV R1, R1'], []),
+	# pairs that do not fold
+	(['ADD R1, #1', 'AND R1, #3'], ['ADD R1, #1', 'AND R1, #3']),
+	(['LSL R1, #2', 'LSR R1, #3'], ['LSL R1, #2', 'LSR R1, #3']),
+	(['ADD R1, R2', 'ADD R1, #1'], ['ADD R1, R2', 'ADD R1, #1']),
+	(['ADD R1, #1', 'ADD R2, #1'], ['ADD R1, #1', 'ADD R2, #1']),
+]
+
+# the other registers, R1 takes every value
+REGISTER_SEEDS = [
+	[0x00, None, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00],
+	[0x3c, None, 0xa5, 0x01, 0x80, 0xff, 0x7f, 0x00],
+]
+
+def get_args(optimize: [str]) -> argparse.Namespace:
+	return argparse.Namespace(optimize=optimize, stream=False, compact=False, incremental=False, listing=None, cost_report=None, cost_top=COST_REPORT_TOP, object=False)
+
+def canonicalize(lines: [str]) -> [str]:
+	return [' '.join(lex_source_line(line)) for line in lines]
+
+def run(lines: [str], registers: [int], optimize: [str]) -> [int]:
+	words = assemble_source(STANDARD_STREAM, get_args(optimize), ExpansionCache(), lines=lines)
+	return simulate(list(words), registers=registers).registers[:RESERVED_REGISTER]
+
+def check_equivalent(lines: [str], registers: [int]):
+	assert run(lines, registers, ['peephole']) == run(lines, registers, [])
+
+@pytest.mark.parametrize('lines, folded', FOLDS)
+def test_fold_rewrites_lines(lines: [str], folded: [str]):
+	optimized = [line for _, line in PeepholeOptimizer().optimize(enumerate(lines, 1))]
+	assert canonicalize(optimized) == canonicalize(folded)
+
+@pytest.mark.parametrize('lines, folded', FOLDS)
+def test_fold_keeps_registers(lines: [str], folded: [str]):
+	for seed in REGISTER_SEEDS:
+		for value in range(256):
+			registers = list(seed)
+			registers[1] = value
+			check_equivalent(lines, registers)
+
+def test_random_sequences_keep_registers():
+	rng = random.Random(0)
+	mnemonics = ['ADD', 'SUB', 'AND', 'XOR', 'ROL', 'ROR', 'LSL', 'LSR', 'MOV', 'ZER']
+	for _ in range(300):
+		lines = []
+		for _ in range(rng.randint(1, 12)):
+			mnemonic = rng.choice(mnemonics)
+			reg = f'R{rng.randint(0, 2)}'
+			if mnemonic == 'ZER':
+				lines.append(f'ZER {reg}')
+			elif mnemonic in ('ADD', 'AND', 'XOR', 'ROL', 'MOV') and rng.random() < 0.3:
+				lines.append(f'{mnemonic} {reg}, R{rng.randint(0, 2)}')
+			else:
+				imm = rng.choice([1, 2, 3, 4, 5, 7, 8, 9, 16, 128, 250, 255] + ([] if mnemonic == 'SUB' else [0]))
+				lines.append(f'{mnemonic} {reg}, #{imm}')
+		check_equivalent(lines, [rng.randrange(256) for _ in range(REGISTER_COUNT)])
@@ -0,0 +1,34 @@
+from server import AssemblerServer
+import json
+import pytest
+
+SOURCE = '\n'.join([
+	'@start',
+	'ADD R1, #37',
+	'SUB R2, #5',
+	'LSL R3, #2',
+	'STR R1, #200',
+	'BEQ R1, R2, start',
+	'ADD R1, #37',
+])
+
+def assemble(server: AssemblerServer, **options) -> [int]:
+	response = server.assemble({'source': SOURCE, **options})
+	return response['machine_code']
+
+def test_compact_and_normal_requests_share_a_server():
+	expected = assemble(AssemblerServer())
+	server = AssemblerServer()
+	assert assemble(server) == expected
+	assert assemble(server, compact=True) == expected
+	assert assemble(server) == expected
+	assert assemble(server, compact=True) == expected
+
+@pytest.mark.parametrize('name', ['input', 'output', 'listing', 'cost_report'])
+def test_standard_stream_is_rejected(name: str):
+	request = {'id': 1, 'source': SOURCE, name: '-'}
+	if name == 'input':
+		del request['source']
+	response = json.loads(AssemblerServer().handle(json.dumps(request)))
+	assert not response['ok']
+	assert response['error'] == f'Invalid {name} for a server request: -'
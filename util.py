@@ -1,81 +1,321 @@
+from array import array
+from contextlib import contextmanager
+from dataclasses import dataclass
+from functools import lru_cache
+from itertools import islice
+import mmap
+import os
+import sys
+
+WORD_BITS = 9
+# formats read_machine_code understands, the output formats are listed after their writers below
+INPUT_FORMATS = ['text', 'bin']
+# words formatted or packed per write
+WRITE_CHUNK_SIZE = 65536
+# file name that stands for stdin/stdout
+STANDARD_STREAM = '-'
+# images at least this long are encoded and written with NumPy when it is installed
+VECTORIZE_MIN_WORDS = 1 << 16
+# unix socket of server.py, shared with client.py
+SERVER_SOCKET = '.datalore.sock'
+# spellings of immediates kept parsed, bounded since server.py sees new sources for as long as it runs
+IMMEDIATE_CACHE_SIZE = 4096
+
+'''
+Returns the numpy module, None when it is not installed. NumPy is optional and only imported once an image is
+large enough to need it, small programs do not pay for the import.
+'''
+@lru_cache(maxsize=1)
+def get_numpy():
+	try:
+		import numpy
+	except ImportError:
+		return None
+	return numpy
+
 def clean_lines(lines: [str]) -> [str]:
-	cleaned = []
 	# trim the lines
 	# remove empty lines
 	# remove lines that start with //
 	for line in lines:
 		line = line.strip()
 		if line != '' and not line.startswith('//'):
-			cleaned.append(line)
-	return cleaned
+			yield line
 
 def get_lines(filename: str) -> [str]:
-	with open(filename) as f:
-		lines = f.readlines()
-	return lines
+	# lines are read lazily so that large sources are never held in memory at once
+	if filename == STANDARD_STREAM:
+		yield from sys.stdin
+		return
+	with open(filename, 'rb') as f:
+		try:
+			# only the current line is copied out of the mapping, the page cache holds the rest
+			mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		except (ValueError, OSError):
+			# empty files, pipes and other files that cannot be mapped
+			for line in f:
+				yield line.decode()
+			return
+		with mapped:
+			for line in iter(mapped.readline, b''):
+				yield line.decode()
 
 def get_cleaned_lines(filename: str) -> [str]:
 	lines = get_lines(filename)
 	return clean_lines(lines)
 
+# 8 bit immediates as strings, split into their two 4 bit halves, and their 8 bit negations (SUB)
+EIGHT_BIT_VALUES = [format(value, '08b') for value in range(256)]
+HALF_IMMS = [(bits[:4], bits[4:]) for bits in EIGHT_BIT_VALUES]
+TWOS_COMPLEMENT_NEGATIVES = [EIGHT_BIT_VALUES[-value & 0xFF] for value in range(256)]
+# 12 bit branch offsets, by offset & 0xFFF, as strings and split into the 3 nibbles of the BEQ preamble
+TWELVE_BIT_VALUES = [format(value, '012b') for value in range(4096)]
+TWELVE_BIT_NIBBLES = [(bits[0:4], bits[4:8], bits[8:12]) for bits in TWELVE_BIT_VALUES]
+# AND masks that clear the bits a rotation by 0..8 brought around, by shift amount
+MASK_BITS_RTL = [format((0xFF << shift) & 0xFF, '08b') for shift in range(9)]
+
+IMMEDIATE_BASES = {'0x': 16, '0b': 2}
+
+'''
+Returns the value of an immediate without its #: decimal, hex (0x..) or binary (0b..)
+'''
+@lru_cache(maxsize=IMMEDIATE_CACHE_SIZE)
+def parse_immediate(imm: str) -> int:
+	base = IMMEDIATE_BASES.get(imm[:2].lower())
+	if base is None:
+		return int(imm)
+	return int(imm[2:], base)
+
 def get_half_imms(imm: str) -> (str, str):
-	imm = int(imm)
-	imm = bin(imm)[2:]
-	if len(imm) < 8:
-		imm = '0' * (8 - len(imm)) + imm
-	elif len(imm) > 8:
+	value = int(imm)
+	if value < 0 or value > 255:
 		raise Exception(f'Immediate value {imm} is too large')
-	return imm[:4], imm[4:]
+	return HALF_IMMS[value]
 
 def get_12_bit_memory_address(num: str) -> str:
 	num = int(num)
 	if num < 0:
 		raise Exception('Only positive numbers can be converted to 12 bit representations. Did you mean you apply abs()?')
-	num = bin(num)[2:]
-	num = num.zfill(12)
-	if len(num) > 12:
+	if num > 4095:
 		raise Exception(f'Address offset value {num} is too large')
-	return num
+	return TWELVE_BIT_VALUES[num]
 
 def get_12_bit_twos_comp_negative(num: str) -> str:
-	num = get_12_bit_memory_address(num)
-	num = num.replace('0', 'x')
-	num = num.replace('1', '0')
-	num = num.replace('x', '1')
-	num = bin(int(num, 2) + 1)[2:]
-	if len(num) > 12:
+	num = int(num)
+	if num < 0:
+		raise Exception('Only positive numbers can be converted to 12 bit representations. Did you mean you apply abs()?')
+	if num > 4095:
+		raise Exception(f'Address offset value {num} is too large')
+	if num == 0:
+		# the negation of 0 does not fit in 12 bits
 		raise Exception(f'Address offset value {num} is too small')
-	return num
+	return TWELVE_BIT_VALUES[-num & 0xFFF]
 
 def get_twos_complement_negative(num: str) -> str:
-	num = int(num)
-	num = bin(num)[2:]
-	if len(num) < 8:
-		num = '0' * (8 - len(num)) + num
-	elif len(num) > 8:
+	value = int(num)
+	if value == 0:
+		raise Exception(f'Immediate value {num} has no 8 bit negation')
+	if value < 0 or value > 255:
 		raise Exception(f'Immediate value {num} is too large')
-	num = num.replace('0', 'x')
-	num = num.replace('1', '0')
-	num = num.replace('x', '1')
-	num = bin(int(num, 2) + 1)[2:]
-	if len(num) < 8:
-		num = '0' * (8 - len(num)) + num
-	elif len(num) > 8:
-		raise Exception(f'Immediate value {num} is too large')
-	return num
+	return TWOS_COMPLEMENT_NEGATIVES[value]
+
+def format_machine_word(word: int) -> str:
+	return format(word, f'0{WORD_BITS}b')
+
+# text output line of every machine word
+FORMATTED_MACHINE_WORDS = [format_machine_word(word) + '\n' for word in range(1 << WORD_BITS)]
+
+def pack_machine_code(machine_code: [int]) -> bytes:
+	# each 9 bit word is stored in 2 bytes, big endian
+	packed = array('H', machine_code)
+	if sys.byteorder == 'little':
+		packed.byteswap()
+	return packed.tobytes()
+
+def format_machine_code(machine_code: [int]) -> str:
+	return ''.join(map(FORMATTED_MACHINE_WORDS.__getitem__, machine_code))
+
+# $readmemh line of every machine word, 3 hex digits
+FORMATTED_HEX_MACHINE_WORDS = [format(word, '03x') + '\n' for word in range(1 << WORD_BITS)]
+
+def format_hex_machine_code(machine_code: [int]) -> str:
+	return ''.join(map(FORMATTED_HEX_MACHINE_WORDS.__getitem__, machine_code))
+
+# data bytes per Intel HEX data record
+INTEL_HEX_RECORD_SIZE = 16
+INTEL_HEX_DATA = 0x00
+INTEL_HEX_END_OF_FILE = 0x01
+INTEL_HEX_EXTENDED_LINEAR_ADDRESS = 0x04
+
+def format_intel_hex_record(record_type: int, address: int, data: bytes) -> str:
+	record = bytes([len(data), address >> 8, address & 0xFF, record_type]) + data
+	checksum = -sum(record) & 0xFF
+	return f':{record.hex().upper()}{checksum:02X}\n'
+
+'''
+Intel HEX records of the words, 2 big endian bytes each like the bin format. address is the index of the
+first word in the image and base_address the byte address the image is loaded at. Every chunk starts with
+an extended linear address record, so chunks can be formatted on their own.
+'''
+def format_intel_hex(machine_code: [int], address: int, base_address: int) -> str:
+	data = pack_machine_code(machine_code)
+	start = base_address + 2 * address
+	if start + len(data) > 1 << 32:
+		raise Exception(f'The image does not fit below 4 GiB at base address {base_address:#x}')
+	records = []
+	pos = 0
+	while pos < len(data):
+		byte_address = start + pos
+		if pos == 0 or byte_address & 0xFFFF == 0:
+			records.append(format_intel_hex_record(INTEL_HEX_EXTENDED_LINEAR_ADDRESS, 0, (byte_address >> 16).to_bytes(2, 'big')))
+		# a record never crosses a 64 KiB segment
+		size = min(INTEL_HEX_RECORD_SIZE, len(data) - pos, 0x10000 - (byte_address & 0xFFFF))
+		records.append(format_intel_hex_record(INTEL_HEX_DATA, byte_address & 0xFFFF, data[pos:pos + size]))
+		pos += size
+	return ''.join(records)
+
+NPY_MAGIC = b'\x93NUMPY\x01\x00'
+# the .npy header is padded so that the data starts at a multiple of this
+NPY_ALIGNMENT = 64
+
+# .npy version 1.0 header of a one dimensional little endian uint16 array, numpy.load reads it
+def format_npy_header(count: int) -> bytes:
+	header = f"{{'descr': '<u2', 'fortran_order': False, 'shape': ({count},), }}"
+	padding = -(len(NPY_MAGIC) + 2 + len(header) + 1) % NPY_ALIGNMENT
+	header = (header + ' ' * padding + '\n').encode('latin1')
+	return NPY_MAGIC + len(header).to_bytes(2, 'little') + header
+
+def pack_npy_machine_code(machine_code: [int]) -> bytes:
+	packed = array('H', machine_code)
+	if sys.byteorder == 'big':
+		packed.byteswap()
+	return packed.tobytes()
+
+@dataclass(frozen=True)
+class OutputFormat:
+	name: str
+	extension: str
+	binary: bool
+	# (words, index of the first one, base address) -> the text or bytes written for them
+	pack: object
+	# (number of words) -> what goes in front of the words, the words are counted before anything is written
+	header: object = None
+	footer: object = None
+	# (NumPy array of words) -> the whole image, used when the encoder hands over a NumPy array
+	pack_array: object = None
+
+# the formatted lines of all 512 words as rows of characters, an image is then formatted with one gather, once for the binary and once for the hex digits
+@lru_cache(maxsize=2)
+def get_word_characters(formatted_words: tuple):
+	numpy = get_numpy()
+	return numpy.frombuffer(''.join(formatted_words).encode('ascii'), dtype=numpy.uint8).reshape(len(formatted_words), -1)
+
+def format_machine_code_array(machine_code) -> str:
+	return get_word_characters(tuple(FORMATTED_MACHINE_WORDS))[machine_code].tobytes().decode('ascii')
+
+def format_hex_machine_code_array(machine_code) -> str:
+	return get_word_characters(tuple(FORMATTED_HEX_MACHINE_WORDS))[machine_code].tobytes().decode('ascii')
+
+OUTPUT_FORMAT_SPECS = [
+	# one 9 bit string per line
+	OutputFormat('text', '.txt', False, lambda machine_code, address, base_address: format_machine_code(machine_code), pack_array=format_machine_code_array),
+	# 2 big endian bytes per word
+	OutputFormat('bin', '.bin', True, lambda machine_code, address, base_address: pack_machine_code(machine_code), pack_array=lambda machine_code: machine_code.astype('>u2').tobytes()),
+	# the text lines, $readmemb reads them as they are
+	OutputFormat('readmemb', '.memb', False, lambda machine_code, address, base_address: format_machine_code(machine_code), pack_array=format_machine_code_array),
+	# 3 hex digits per line for $readmemh
+	OutputFormat('readmemh', '.memh', False, lambda machine_code, address, base_address: format_hex_machine_code(machine_code), pack_array=format_hex_machine_code_array),
+	OutputFormat('ihex', '.hex', False, format_intel_hex, footer=format_intel_hex_record(INTEL_HEX_END_OF_FILE, 0, b'')),
+	# little endian uint16 array for numpy.load
+	OutputFormat('npy', '.npy', True, lambda machine_code, address, base_address: pack_npy_machine_code(machine_code), header=format_npy_header, pack_array=lambda machine_code: machine_code.astype('<u2').tobytes()),
+]
+
+OUTPUT_FORMAT_TABLE = {spec.name: spec for spec in OUTPUT_FORMAT_SPECS}
+OUTPUT_FORMATS = [spec.name for spec in OUTPUT_FORMAT_SPECS]
+OUTPUT_EXTENSIONS = {spec.name: spec.extension for spec in OUTPUT_FORMAT_SPECS}
+
+'''
+Opens output_file for writing. A regular file is written under a temporary name next to it and only
+replaces output_file once the block finished, so a lazy producer that fails (a malformed line in --stream
+mode) leaves the previous file alone instead of an empty or partial one. Devices and pipes are written in
+place and stdout is left open for the caller, what was written to them before an error stays written.
+'''
+@contextmanager
+def open_output(output_file: str, binary: bool):
+	mode = 'wb' if binary else 'w'
+	if output_file == STANDARD_STREAM:
+		yield sys.stdout.buffer if binary else sys.stdout
+		return
+	path = os.path.realpath(output_file)
+	if os.path.exists(path) and not os.path.isfile(path):
+		with open(path, mode) as f:
+			yield f
+		return
+	temporary_path = f'{path}.{os.getpid()}.tmp'
+	try:
+		with open(temporary_path, mode) as f:
+			yield f
+	except BaseException:
+		os.remove(temporary_path)
+		raise
+	os.replace(temporary_path, path)
+
+# returns the number of words written
+def write_machine_code(output_file :str, machine_code: [int], output_format: str = 'text', base_address: int = 0) -> int:
+	spec = OUTPUT_FORMAT_TABLE.get(output_format)
+	if spec is None:
+		raise Exception(f'Invalid output format: {output_format}')
+	count = 0
+	# only a caller that imported NumPy can hand over one of its arrays
+	numpy = sys.modules.get('numpy')
+	if numpy is not None and isinstance(machine_code, numpy.ndarray):
+		if spec.pack_array is None:
+			machine_code = machine_code.tolist()
+		else:
+			with open_output(output_file, spec.binary) as f:
+				if spec.header is not None:
+					f.write(spec.header(len(machine_code)))
+				f.write(spec.pack_array(machine_code))
+				f.flush()
+			return len(machine_code)
+	with open_output(output_file, spec.binary) as f:
+		if spec.header is not None:
+			machine_code = list(machine_code)
+			f.write(spec.header(len(machine_code)))
+		machine_code = iter(machine_code)
+		while True:
+			chunk = list(islice(machine_code, WRITE_CHUNK_SIZE))
+			if not chunk:
+				break
+			f.write(spec.pack(chunk, count, base_address))
+			count += len(chunk)
+		if spec.footer is not None:
+			f.write(spec.footer)
+		f.flush()
+	return count
+
+def unpack_machine_code(data: bytes) -> [int]:
+	packed = array('H')
+	packed.frombytes(data)
+	if sys.byteorder == 'little':
+		packed.byteswap()
+	return packed.tolist()
 
-def write_machine_code(output_file :str, machine_code: [str]):
-	with open(output_file, 'w') as f:
-		for line in machine_code:
-			f.write(line + '\n')
+def read_machine_code(input_file: str, input_format: str = 'text') -> [int]:
+	if input_format == 'text':
+		return [int(line, 2) for line in clean_lines(get_lines(input_file))]
+	elif input_format == 'bin':
+		if input_file == STANDARD_STREAM:
+			return unpack_machine_code(sys.stdin.buffer.read())
+		with open(input_file, 'rb') as f:
+			return unpack_machine_code(f.read())
+	else:
+		raise Exception(f'Invalid input format: {input_format}')
 
 def get_mask_bits_rtl(num: int) -> str:
 	# eg: (2) -> 0b11111100
 	# eg: (3) -> 0b11111000
-	mask = 0
-	for i in range(num):
-		mask += 2 ** (7 - i)
-	return bin(mask)[2:]
+	return MASK_BITS_RTL[num]
 
 if __name__ == '__main__':
 	print(get_twos_complement_negative('56'))